@@ -1,14 +1,63 @@
+import csv
+import hashlib
+import hmac
+import html
+import io
+import ipaddress
 import json
+import math
+import multiprocessing
 import requests
 import logging
 import os
+import queue
+import random
+import select
+import socket
 import time
+import threading
 import psycopg2
-from flask import Flask, request, jsonify, send_from_directory, session, redirect, url_for
+import psycopg2.extensions
+import psycopg2.pool
+import click
+import zstandard
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify, send_from_directory, session, redirect, url_for, g, has_request_context
 from typing import Dict, Any, Optional
-from datetime import datetime
-from functools import wraps
-from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlparse
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError, wait as futures_wait
+from functools import partial, wraps
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+from prometheus_client import (
+    REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess
+)
+
+# OpenTelemetry - опциональная зависимость (requirements-tracing.txt)
+try:
+    from opentelemetry import context as otel_context, propagate as otel_propagate, trace as otel_trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+    OTEL_AVAILABLE = True
+except ImportError:
+    OTEL_AVAILABLE = False
+
+# Redis - опциональная зависимость (requirements-redis.txt)
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
 
 # Определяем абсолютный путь к dist папке
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -29,1512 +78,5624 @@ logger = logging.getLogger(__name__)
 # Database URL from environment
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
-# eKomKassa environment: 'production' or 'sandbox'
-EKOMKASSA_ENV = os.environ.get('EKOMKASSA_ENV', 'sandbox')
+# Пул соединений с БД (на каждый gunicorn воркер)
+DB_POOL_MIN_CONNECTIONS = int(os.environ.get('DB_POOL_MIN_CONNECTIONS', '1'))
+DB_POOL_MAX_CONNECTIONS = int(os.environ.get('DB_POOL_MAX_CONNECTIONS', '5'))
+# Таймаут установки нового соединения: недоступная БД не должна держать поток дольше таймаута gunicorn
+DB_CONNECT_TIMEOUT_SECONDS = int(os.environ.get('DB_CONNECT_TIMEOUT_SECONDS', '3'))
+
+# Каталог для метрик Prometheus в multiprocess режиме (общий для всех gunicorn воркеров)
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Отдавать клиенту заголовок Server-Timing с разбивкой времени по фазам обработки
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+# Трассировка OpenTelemetry: экспорт в OTLP коллектор (OTEL_EXPORTER_OTLP_ENDPOINT) или в файл
+OTEL_TRACING_ENABLED = os.environ.get('OTEL_TRACING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+OTEL_EXPORTER = os.environ.get('OTEL_EXPORTER', 'otlp')  # otlp | file
+OTEL_TRACES_FILE = os.environ.get('OTEL_TRACES_FILE', '/var/log/ekomkassa-gateway/traces.jsonl')
+# Доля трассируемых запросов: ограничивает накладные расходы при высоком RPS
+OTEL_SAMPLE_RATIO = float(os.environ.get('OTEL_SAMPLE_RATIO', '0.05'))
+# Служебные пути не трассируем
+OTEL_EXCLUDED_PATHS = ('/health', '/health/live', '/health/ready', '/metrics')
+
+# Проверка готовности воркера (/health/ready): результат кэшируется на HEALTH_CACHE_SECONDS,
+# чтобы частые пробы балансировщика не нагружали БД
+HEALTH_CACHE_SECONDS = float(os.environ.get('HEALTH_CACHE_SECONDS', '2'))
+HEALTH_DB_TIMEOUT_MS = 1000
+# Сколько проба ждёт уже идущую проверку; дольше - воркер не готов (зависшая БД не должна вешать пробы)
+HEALTH_PROBE_WAIT_SECONDS = 3.0
+# Ошибок записи логов в БД подряд, после которых воркер считается неготовым
+HEALTH_LOG_WRITE_FAILURES = 3
+# Потоков gthread в воркере (--threads в ekomkassa-gateway.service)
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', '4'))
+
+# Circuit breaker для eKomKassa (отдельный на auth/receipt/status, состояние у каждого воркера своё):
+# размыкается, если за CIRCUIT_WINDOW_SECONDS было не меньше CIRCUIT_MIN_CALLS вызовов и доля ошибок
+# (нет ответа или 5xx) или медленных вызовов превысила порог; через CIRCUIT_OPEN_SECONDS пропускает пробный запрос
+CIRCUIT_BREAKER_ENABLED = os.environ.get('CIRCUIT_BREAKER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+CIRCUIT_WINDOW_SECONDS = float(os.environ.get('CIRCUIT_WINDOW_SECONDS', '30'))
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', '10'))
+CIRCUIT_ERROR_RATE = float(os.environ.get('CIRCUIT_ERROR_RATE', '0.5'))
+CIRCUIT_SLOW_RATE = float(os.environ.get('CIRCUIT_SLOW_RATE', '0.8'))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', '15'))
+# Порог медленного вызова по операциям (секунды)
+CIRCUIT_SLOW_CALL_SECONDS = {'auth': 5.0, 'status': 5.0, 'receipt': 8.0}
+
+# Bulkhead: отдельный лимит одновременных запросов на воркер для каждого класса endpoint,
+# чтобы поток запросов статуса не занимал все потоки gthread, нужные для создания чеков.
+# Сверх лимита запрос сразу отклоняется (503), без очереди
+BULKHEAD_ENABLED = os.environ.get('BULKHEAD_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+BULKHEAD_MAX_LIMITS = {
+    'receipt': int(os.environ.get('BULKHEAD_RECEIPT_LIMIT', '4')),
+    'status': int(os.environ.get('BULKHEAD_STATUS_LIMIT', '2')),
+    'auth': int(os.environ.get('BULKHEAD_AUTH_LIMIT', '2')),
+    'admin': int(os.environ.get('BULKHEAD_ADMIN_LIMIT', '3'))
+}
+BULKHEAD_MIN_LIMIT = 1
+# Лимиты классов, обращающихся к eKomKassa, подстраиваются по AIMD: +1/limit за ответ быстрее
+# целевой задержки, умножение на BULKHEAD_BACKOFF при медленном ответе или ошибке.
+# Целевая задержка - минимальная задержка eKomKassa за последнее окно, умноженная на BULKHEAD_LATENCY_TOLERANCE,
+# но не меньше минимальной цели операции: стабильно медленный eKomKassa не сводит лимит к 1
+BULKHEAD_MIN_TARGET_LATENCY_SECONDS = {'auth': 1.0, 'status': 1.0, 'receipt': 2.0}
+BULKHEAD_LATENCY_TOLERANCE = float(os.environ.get('BULKHEAD_LATENCY_TOLERANCE', '2.0'))
+BULKHEAD_MIN_LATENCY_WINDOW_SECONDS = 60
+BULKHEAD_BACKOFF = float(os.environ.get('BULKHEAD_BACKOFF', '0.75'))
+# Одновременных запросов одного клиента (AuthToken, иначе IP) на воркер; сверх - 429. 0 - без ограничения:
+# AuthToken чеков передаётся в теле, поэтому все запросы бэкенда магазина считаются по его IP
+BULKHEAD_CLIENT_LIMIT = int(os.environ.get('BULKHEAD_CLIENT_LIMIT', '0'))
+BULKHEAD_ENDPOINTS = {
+    '/api/kkt/cloud/receipt': 'receipt',
+    '/api/kkt/cloud/status': 'status',
+    '/api/Authorization/CreateAuthToken': 'auth'
+}
+# Не ограничиваются: служебные пути, live tail (у него свой лимит LIVE_TAIL_MAX_CLIENTS)
+# и результаты чеков от eKomKassa (все приходят с одного IP)
+BULKHEAD_EXCLUDED_PATHS = (
+    '/health', '/health/live', '/health/ready', '/metrics', '/api/request-logs/tail', '/api/ekomkassa/callback'
+)
+
+# Token bucket лимиты запросов к eKomKassa по логину, токену и группе касс (общие для воркеров, в Postgres,
+# migrations/008_rate_limit_buckets.sql). Квоты "вид=запросов_в_секунду/размер_bucket"
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+RATE_LIMIT_QUOTAS = {
+    kind.strip(): tuple(float(part) for part in quota.split('/', 1))
+    for kind, quota in (
+        item.split('=', 1)
+        for item in os.environ.get('RATE_LIMIT_QUOTAS', 'login=1/5,token=10/20,group=20/40').split(',') if '=' in item
+    )
+}
+# Квоты отдельных ключей: "group:700=50/100,login:shop=2/10"
+RATE_LIMIT_OVERRIDES = {
+    key.strip(): tuple(float(part) for part in quota.split('/', 1))
+    for key, quota in (
+        item.split('=', 1) for item in os.environ.get('RATE_LIMIT_OVERRIDES', '').split(',') if '=' in item
+    )
+}
+# Сколько можно задержать запрос сверх квоты в ожидании токена; 0 - сразу отклонять
+RATE_LIMIT_MAX_DELAY_MS = int(os.environ.get('RATE_LIMIT_MAX_DELAY_MS', '0'))
+
+# Бюджет времени на запрос: nginx (proxy_read_timeout) и gunicorn обрывают запрос через 30 с, поэтому
+# по умолчанию 25 с. Клиент может сократить его заголовком X-Request-Timeout-Ms. Таймауты запросов
+# к eKomKassa и паузы между повторами не выходят за остаток бюджета
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', '25'))
+REQUEST_DEADLINE_HEADER = 'X-Request-Timeout-Ms'
+# С меньшим остатком бюджета запрос в eKomKassa не отправляется
+UPSTREAM_MIN_TIMEOUT_SECONDS = 0.1
+
+# Повторы запросов к eKomKassa: попыток на операцию и при каких ошибках повторять
+#   any     - нет ответа или 502/503/504 (идемпотентные auth и status)
+#   connect - только если соединение не установлено и запрос точно не отправлен (создание чека)
+RETRY_POLICIES = {
+    'auth': {'attempts': int(os.environ.get('RETRY_AUTH_ATTEMPTS', '3')), 'retry_on': 'any'},
+    'status': {'attempts': int(os.environ.get('RETRY_STATUS_ATTEMPTS', '3')), 'retry_on': 'any'},
+    'receipt': {'attempts': int(os.environ.get('RETRY_RECEIPT_ATTEMPTS', '2')), 'retry_on': 'connect'}
+}
+RETRY_STATUS_CODES = (502, 503, 504)
+# Экспоненциальная задержка с полным jitter: случайно от 0 до min(MAX, BASE * 2^(попытка-1))
+RETRY_BASE_DELAY_MS = int(os.environ.get('RETRY_BASE_DELAY_MS', '100'))
+RETRY_MAX_DELAY_MS = int(os.environ.get('RETRY_MAX_DELAY_MS', '1000'))
+# Бюджет повторов воркера по операции: каждый запрос добавляет RETRY_BUDGET_RATIO повтора (не больше
+# RETRY_BUDGET_MAX), поэтому при массовых ошибках повторов не больше ~20% от потока, а не кратно ему
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', '0.2'))
+RETRY_BUDGET_MAX = 10.0
+
+# Hedging запросов статуса: если ответа нет дольше HEDGE_QUANTILE наблюдаемых задержек, отправляется
+# второй такой же запрос и берётся первый ответ. Тратит бюджет повторов и не работает при открытом breaker
+HEDGE_STATUS_ENABLED = os.environ.get('HEDGE_STATUS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+HEDGE_QUANTILE = float(os.environ.get('HEDGE_QUANTILE', '0.95'))
+HEDGE_MIN_DELAY_MS = int(os.environ.get('HEDGE_MIN_DELAY_MS', '50'))
+# Задержек в выборке для квантиля; пока их меньше HEDGE_MIN_SAMPLES, hedging не используется
+HEDGE_SAMPLE_SIZE = 500
+HEDGE_MIN_SAMPLES = 50
+
+# Пулы eKomKassa: имя -> базовые URL API fiscalorder/v5 (несколько - для переключения между ними),
+# веса, стратегия выбора (weighted / least_latency), таймауты по операциям и размер пула соединений.
+# Пример: {"production": {"urls": ["https://app.ecomkassa.ru"]},
+#          "sandbox": {"urls": ["https://sandbox.example"], "timeouts": {"receipt": 30}}}
+EKOMKASSA_BASE_URL = os.environ.get('EKOMKASSA_BASE_URL', 'https://app.ecomkassa.ru')
+UPSTREAM_POOLS_CONFIG = json.loads(
+    os.environ.get('UPSTREAM_POOLS') or json.dumps({'production': {'urls': [EKOMKASSA_BASE_URL]}})
+)
+UPSTREAM_DEFAULT_POOL = os.environ.get('UPSTREAM_DEFAULT_POOL', next(iter(UPSTREAM_POOLS_CONFIG)))
+# Маршрутизация арендаторов по пулам: "group:700=production,login:demo=sandbox" (иначе UPSTREAM_DEFAULT_POOL).
+# Пул, выбранный по логину при авторизации, запоминается за выданным токеном в общем хранилище
+# на UPSTREAM_TOKEN_POOL_TTL_SECONDS: чеки и статусы с этим токеном идут в тот же пул
+UPSTREAM_ROUTES = {
+    key.strip(): pool.strip()
+    for key, pool in (
+        item.split('=', 1) for item in os.environ.get('UPSTREAM_ROUTES', '').split(',') if '=' in item
+    )
+}
+UPSTREAM_TOKEN_POOL_TTL_SECONDS = int(os.environ.get('UPSTREAM_TOKEN_POOL_TTL_SECONDS', str(24 * 3600)))
+# Ошибка в именах пулов должна останавливать запуск, а не давать 500 на каждый запрос арендатора
+for _route, _pool_name in [('UPSTREAM_DEFAULT_POOL', UPSTREAM_DEFAULT_POOL), *UPSTREAM_ROUTES.items()]:
+    if _pool_name not in UPSTREAM_POOLS_CONFIG:
+        raise ValueError(f'Unknown upstream pool {_pool_name!r} in {_route}; pools: {", ".join(UPSTREAM_POOLS_CONFIG)}')
+    if _route != 'UPSTREAM_DEFAULT_POOL' and not _route.startswith(('group:', 'login:')):
+        raise ValueError(f'Upstream route {_route!r} must start with group: or login:')
+UPSTREAM_DEFAULT_TIMEOUTS = {'auth': 10, 'status': 10, 'receipt': 15}
+EKOMKASSA_AUTH_PATH = '/fiscalorder/v5/getToken'
+# После стольких ошибок подряд адрес пула исключается из выбора на UPSTREAM_ENDPOINT_COOLDOWN_SECONDS
+UPSTREAM_ENDPOINT_MAX_FAILURES = 3
+UPSTREAM_ENDPOINT_COOLDOWN_SECONDS = float(os.environ.get('UPSTREAM_ENDPOINT_COOLDOWN_SECONDS', '30'))
+# Вес нового замера в скользящей средней задержке адреса (EWMA)
+UPSTREAM_LATENCY_EWMA_ALPHA = 0.2
+
+# Активная проверка адресов пулов: раз в UPSTREAM_PROBE_INTERVAL_SECONDS в каждом воркере замеряется
+# установка TCP соединения и ответ на лёгкие запросы к API авторизации и fiscalorder (без тела)
+UPSTREAM_PROBE_ENABLED = os.environ.get('UPSTREAM_PROBE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+UPSTREAM_PROBE_INTERVAL_SECONDS = float(os.environ.get('UPSTREAM_PROBE_INTERVAL_SECONDS', '15'))
+UPSTREAM_PROBE_TIMEOUT_SECONDS = float(os.environ.get('UPSTREAM_PROBE_TIMEOUT_SECONDS', '3'))
+UPSTREAM_PROBE_PATHS = {'auth': EKOMKASSA_AUTH_PATH, 'fiscalorder': '/fiscalorder/v5/'}
+# Доступность адреса - EWMA успешности проверок (1 - все успешны); ниже порога адрес исключается из выбора
+UPSTREAM_PROBE_AVAILABILITY_ALPHA = 0.3
+UPSTREAM_PROBE_MIN_AVAILABILITY = float(os.environ.get('UPSTREAM_PROBE_MIN_AVAILABILITY', '0.5'))
+
+logger.info(f'eKomKassa upstream pools: {json.dumps(UPSTREAM_POOLS_CONFIG)}, default: {UPSTREAM_DEFAULT_POOL}')
+
+# Уровень логирования запросов (в БД и журнал процесса):
+#   off         - только статистика, без записей логов
+#   summary     - метаданные запроса (путь, статус, время) без заголовков и тел
+#   errors-full - полные тела только для ошибок
+#   full        - полные тела (с выборкой LOG_FULL_SAMPLE_RATES для успешных запросов)
+LOG_TIER = os.environ.get('LOG_TIER', 'full')
+
+# Доля успешных запросов с полными телами по endpoint: "/api/kkt/cloud/status=0.01,/api/kkt/cloud/receipt=1"
+LOG_FULL_SAMPLE_RATES = {
+    path.strip(): float(rate)
+    for path, rate in (
+        item.split('=', 1) for item in os.environ.get('LOG_FULL_SAMPLE_RATES', '').split(',') if '=' in item
+    )
+}
+LOG_FULL_SAMPLE_RATE_DEFAULT = float(os.environ.get('LOG_FULL_SAMPLE_RATE', '1.0'))
+
+# Ограничение размера одного тела в логе (байт JSON), больше - обрезается
+LOG_PAYLOAD_MAX_BYTES = int(os.environ.get('LOG_PAYLOAD_MAX_BYTES', '16384'))
+
+# Маскировать персональные данные (Email/Phone) в логах
+LOG_REDACT_PII = os.environ.get('LOG_REDACT_PII', 'true').lower() in ('1', 'true', 'yes')
+
+# Ключи (без учёта регистра), значения которых никогда не пишутся в логи
+LOG_SECRET_KEYS = frozenset({
+    'password', 'pass', 'token', 'authtoken', 'authorization', 'cookie', 'set-cookie', 'x-api-key', 'secret'
+})
+LOG_PII_KEYS = frozenset({'email', 'phone'})
+# URL в телах запросов, в которых маскируются секретные параметры (ключ service.callback_url шлюза)
+LOG_URL_KEYS = frozenset({'callback_url', 'callbackurl'})
+LOG_SECRET_QUERY_PARAMS = LOG_SECRET_KEYS | {'key'}
+
+# Холодное хранение: payload записей request_logs старше ARCHIVE_AFTER_DAYS переносятся
+# в сжатые zstd сегменты NDJSON (flask archive-request-logs), в БД остаётся сводная строка
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '/var/lib/ekomkassa-gateway/archive')
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '7'))
+# Строк в одном сегменте и в одном zstd блоке (блок - единица чтения при случайном доступе)
+ARCHIVE_SEGMENT_ROWS = int(os.environ.get('ARCHIVE_SEGMENT_ROWS', '10000'))
+ARCHIVE_BLOCK_ROWS = int(os.environ.get('ARCHIVE_BLOCK_ROWS', '64'))
+ARCHIVE_ZSTD_LEVEL = int(os.environ.get('ARCHIVE_ZSTD_LEVEL', '9'))
+# Сколько индексов сегментов держать в памяти воркера
+ARCHIVE_INDEX_CACHE_SEGMENTS = int(os.environ.get('ARCHIVE_INDEX_CACHE_SEGMENTS', '32'))
+
+# Потоковая выгрузка /api/request-logs/export: строк в одном батче server-side курсора
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', '2000'))
+
+# Пакетный повтор запросов (/api/replay-jobs): ограничения на одно задание
+REPLAY_JOB_MAX_ROWS = int(os.environ.get('REPLAY_JOB_MAX_ROWS', '10000'))
+# Не больше размера пула соединений HTTP-сессии к eKomKassa (10)
+REPLAY_JOB_MAX_CONCURRENCY = 8
+REPLAY_JOB_BATCH_ROWS = 100
+# Различий, сохраняемых на одну строку
+REPLAY_DIFF_MAX_ENTRIES = 20
+# Ключи, различия в которых не считаются изменением ответа
+REPLAY_DIFF_IGNORE_KEYS = ('timestamp',)
+
+# Опрос статусов чеков шлюзом (migrations/009_receipt_status_polling.sql): созданные чеки опрашиваются
+# в фоне каждого воркера, финальный статус сохраняется (на него отвечает /api/kkt/cloud/status)
+# и отправляется POST на CallbackUrl чека.
+#   callback - опрашивать только чеки с CallbackUrl, all - все созданные чеки
+STATUS_POLL_ENABLED = os.environ.get('STATUS_POLL_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+STATUS_POLL_MODE = os.environ.get('STATUS_POLL_MODE', 'callback')
+# Паузы между опросами одного чека (секунды); после последней - с её интервалом
+STATUS_POLL_SCHEDULE_SECONDS = (2, 3, 5, 10, 15, 30, 60)
+# Без финального статуса дольше этого чек больше не опрашивается (токен eKomKassa живёт сутки)
+STATUS_POLL_MAX_AGE_HOURS = int(os.environ.get('STATUS_POLL_MAX_AGE_HOURS', '24'))
+# Чеков, обрабатываемых воркером за один проход, и пауза, когда опрашивать нечего
+STATUS_POLL_BATCH_ROWS = int(os.environ.get('STATUS_POLL_BATCH_ROWS', '20'))
+STATUS_POLL_IDLE_SECONDS = 1.0
+# Строки забираются по одной на это время: другой воркер не возьмёт строку, пока идёт её обработка.
+# Должно быть больше худшего времени одной строки: опрос статуса с повторами (~3 x 10 с) или доставка
+STATUS_POLL_LEASE_SECONDS = 60
+# Доставка на CallbackUrl: паузы между попытками (секунды), после последней - отказ
+STATUS_CALLBACK_SCHEDULE_SECONDS = (10, 30, 60, 300, 900, 3600)
+STATUS_CALLBACK_TIMEOUT_SECONDS = 10
+# CallbackUrl, указывающие на loopback, частные, link-local (метаданные облака) и прочие не публичные адреса,
+# отклоняются (защита от SSRF); разрешить можно для тестовых стендов
+STATUS_CALLBACK_ALLOW_PRIVATE = os.environ.get('STATUS_CALLBACK_ALLOW_PRIVATE', 'false').lower() in ('1', 'true', 'yes')
+
+# Приём результатов чеков от eKomKassa (POST /api/ekomkassa/callback?key=...): при заданном секрете
+# в чек передаётся service.callback_url шлюза, а присланный результат сохраняется в receipt_statuses
+EKOMKASSA_CALLBACK_SECRET = os.environ.get('EKOMKASSA_CALLBACK_SECRET', '')
+GATEWAY_PUBLIC_URL = os.environ.get('GATEWAY_PUBLIC_URL', 'https://gw.ecomkassa.ru')
+EKOMKASSA_CALLBACK_URL = (
+    f'{GATEWAY_PUBLIC_URL}/api/ekomkassa/callback?key={EKOMKASSA_CALLBACK_SECRET}' if EKOMKASSA_CALLBACK_SECRET else ''
+)
 
-# eKomKassa URLs
-if EKOMKASSA_ENV == 'production':
-    EKOMKASSA_BASE_URL = 'https://gw.ecomkassa.ru'
-    EKOMKASSA_AUTH_URL = f'{EKOMKASSA_BASE_URL}/api/Authorization/CreateAuthToken'
-    EKOMKASSA_RECEIPT_URL_TEMPLATE = f'{EKOMKASSA_BASE_URL}/api/kkt/cloud/receipt'
-    EKOMKASSA_STATUS_URL_TEMPLATE = f'{EKOMKASSA_BASE_URL}/api/kkt/cloud/status'
-else:
-    EKOMKASSA_BASE_URL = 'https://app.ecomkassa.ru'
-    EKOMKASSA_AUTH_URL = f'{EKOMKASSA_BASE_URL}/fiscalorder/v5/getToken'
-    EKOMKASSA_RECEIPT_URL_TEMPLATE = f'{EKOMKASSA_BASE_URL}/fiscalorder/v5/{{group_code}}/{{operation}}'
-    EKOMKASSA_STATUS_URL_TEMPLATE = f'{EKOMKASSA_BASE_URL}/fiscalorder/v5/{{group_code}}/report/{{uuid}}'
+# Live tail /api/request-logs/tail (SSE): сводки новых записей рассылаются через Postgres NOTIFY
+LIVE_TAIL_ENABLED = os.environ.get('LIVE_TAIL_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+LIVE_TAIL_CHANNEL = 'request_logs_tail'
+# Подписчиков на воркер: каждый занимает поток gthread на всё время подключения
+LIVE_TAIL_MAX_CLIENTS = int(os.environ.get('LIVE_TAIL_MAX_CLIENTS', '2'))
+# Очередь событий подписчика; медленный клиент теряет события сверх неё
+LIVE_TAIL_QUEUE_SIZE = int(os.environ.get('LIVE_TAIL_QUEUE_SIZE', '500'))
+LIVE_TAIL_KEEPALIVE_SECONDS = 15
+# NOTIFY на каждую запись лога сериализуется на глобальной блокировке очереди уведомлений Postgres, поэтому
+# делается, только пока хоть на одном узле есть подписчики: слушатель отмечает их в общем хранилище,
+# пишущие воркеры проверяют отметку не чаще раза в LIVE_TAIL_PRESENCE_CHECK_SECONDS
+LIVE_TAIL_PRESENCE_TTL_SECONDS = 2 * LIVE_TAIL_KEEPALIVE_SECONDS
+LIVE_TAIL_PRESENCE_CHECK_SECONDS = 2.0
 
-logger.info(f'eKomKassa environment: {EKOMKASSA_ENV}')
-logger.info(f'eKomKassa auth URL: {EKOMKASSA_AUTH_URL}')
+# HTML просмотр /request-logs: строк на странице и длина превью тел (обрезаются в SQL)
+VIEW_PAGE_SIZE_DEFAULT = 100
+VIEW_PAGE_SIZE_MAX = 500
+VIEW_PREVIEW_CHARS = int(os.environ.get('VIEW_PREVIEW_CHARS', '300'))
 
 # Admin credentials
 ADMIN_LOGIN = 'admin'
 ADMIN_PASSWORD = 'GatewayEcomkassa'
 
-def convert_ekomkassa_datetime(dt_str: str) -> str:
-    '''Convert eKomKassa datetime to ISO 8601 with timezone'''
-    try:
-        dt = datetime.strptime(dt_str, '%d.%m.%Y %H:%M:%S')
-        return dt.strftime('%Y-%m-%dT%H:%M:%S.000+03:00[Europe/Moscow]')
-    except Exception as e:
-        logger.error(f"Failed to convert datetime '{dt_str}': {e}")
-        return dt_str
+# Границы корзин гистограммы задержек (мс) для rollup-таблиц статистики.
+# Последняя корзина в БД — всё, что больше последней границы.
+# При изменении границ нужно пересоздать request_metrics_* (см. migrations/003_metrics_rollups.sql)
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
 
-def create_ferma_response(status: str, data: Optional[Dict] = None, error: Optional[Dict] = None) -> OrderedDict:
-    '''Helper function to create Ferma-compatible response with guaranteed field order'''
-    response = OrderedDict()
-    response['Status'] = status
-    if data is not None:
-        response['Data'] = data
-    if error is not None:
-        response['Error'] = error
-    return response
+# Окна больше этого значения считаются по почасовым срезам вместо поминутных
+STATS_MINUTE_RANGE_LIMIT = timedelta(hours=6)
 
-def require_auth(f):
-    '''Decorator for routes that require authentication'''
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not session.get('authenticated'):
-            return jsonify({'error': 'Unauthorized', 'message': 'Authentication required'}), 401
-        return f(*args, **kwargs)
-    return decorated_function
+# Предустановленные окна статистики для /api/stats?window=...
+STATS_WINDOWS = {
+    '5m': timedelta(minutes=5),
+    '1h': timedelta(hours=1),
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7)
+}
+STATS_DEFAULT_WINDOW = '24h'
 
-def log_request_to_db(
-    method: str,
-    url: str,
-    path: str,
-    source_ip: str,
-    user_agent: str,
-    request_headers: Dict,
-    request_body: Any,
-    target_url: Optional[str] = None,
-    target_method: Optional[str] = None,
-    target_headers: Optional[Dict] = None,
-    target_body: Any = None,
-    response_status: Optional[int] = None,
-    response_headers: Optional[Dict] = None,
-    response_body: Any = None,
-    client_response_status: Optional[int] = None,
-    client_response_body: Any = None,
-    duration_ms: Optional[int] = None,
-    error_message: Optional[str] = None,
-    request_id: Optional[str] = None
-) -> None:
-    '''Полное логирование запроса в БД'''
+# Время жизни кэша статистики: много вкладок админки не должны нагружать Postgres
+STATS_CACHE_TTL_SECONDS = float(os.environ.get('STATS_CACHE_TTL_SECONDS', '15'))
+# Сколько запрос статистики ждёт расчёта того же окна на другом воркере или узле, прежде чем считать сам
+STATS_CACHE_LOCK_WAIT_SECONDS = 5.0
+
+# Общее состояние узлов шлюза (кэш статистики, лимиты запросов), чтобы при нескольких узлах
+# за балансировщиком кэши и квоты не делились между ними:
+#   postgres - UNLOGGED таблицы и advisory locks (миграции 008 и 011)
+#   redis    - Redis-совместимый сервер SHARED_STATE_REDIS_URL (requirements-redis.txt)
+SHARED_STATE_BACKEND = os.environ.get('SHARED_STATE_BACKEND', 'postgres')
+SHARED_STATE_REDIS_URL = os.environ.get('SHARED_STATE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+SHARED_STATE_REDIS_PREFIX = 'ekomkassa-gateway:'
+
+
+# ============================================
+# METRICS (PROMETHEUS)
+# ============================================
+LATENCY_BUCKETS_SECONDS = tuple(bound / 1000 for bound in LATENCY_BUCKETS_MS)
+
+REQUEST_DURATION = Histogram(
+    'gateway_request_duration_seconds', 'Полное время обработки запроса шлюзом',
+    ['endpoint', 'method', 'status_class'], buckets=LATENCY_BUCKETS_SECONDS
+)
+UPSTREAM_DURATION = Histogram(
+    'gateway_upstream_duration_seconds', 'Время запроса к eKomKassa',
+    ['operation'], buckets=LATENCY_BUCKETS_SECONDS
+)
+CONVERSION_DURATION = Histogram(
+    'gateway_conversion_duration_seconds', 'Время конвертации между форматами Ferma и eKomKassa',
+    ['operation'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+)
+LOG_WRITE_DURATION = Histogram(
+    'gateway_log_write_duration_seconds', 'Время записи лога в БД',
+    ['table'], buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+UPSTREAM_RESPONSES = Counter(
+    'gateway_upstream_responses_total', 'Ответы eKomKassa по HTTP статусам (error - нет ответа)',
+    ['operation', 'status_code']
+)
+FERMA_ERRORS = Counter(
+    'gateway_ferma_errors_total', 'Ответы клиентам в формате Ferma со Status=Failed по коду ошибки',
+    ['endpoint', 'code']
+)
+CACHE_REQUESTS = Counter(
+    'gateway_cache_requests_total', 'Обращения к кэшам шлюза',
+    ['cache', 'result']
+)
+SHARED_STATE_ERRORS = Counter(
+    'gateway_shared_state_errors_total', 'Ошибки общего хранилища состояния (операция выполнена без него)',
+    ['backend', 'operation']
+)
+DB_POOL_CONNECTIONS = Gauge(
+    'gateway_db_pool_connections', 'Соединения пула БД (in_use - выданы, max - лимит)',
+    ['state'], multiprocess_mode='livesum'
+)
+DB_POOL_EXHAUSTED = Counter(
+    'gateway_db_pool_exhausted_total', 'Отказы выдачи соединения из-за исчерпания пула'
+)
+CIRCUIT_STATE = Gauge(
+    'gateway_circuit_state', 'Состояние circuit breaker eKomKassa (0 - closed, 1 - half_open, 2 - open), худшее по воркерам',
+    ['operation'], multiprocess_mode='livemax'
+)
+CIRCUIT_REJECTED = Counter(
+    'gateway_circuit_rejected_total', 'Запросы, отклонённые без обращения к eKomKassa из-за открытого circuit breaker',
+    ['operation']
+)
+CIRCUIT_TRANSITIONS = Counter(
+    'gateway_circuit_transitions_total', 'Переходы circuit breaker между состояниями',
+    ['operation', 'state']
+)
+BULKHEAD_LIMIT = Gauge(
+    'gateway_bulkhead_limit', 'Текущий лимит одновременных запросов класса endpoint (сумма по воркерам)',
+    ['endpoint_class'], multiprocess_mode='livesum'
+)
+BULKHEAD_IN_FLIGHT = Gauge(
+    'gateway_bulkhead_in_flight', 'Выполняющиеся запросы класса endpoint (сумма по воркерам)',
+    ['endpoint_class'], multiprocess_mode='livesum'
+)
+BULKHEAD_REJECTED = Counter(
+    'gateway_bulkhead_rejected_total', 'Запросы, отклонённые bulkhead (class - лимит класса, client - лимит клиента)',
+    ['endpoint_class', 'reason']
+)
+DEADLINE_EXCEEDED = Counter(
+    'gateway_deadline_exceeded_total', 'Работа, пропущенная из-за истёкшего бюджета запроса (upstream, retry, log)',
+    ['stage']
+)
+UPSTREAM_ENDPOINT_REQUESTS = Counter(
+    'gateway_upstream_endpoint_requests_total', 'Запросы к адресам пулов eKomKassa (ok / error - нет ответа или 5xx)',
+    ['pool', 'endpoint', 'outcome']
+)
+UPSTREAM_ENDPOINT_AVAILABILITY = Gauge(
+    'gateway_upstream_endpoint_availability', 'Доступность адреса пула eKomKassa по активным проверкам (0..1), худшая по воркерам',
+    ['pool', 'endpoint'], multiprocess_mode='livemin'
+)
+UPSTREAM_PROBE_LATENCY = Gauge(
+    'gateway_upstream_probe_latency_seconds', 'EWMA задержки проверок адреса eKomKassa (target: connect / auth / fiscalorder)',
+    ['pool', 'endpoint', 'target'], multiprocess_mode='livemax'
+)
+UPSTREAM_RETRIES = Counter(
+    'gateway_upstream_retries_total', 'Повторные запросы к eKomKassa (error - нет ответа, status - 502/503/504)',
+    ['operation', 'reason']
+)
+UPSTREAM_RETRY_BUDGET_EXHAUSTED = Counter(
+    'gateway_upstream_retry_budget_exhausted_total', 'Повторы и hedging, не выполненные из-за исчерпанного бюджета',
+    ['operation']
+)
+UPSTREAM_HEDGED = Counter(
+    'gateway_upstream_hedged_total', 'Hedged запросы к eKomKassa (winner - чей ответ использован)',
+    ['operation', 'winner']
+)
+STATUS_POLLS = Counter(
+    'gateway_status_polls_total', 'Опросы статусов чеков шлюзом (done/fail - финальный статус, wait, error, expired)',
+    ['outcome']
+)
+STATUS_CALLBACKS = Counter(
+    'gateway_status_callbacks_total', 'Доставка статусов на CallbackUrl (delivered, retry, failed)',
+    ['outcome']
+)
+EKOMKASSA_CALLBACKS = Counter(
+    'gateway_ekomkassa_callbacks_total', 'Результаты чеков, присланные eKomKassa (stored, duplicate, ignored, rejected)',
+    ['outcome']
+)
+RATE_LIMITED = Counter(
+    'gateway_rate_limited_total', 'Запросы сверх квоты (delayed - дождались токена, rejected - отклонены)',
+    ['endpoint_class', 'outcome']
+)
+LIVE_TAIL_CLIENTS = Gauge(
+    'gateway_live_tail_clients', 'Подключённые клиенты live tail (SSE)',
+    multiprocess_mode='livesum'
+)
+LIVE_TAIL_DROPPED = Counter(
+    'gateway_live_tail_dropped_total', 'События live tail, отброшенные из-за переполненной очереди клиента'
+)
+
+
+
+# ============================================
+# REQUEST PHASE TIMINGS
+# ============================================
+# Фазы обработки запроса: колонки phase_*_ms в request_logs и метрики заголовка Server-Timing
+REQUEST_PHASES = ('parse', 'convert', 'upstream_connect', 'upstream_ttfb', 'upstream', 'serialize', 'log')
+
+
+def record_phase(name: str, duration_ms: float) -> None:
+    '''Добавить время фазы к текущему запросу (вне контекста запроса ничего не делает)'''
+    if has_request_context():
+        timings = g.setdefault('phase_timings', {})
+        timings[name] = timings.get(name, 0.0) + duration_ms
+
+
+@contextmanager
+def timed_phase(name: str):
+    '''Замер фазы обработки запроса (parse/convert/serialize/...)'''
+    started = time.perf_counter()
     try:
-        if not DATABASE_URL:
-            return
-        
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
+        yield
+    finally:
+        record_phase(name, (time.perf_counter() - started) * 1000)
+
+
+def current_phase_timings() -> Dict[str, float]:
+    '''Фазы текущего запроса, накопленные к этому моменту'''
+    if not has_request_context():
+        return {}
+    return g.get('phase_timings', {})
+
+
+def record_conversion(operation: str, started: float) -> None:
+    '''Время конвертации форматов: метрика Prometheus и фаза convert запроса'''
+    elapsed = time.perf_counter() - started
+    CONVERSION_DURATION.labels(operation=operation).observe(elapsed)
+    record_phase('convert', elapsed * 1000)
+    record_span(f'convert {operation}', started)
+
+
+class TimedHTTPConnection(HTTPConnection):
+    '''HTTP соединение с замером времени установки (фаза upstream_connect)'''
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            record_phase('upstream_connect', (time.perf_counter() - started) * 1000)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    '''HTTPS соединение с замером времени установки, включая TLS handshake'''
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            record_phase('upstream_connect', (time.perf_counter() - started) * 1000)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    '''Адаптер requests, пулы которого замеряют установку соединений'''
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+
+# ============================================
+# TRACING (OPENTELEMETRY)
+# ============================================
+_tracer = None
+_tracer_pid = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    '''Трейсер процесса или None, если трассировка выключена (создаётся лениво в каждом воркере)'''
+    global _tracer, _tracer_pid
+    
+    if not OTEL_TRACING_ENABLED or not OTEL_AVAILABLE:
+        return None
+    
+    if _tracer is None or _tracer_pid != os.getpid():
+        with _tracer_lock:
+            if _tracer is None or _tracer_pid != os.getpid():
+                if OTEL_EXPORTER == 'file':
+                    exporter = ConsoleSpanExporter(
+                        out=open(OTEL_TRACES_FILE, 'a'),
+                        formatter=lambda span: span.to_json(indent=None) + '\n'
+                    )
+                else:
+                    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+                    exporter = OTLPSpanExporter()
+                
+                provider = TracerProvider(
+                    resource=Resource.create({'service.name': 'ekomkassa-gateway'}),
+                    sampler=ParentBased(TraceIdRatioBased(OTEL_SAMPLE_RATIO))
+                )
+                # Batch процессор отправляет span в фоне и отбрасывает их при переполнении очереди
+                provider.add_span_processor(BatchSpanProcessor(exporter))
+                _tracer = provider.get_tracer('ekomkassa-gateway')
+                _tracer_pid = os.getpid()
+    return _tracer
+
+
+@contextmanager
+def trace_span(name: str, client: bool = False, attributes: Optional[Dict] = None):
+    '''Дочерний span текущего запроса (no-op без OpenTelemetry)'''
+    tracer = get_tracer()
+    if tracer is None:
+        yield None
+        return
+    
+    kind = SpanKind.CLIENT if client else SpanKind.INTERNAL
+    with tracer.start_as_current_span(name, kind=kind, attributes=attributes) as span:
+        yield span
+
+
+def record_span(name: str, started: float, attributes: Optional[Dict] = None) -> None:
+    '''Span задним числом для уже завершённого участка (started - значение time.perf_counter())'''
+    tracer = get_tracer()
+    if tracer is None:
+        return
+    
+    end_ns = time.time_ns()
+    start_ns = end_ns - int((time.perf_counter() - started) * 1e9)
+    span = tracer.start_span(name, start_time=start_ns, attributes=attributes)
+    span.end(end_time=end_ns)
+
+
+# Общая HTTP-сессия: keep-alive соединения к eKomKassa вместо TLS handshake на каждый запрос
+upstream_session = requests.Session()
+upstream_session.mount('http://', TimedHTTPAdapter())
+upstream_session.mount('https://', TimedHTTPAdapter())
+
+# Потоки для hedged запросов статуса (в потоке обработчика ждётся первый ответ)
+hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+
+# ============================================
+# UPSTREAM POOLS (ROUTING)
+# ============================================
+class UpstreamEndpoint:
+    '''Базовый URL пула eKomKassa со статистикой ответов и активных проверок: EWMA задержки, доступность'''
+    
+    def __init__(self, pool_name: str, base_url: str, weight: float):
+        self.pool_name = pool_name
+        self.base_url = base_url.rstrip('/')
+        self.weight = weight
+        self.latency_ewma = None
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        self.availability = 1.0
+        # target проверки (connect / auth / fiscalorder) -> EWMA задержки в секундах
+        self.probe_latency = {}
+        self.probed_at = None
+        self.lock = threading.Lock()
+        UPSTREAM_ENDPOINT_AVAILABILITY.labels(pool=pool_name, endpoint=self.base_url).set(1.0)
+    
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until and self.availability >= UPSTREAM_PROBE_MIN_AVAILABILITY
+    
+    def expected_latency(self) -> float:
+        '''Ожидаемая задержка для least_latency: по ответам клиентам, до них - по проверкам'''
+        if self.latency_ewma is not None:
+            return self.latency_ewma
+        return max(self.probe_latency.values(), default=0.0)
+    
+    def record_probe(self, ok: bool, latencies: Dict[str, float]) -> None:
+        '''Итог проверки адреса: успешная проверка возвращает адрес в выбор досрочно'''
+        with self.lock:
+            self.availability += UPSTREAM_PROBE_AVAILABILITY_ALPHA * ((1.0 if ok else 0.0) - self.availability)
+            for target, duration in latencies.items():
+                previous = self.probe_latency.get(target)
+                self.probe_latency[target] = duration if previous is None else (
+                    previous + UPSTREAM_LATENCY_EWMA_ALPHA * (duration - previous)
+                )
+                UPSTREAM_PROBE_LATENCY.labels(
+                    pool=self.pool_name, endpoint=self.base_url, target=target
+                ).set(self.probe_latency[target])
+            if ok:
+                self.consecutive_failures = 0
+                self.down_until = 0.0
+            self.probed_at = datetime.now()
+        UPSTREAM_ENDPOINT_AVAILABILITY.labels(pool=self.pool_name, endpoint=self.base_url).set(self.availability)
+    
+    def record(self, failed: bool, duration: float) -> None:
+        UPSTREAM_ENDPOINT_REQUESTS.labels(
+            pool=self.pool_name, endpoint=self.base_url, outcome='error' if failed else 'ok'
+        ).inc()
+        with self.lock:
+            if failed:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= UPSTREAM_ENDPOINT_MAX_FAILURES:
+                    self.down_until = time.monotonic() + UPSTREAM_ENDPOINT_COOLDOWN_SECONDS
+                return
+            self.consecutive_failures = 0
+            self.down_until = 0.0
+            if self.latency_ewma is None:
+                self.latency_ewma = duration
+            else:
+                self.latency_ewma += UPSTREAM_LATENCY_EWMA_ALPHA * (duration - self.latency_ewma)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'url': self.base_url,
+                'weight': self.weight,
+                'available': self.available(),
+                'latency_ewma_ms': round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+                'consecutive_failures': self.consecutive_failures,
+                'availability': round(self.availability, 3),
+                'probe_latency_ms': {
+                    target: round(duration * 1000, 1) for target, duration in self.probe_latency.items()
+                },
+                'probed_at': self.probed_at.isoformat() if self.probed_at else None
+            }
+
+
+class UpstreamPool:
+    '''Именованный пул eKomKassa: свои адреса, стратегия выбора, таймауты и пул соединений'''
+    
+    def __init__(self, name: str, config: Dict[str, Any]):
+        self.name = name
+        urls = config['urls']
+        weights = config.get('weights') or [1] * len(urls)
+        self.endpoints = [UpstreamEndpoint(name, url, float(weight)) for url, weight in zip(urls, weights)]
+        self.strategy = config.get('strategy', 'weighted')
+        self.timeouts = {**UPSTREAM_DEFAULT_TIMEOUTS, **config.get('timeouts', {})}
         
-        cur.execute(
-            """
-            INSERT INTO request_logs (
-                method, url, path, source_ip, user_agent,
-                request_headers, request_body,
-                target_url, target_method, target_headers, target_body,
-                response_status, response_headers, response_body,
-                client_response_status, client_response_body,
-                duration_ms, error_message, request_id
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """,
-            (
-                method, url, path, source_ip, user_agent,
-                json.dumps(request_headers) if request_headers else None,
-                json.dumps(request_body) if request_body else None,
-                target_url, target_method,
-                json.dumps(target_headers) if target_headers else None,
-                json.dumps(target_body) if target_body else None,
-                response_status,
-                json.dumps(response_headers) if response_headers else None,
-                json.dumps(response_body) if response_body else None,
-                client_response_status,
-                json.dumps(client_response_body) if client_response_body else None,
-                duration_ms, error_message, request_id
-            )
+        adapter = TimedHTTPAdapter(pool_maxsize=int(config.get('max_connections', 10)))
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def choose(self, exclude: tuple = ()) -> UpstreamEndpoint:
+        '''Адрес для очередной попытки: среди доступных и ещё не пробованных в этом запросе'''
+        candidates = (
+            [endpoint for endpoint in self.endpoints if endpoint not in exclude and endpoint.available()]
+            or [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            or self.endpoints
         )
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Failed to write request log to DB: {str(e)}")
+        if self.strategy == 'least_latency':
+            # Адрес без замеров пробуется первым
+            return min(candidates, key=lambda endpoint: endpoint.expected_latency())
+        # Вес снижается вместе с доступностью по проверкам (не ниже минимального, чтобы адрес не выпал совсем)
+        return random.choices(
+            candidates, weights=[endpoint.weight * max(endpoint.availability, 0.01) for endpoint in candidates]
+        )[0]
+    
+    def url(self, path: str) -> str:
+        '''Полный URL на основном адресе пула (для логов до ответа)'''
+        return self.endpoints[0].base_url + path
+
+
+UPSTREAM_POOLS = {name: UpstreamPool(name, config) for name, config in UPSTREAM_POOLS_CONFIG.items()}
 
 
-def log_to_db(function_name: str, log_level: str, message: str, 
-              request_data: Optional[Dict] = None, response_data: Optional[Dict] = None,
-              request_id: Optional[str] = None, duration_ms: Optional[int] = None,
-              status_code: Optional[int] = None) -> None:
-    '''Старая функция логирования для обратной совместимости'''
+UPSTREAM_LOGIN_ROUTES = any(key.startswith('login:') for key in UPSTREAM_ROUTES)
+
+
+def upstream_pool_for(group_code: Optional[str] = None, login: Optional[str] = None,
+                      auth_token: Optional[str] = None) -> UpstreamPool:
+    '''
+    Пул арендатора по UPSTREAM_ROUTES: сначала логин (при авторизации - напрямую, далее - по пулу,
+    запомненному за токеном), затем группа касс
+    '''
+    if auth_token and UPSTREAM_LOGIN_ROUTES:
+        try:
+            pool_name = shared_state.get(f'pool:{token_fingerprint(auth_token)}')
+        except SharedStateError as e:
+            logger.warning(f"[UPSTREAM] Token pool lookup failed, routing by group: {str(e)}")
+            pool_name = None
+        if pool_name in UPSTREAM_POOLS:
+            return UPSTREAM_POOLS[pool_name]
+    for key in (f'login:{login}' if login else None, f'group:{group_code}' if group_code else None):
+        if key in UPSTREAM_ROUTES:
+            return UPSTREAM_POOLS[UPSTREAM_ROUTES[key]]
+    return UPSTREAM_POOLS[UPSTREAM_DEFAULT_POOL]
+
+
+def remember_token_pool(auth_token: str, login: str, pool: UpstreamPool) -> None:
+    '''Запоминает пул, выбранный по логину, за выданным токеном (без маршрута по логину - не нужно)'''
+    if f'login:{login}' not in UPSTREAM_ROUTES:
+        return
     try:
-        if not DATABASE_URL:
-            logger.warning("DATABASE_URL not set, skipping DB logging")
-            return
-        
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        cur.execute(
-            "INSERT INTO logs (function_name, log_level, message, request_data, response_data, request_id, duration_ms, status_code) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-            (
-                function_name,
-                log_level,
-                message,
-                json.dumps(request_data) if request_data else None,
-                json.dumps(response_data) if response_data else None,
-                request_id,
-                duration_ms,
-                status_code
-            )
-        )
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Failed to write log to DB: {str(e)}")
+        shared_state.set(f'pool:{token_fingerprint(auth_token)}', pool.name, UPSTREAM_TOKEN_POOL_TTL_SECONDS)
+    except SharedStateError as e:
+        logger.warning(f"[UPSTREAM] Failed to remember pool for login {login}: {str(e)}")
 
 
-def proxy_and_log(target_url: str, target_method: str = None) -> tuple:
+# ============================================
+# DB CONNECTION POOL
+# ============================================
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+# Выданные соединения пула воркера (для проверки готовности)
+db_connections_in_use = 0
+
+
+def get_db_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    '''Пул соединений процесса (создаётся лениво, чтобы каждый воркер после fork имел свой)'''
+    global _db_pool, _db_pool_pid
+    
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != os.getpid():
+                _db_pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS, DATABASE_URL,
+                    connect_timeout=DB_CONNECT_TIMEOUT_SECONDS
+                )
+                _db_pool_pid = os.getpid()
+                DB_POOL_CONNECTIONS.labels(state='max').set(DB_POOL_MAX_CONNECTIONS)
+    return _db_pool
+
+
+@contextmanager
+def db_connection():
+    '''Соединение из пула. Незавершённая транзакция откатывается, разорванное соединение закрывается'''
+    db_pool = get_db_pool()
+    try:
+        conn = db_pool.getconn()
+    except psycopg2.pool.PoolError:
+        DB_POOL_EXHAUSTED.inc()
+        raise
+    
+    global db_connections_in_use
+    DB_POOL_CONNECTIONS.labels(state='in_use').inc()
+    with _db_pool_lock:
+        db_connections_in_use += 1
+    try:
+        yield conn
+    finally:
+        DB_POOL_CONNECTIONS.labels(state='in_use').dec()
+        with _db_pool_lock:
+            db_connections_in_use -= 1
+        discard = bool(conn.closed)
+        if not discard and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        db_pool.putconn(conn, close=discard)
+
+
+def iter_cursor_batches(query: str, params: list, batch_rows: int, cursor_name: str):
     '''
-    Универсальная функция для проксирования запроса с полным логированием
-    Возвращает (response_json, status_code)
+    Строки запроса батчами через именованный (server-side) курсор: в памяти только один батч
+    Соединение из пула занято, пока генератор не исчерпан или не закрыт
     '''
-    start_time = time.time()
-    request_id = request.headers.get('X-Request-ID', f'req_{int(time.time() * 1000)}')
+    with db_connection() as conn:
+        cur = conn.cursor(name=cursor_name)
+        cur.itersize = batch_rows
+        try:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(batch_rows)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cur.close()
+            conn.rollback()
+
+
+def resolve_time_range(cur, range_from: Optional[datetime], range_to: Optional[datetime], length: timedelta) -> tuple:
+    '''
+    Границы периода по часам БД: created_at и срезы - CURRENT_TIMESTAMP в TIMESTAMP (локальное время сессии).
+    Без to - текущее время БД, без from - to минус length; время со смещением приводится к поясу сессии
+    '''
+    cur.execute(
+        '''
+        SELECT COALESCE(%s::timestamp, range_to - %s), range_to
+        FROM (SELECT COALESCE(%s::timestamp, LOCALTIMESTAMP) AS range_to) bounds
+        ''',
+        (range_from, length, range_to)
+    )
+    return cur.fetchone()
+
+
+# ============================================
+# SHARED STATE
+# ============================================
+class SharedStateError(Exception):
+    '''Общее хранилище недоступно: вызывающий код продолжает без него (без кэша, без лимита)'''
+
+
+class PostgresSharedState:
+    '''Общее состояние в Postgres: кэши в UNLOGGED таблице shared_state, блокировки - advisory locks'''
     
-    # Информация о входящем запросе
-    method = request.method
-    url = request.url
-    path = request.path
-    source_ip = request.headers.get('X-Real-IP', request.remote_addr)
-    user_agent = request.headers.get('User-Agent', '')
-    request_headers = dict(request.headers)
-    request_body = request.get_json(silent=True) or {}
+    name = 'postgres'
     
-    # Для проксирования используем метод запроса или переданный
-    if target_method is None:
-        target_method = method
+    @contextmanager
+    def _cursor(self, operation: str):
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    yield cur
+                conn.commit()
+        except (psycopg2.Error, psycopg2.pool.PoolError) as e:
+            SHARED_STATE_ERRORS.labels(backend=self.name, operation=operation).inc()
+            raise SharedStateError(str(e)) from e
     
-    response_status = None
-    response_headers = None
-    response_body = None
-    client_response_status = None
-    client_response_body = None
-    error_message = None
+    def get(self, key: str) -> Any:
+        with self._cursor('get') as cur:
+            cur.execute('SELECT value FROM shared_state WHERE state_key = %s AND expires_at > NOW()', (key,))
+            row = cur.fetchone()
+        return row[0] if row else None
     
-    try:
-        # Подготовка заголовков для проксирования
-        proxy_headers = {
-            'Content-Type': 'application/json',
-            'User-Agent': 'eKomKassa-Gateway/1.0'
-        }
-        
-        # Отправка запроса к целевому API
-        logger.info(f"[PROXY] {method} {path} -> {target_method} {target_url}")
-        
-        if target_method == 'GET':
-            resp = requests.get(target_url, headers=proxy_headers, params=request.args, timeout=30)
-        else:
-            resp = requests.post(target_url, headers=proxy_headers, json=request_body, timeout=30)
-        
-        response_status = resp.status_code
-        response_headers = dict(resp.headers)
-        
+    def set(self, key: str, value: Any, ttl_seconds: float) -> None:
+        with self._cursor('set') as cur:
+            cur.execute(
+                '''
+                INSERT INTO shared_state (state_key, value, expires_at)
+                VALUES (%s, %s, NOW() + %s * INTERVAL '1 second')
+                ON CONFLICT (state_key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+                ''',
+                (key, json.dumps(value, ensure_ascii=False), ttl_seconds)
+            )
+            # Протухшие ключи (произвольные from/to статистики) не должны копиться
+            if random.random() < 0.01:
+                cur.execute('DELETE FROM shared_state WHERE expires_at <= NOW()')
+    
+    def take_tokens(self, buckets: list) -> float:
+        '''
+        Берёт по токену из всех bucket'ов (ключ, запросов_в_секунду, размер) или ни из одного:
+        0 - разрешено, иначе секунд до появления токена в самом пустом bucket
+        '''
+        keys, rates, bursts = zip(*buckets)
+        with self._cursor('take_tokens') as cur:
+            cur.execute(
+                'SELECT rate_limit_take_all(%s::varchar[], %s::float8[], %s::float8[])',
+                (list(keys), list(rates), list(bursts))
+            )
+            return cur.fetchone()[0]
+    
+    @contextmanager
+    def lock(self, key: str, wait_seconds: float):
+        '''
+        Блокировка ключа между воркерами и узлами на время блока: даёт True, если получена за wait_seconds.
+        Строка-аренда в shared_state (как SET NX PX в Redis): соединение пула берётся только на попытку,
+        ни ожидание, ни сам блок его не держат
+        '''
+        lock_key = 'lock:' + key
+        token = json.dumps(os.urandom(16).hex())
+        deadline = time.monotonic() + wait_seconds
+        acquired = self._try_lock(lock_key, token)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(0.05)
+            acquired = self._try_lock(lock_key, token)
         try:
-            response_body = resp.json()
-        except:
-            response_body = {'raw': resp.text}
-        
-        # Формируем ответ клиенту
-        client_response_status = response_status
-        client_response_body = response_body
-        
-        duration_ms = int((time.time() - start_time) * 1000)
-        
-        # Логируем всё в БД
-        log_request_to_db(
-            method=method, url=url, path=path,
-            source_ip=source_ip, user_agent=user_agent,
-            request_headers=request_headers, request_body=request_body,
-            target_url=target_url, target_method=target_method,
-            target_headers=proxy_headers, target_body=request_body,
-            response_status=response_status,
-            response_headers=response_headers,
-            response_body=response_body,
-            client_response_status=client_response_status,
-            client_response_body=client_response_body,
-            duration_ms=duration_ms,
-            request_id=request_id
-        )
-        
-        return client_response_body, client_response_status
-        
-    except requests.exceptions.RequestException as e:
-        error_message = str(e)
-        client_response_status = 502
-        client_response_body = {'error': 'Gateway error', 'message': error_message}
-        duration_ms = int((time.time() - start_time) * 1000)
-        
-        logger.error(f"[PROXY] Error: {error_message}")
-        
-        # Логируем ошибку
-        log_request_to_db(
-            method=method, url=url, path=path,
-            source_ip=source_ip, user_agent=user_agent,
-            request_headers=request_headers, request_body=request_body,
-            target_url=target_url, target_method=target_method,
-            target_headers=proxy_headers, target_body=request_body,
-            client_response_status=client_response_status,
-            client_response_body=client_response_body,
-            duration_ms=duration_ms,
-            error_message=error_message,
-            request_id=request_id
-        )
-        
-        return client_response_body, client_response_status
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    with self._cursor('unlock') as cur:
+                        cur.execute('DELETE FROM shared_state WHERE state_key = %s AND value::text = %s', (lock_key, token))
+                except SharedStateError as e:
+                    logger.warning(f"[SHARED STATE] Failed to release lock {key}: {str(e)}")
+    
+    def _try_lock(self, lock_key: str, token: str) -> bool:
+        # Истекает сама, если воркер погиб, не сняв её
+        with self._cursor('lock') as cur:
+            cur.execute(
+                '''
+                INSERT INTO shared_state (state_key, value, expires_at)
+                VALUES (%s, %s, NOW() + %s * INTERVAL '1 second')
+                ON CONFLICT (state_key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+                WHERE shared_state.expires_at <= NOW()
+                RETURNING 1
+                ''',
+                (lock_key, token, REQUEST_DEADLINE_SECONDS)
+            )
+            return cur.fetchone() is not None
 
 
-# ============================================
-# AUTH ENDPOINT
-# ============================================
-@app.route('/api/Authorization/CreateAuthToken', methods=['POST', 'OPTIONS'])
-def auth_handler():
+class RedisSharedState:
+    '''Общее состояние в Redis-совместимом сервере: ключи с TTL, token bucket'ы и блокировки - Lua скриптами'''
+    
+    name = 'redis'
+    
+    # Bucket'ы запроса: пополнение по времени сервера Redis (часы узлов шлюза могут расходиться),
+    # списание из всех или ни из одного (как rate_limit_take_all в Postgres). ARGV: rate1, burst1, rate2, ...
+    TAKE_TOKENS_SCRIPT = '''
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local tokens, wait = {}, 0
+        for i, key in ipairs(KEYS) do
+            local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+            local bucket = redis.call('HMGET', key, 'tokens', 'updated_at')
+            local current = tonumber(bucket[1]) or burst
+            local updated_at = tonumber(bucket[2]) or now
+            tokens[i] = math.min(burst, current + math.max(now - updated_at, 0) * rate)
+            if tokens[i] < 1 then
+                wait = math.max(wait, (1 - tokens[i]) / rate)
+            end
+        end
+        for i, key in ipairs(KEYS) do
+            local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+            if wait == 0 then
+                tokens[i] = tokens[i] - 1
+            end
+            redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'updated_at', tostring(now))
+            redis.call('EXPIRE', key, math.ceil(burst / rate) + 60)
+        end
+        return tostring(wait)
     '''
-    Ferma-совместимый API для получения токена авторизации
-    Ferma URL: POST https://ferma.ofd.ru/api/Authorization/CreateAuthToken
-    Target: https://app.ecomkassa.ru/fiscalorder/v5/getToken
+    RELEASE_LOCK_SCRIPT = '''
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
     '''
-    start_time = time.time()
-    request_id = request.headers.get('X-Request-ID', str(time.time()))
     
-    if request.method == 'OPTIONS':
-        response = jsonify({})
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        response.headers['Access-Control-Max-Age'] = '86400'
-        return response, 200
+    def __init__(self, url: str):
+        # Пул соединений redis-py сам пересоздаётся после fork воркера
+        self.client = redis.Redis.from_url(url, socket_timeout=1.0, socket_connect_timeout=1.0)
+        self.take_tokens_script = self.client.register_script(self.TAKE_TOKENS_SCRIPT)
+        self.release_lock = self.client.register_script(self.RELEASE_LOCK_SCRIPT)
     
-    body_data = request.get_json(silent=True) or {}
-    # Ferma формат использует Login и Password с заглавной буквы
-    login = body_data.get('Login') or body_data.get('login')
-    password = body_data.get('Password') or body_data.get('password')
+    @contextmanager
+    def _errors(self, operation: str):
+        try:
+            yield
+        except redis.RedisError as e:
+            SHARED_STATE_ERRORS.labels(backend=self.name, operation=operation).inc()
+            raise SharedStateError(str(e)) from e
     
-    logger.info(f"[AUTH] Incoming request: Login={login}, Password={'***' if password else None}")
-    log_to_db('auth', 'INFO', 'Incoming auth request', 
-              request_data={'Login': login, 'has_password': bool(password)}, 
-              request_id=request_id)
+    def get(self, key: str) -> Any:
+        with self._errors('get'):
+            value = self.client.get(SHARED_STATE_REDIS_PREFIX + key)
+        return json.loads(value) if value is not None else None
     
-    if not login or not password:
-        ferma_error = {
-            'Status': 'Failed',
-            'Error': {
-                'Code': 400,
-                'Message': 'Login и Password обязательны'
-            }
-        }
-        flask_response = jsonify(ferma_error)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, 400
+    def set(self, key: str, value: Any, ttl_seconds: float) -> None:
+        with self._errors('set'):
+            self.client.set(
+                SHARED_STATE_REDIS_PREFIX + key, json.dumps(value, ensure_ascii=False),
+                px=max(1, int(ttl_seconds * 1000))
+            )
     
-    try:
-        request_payload = {'login': login, 'pass': password}
-        logger.info(f"[AUTH] Request to eKomKassa: {json.dumps({'login': login, 'pass': '***'})}")
-        
-        response = requests.post(
-            EKOMKASSA_AUTH_URL,
-            json=request_payload,
-            headers={'Content-Type': 'application/json'},
-            timeout=10
-        )
-        
-        duration_ms = int((time.time() - start_time) * 1000)
-        logger.info(f"[AUTH] Response from eKomKassa: status={response.status_code}, body={response.text}")
-        
+    def take_tokens(self, buckets: list) -> float:
+        '''
+        Берёт по токену из всех bucket'ов (ключ, запросов_в_секунду, размер) или ни из одного:
+        0 - разрешено, иначе секунд до появления токена в самом пустом bucket
+        '''
+        with self._errors('take_tokens'):
+            return float(self.take_tokens_script(
+                keys=[SHARED_STATE_REDIS_PREFIX + 'bucket:' + key for key, _, _ in buckets],
+                args=[value for _, rate, burst in buckets for value in (rate, burst)]
+            ))
+    
+    @contextmanager
+    def lock(self, key: str, wait_seconds: float):
+        '''Блокировка ключа между воркерами и узлами на время блока: даёт True, если получена за wait_seconds'''
+        lock_key = SHARED_STATE_REDIS_PREFIX + 'lock:' + key
+        token = os.urandom(16).hex()
+        deadline = time.monotonic() + wait_seconds
+        with self._errors('lock'):
+            # Истекает сама, если воркер погиб, не сняв её
+            acquired = bool(self.client.set(lock_key, token, nx=True, px=int(REQUEST_DEADLINE_SECONDS * 1000)))
+            while not acquired and time.monotonic() < deadline:
+                time.sleep(0.05)
+                acquired = bool(self.client.set(lock_key, token, nx=True, px=int(REQUEST_DEADLINE_SECONDS * 1000)))
         try:
-            response_json = response.json()
-        except:
-            response_json = {'raw': response.text}
-        
-        # Конвертируем в формат Атол/Ferma
-        if response.status_code == 200 and isinstance(response_json, dict) and response_json.get('token'):
-            ferma_response = create_ferma_response(
-                status='Success',
-                data={
-                    'AuthToken': response_json['token'],
-                    'ExpirationDateUtc': '2099-12-31T23:59:59'
-                }
-            )
-            client_status = 200
-        else:
-            # В случае ошибки возвращаем формат с Status Failed и Error
-            error_code = 2
-            error_message = 'Авторизация невозможна. Неверные учетные данные'
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    self.release_lock(keys=[lock_key], args=[token])
+                except redis.RedisError as e:
+                    logger.warning(f"[SHARED STATE] Failed to release lock {key}: {str(e)}")
+
+
+def create_shared_state():
+    '''Хранилище общего состояния по SHARED_STATE_BACKEND; без пакета redis - postgres'''
+    if SHARED_STATE_BACKEND == 'redis':
+        if REDIS_AVAILABLE:
+            return RedisSharedState(SHARED_STATE_REDIS_URL)
+        logger.error("[SHARED STATE] SHARED_STATE_BACKEND=redis, but redis package is not installed; using postgres")
+    return PostgresSharedState()
+
+
+shared_state = create_shared_state()
+logger.info(f'Shared state backend: {shared_state.name}')
+
+
+# ============================================
+# REQUEST DEADLINES
+# ============================================
+class DeadlineExceededError(requests.Timeout):
+    '''Бюджет времени запроса клиента исчерпан, запрос к eKomKassa не отправлялся'''
+
+
+def request_deadline_budget() -> float:
+    '''Бюджет текущего запроса (секунды): из заголовка клиента, но не больше REQUEST_DEADLINE_SECONDS'''
+    try:
+        client_budget = float(request.headers.get(REQUEST_DEADLINE_HEADER, '')) / 1000
+    except ValueError:
+        return REQUEST_DEADLINE_SECONDS
+    return min(max(client_budget, 0.0), REQUEST_DEADLINE_SECONDS)
+
+
+def remaining_request_time() -> Optional[float]:
+    '''Остаток бюджета текущего запроса (секунды); None - вне запроса (фоновые задания, CLI)'''
+    if not has_request_context() or 'request_deadline' not in g:
+        return None
+    return g.request_deadline - time.monotonic()
+
+
+def deadline_timeout(timeout: Any) -> Any:
+    '''Таймаут requests (число или (connect, read)), урезанный до остатка бюджета'''
+    remaining = remaining_request_time()
+    if remaining is None:
+        return timeout
+    if remaining < UPSTREAM_MIN_TIMEOUT_SECONDS:
+        DEADLINE_EXCEEDED.labels(stage='upstream').inc()
+        raise DeadlineExceededError('Истекло время обработки запроса, запрос не отправлялся')
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(min(part, remaining) if part is not None else remaining for part in timeout)
+    return min(timeout, remaining)
+
+
+def request_deadline_expired() -> bool:
+    remaining = remaining_request_time()
+    return remaining is not None and remaining <= 0
+
+
+# ============================================
+# CIRCUIT BREAKER
+# ============================================
+CIRCUIT_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class CircuitOpenError(requests.RequestException):
+    '''Вызов eKomKassa не выполнялся: circuit breaker открыт (обрабатывается как ошибка подключения)'''
+
+
+class CircuitBreaker:
+    '''Circuit breaker одной операции eKomKassa: скользящее окно исходов, closed -> open -> half_open'''
+    
+    def __init__(self, operation: str, slow_call_seconds: float):
+        self.operation = operation
+        self.slow_call_seconds = slow_call_seconds
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        # Поток, выполняющий пробный запрос half_open
+        self.probe_thread = None
+        # (время, ошибка, медленный) за последние CIRCUIT_WINDOW_SECONDS
+        self.calls = deque()
+        self.lock = threading.Lock()
+        CIRCUIT_STATE.labels(operation=operation).set(0)
+    
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning(f"[CIRCUIT] {self.operation}: {self.state} -> {state}")
+        self.state = state
+        CIRCUIT_STATE.labels(operation=self.operation).set(CIRCUIT_STATE_VALUES[state])
+        CIRCUIT_TRANSITIONS.labels(operation=self.operation, state=state).inc()
+    
+    def allow_request(self) -> bool:
+        '''Можно ли обращаться к eKomKassa; в half_open пропускается один пробный запрос'''
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= CIRCUIT_OPEN_SECONDS:
+                self._transition('half_open')
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                self.probe_thread = threading.get_ident()
+                return True
+            return False
+    
+    def record(self, failed: bool, duration: float) -> None:
+        '''Исход вызова: ошибка (нет ответа или 5xx) и/или медленный ответ'''
+        now = time.monotonic()
+        slow = duration >= self.slow_call_seconds
+        with self.lock:
+            if self.state == 'half_open':
+                self.probe_in_flight = False
+                if failed or slow:
+                    self.opened_at = now
+                    self._transition('open')
+                else:
+                    self.calls.clear()
+                    self._transition('closed')
+                return
             
-            if isinstance(response_json, dict):
-                if response_json.get('code') is not None:
-                    error_code = response_json['code']
-                if response_json.get('text'):
-                    error_message = response_json['text']
-                elif response_json.get('error'):
-                    error_obj = response_json['error']
-                    if isinstance(error_obj, dict):
-                        error_code = error_obj.get('code', error_code)
-                        error_message = error_obj.get('text', str(error_obj))
-                    elif isinstance(error_obj, str):
-                        error_message = error_obj
+            self.calls.append((now, failed, slow))
+            while self.calls and now - self.calls[0][0] > CIRCUIT_WINDOW_SECONDS:
+                self.calls.popleft()
             
-            ferma_response = create_ferma_response(
-                status='Failed',
-                error={
-                    'Code': error_code,
-                    'Message': error_message
-                }
-            )
-            client_status = 401
-        
-        log_to_db('auth', 'INFO', 'eKomKassa response received',
-                  request_data={'login': login},
-                  response_data={'ferma_format': ferma_response, 'ekomkassa_raw': response_json},
-                  request_id=request_id,
-                  duration_ms=duration_ms,
-                  status_code=response.status_code)
-        
-        # Логируем в request_logs
-        log_request_to_db(
-            method=request.method,
-            url=request.url,
-            path=request.path,
-            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
-            user_agent=request.headers.get('User-Agent', ''),
-            request_headers=dict(request.headers),
-            request_body=body_data,
-            target_url=EKOMKASSA_AUTH_URL,
-            target_method='POST',
-            target_headers={'Content-Type': 'application/json'},
-            target_body=request_payload,
-            response_status=response.status_code,
-            response_headers=dict(response.headers),
-            response_body=response_json,
-            client_response_status=client_status,
-            client_response_body=ferma_response,
-            duration_ms=duration_ms,
-            request_id=request_id
-        )
-        
-        flask_response = jsonify(ferma_response)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, client_status
-        
-    except requests.RequestException as e:
-        duration_ms = int((time.time() - start_time) * 1000)
-        error_msg = str(e)
-        logger.error(f"[AUTH] eKomKassa API error: {error_msg}")
-        
-        ferma_error_response = {
-            'Status': 'Failed',
-            'Error': {
-                'Code': 500,
-                'Message': f'Ошибка подключения к сервису кассы: {error_msg}'
+            if self.state == 'closed' and len(self.calls) >= CIRCUIT_MIN_CALLS:
+                error_rate = sum(1 for call in self.calls if call[1]) / len(self.calls)
+                slow_rate = sum(1 for call in self.calls if call[2]) / len(self.calls)
+                if error_rate >= CIRCUIT_ERROR_RATE or slow_rate >= CIRCUIT_SLOW_RATE:
+                    self.opened_at = now
+                    self.calls.clear()
+                    self._transition('open')
+    
+    def release_probe(self) -> None:
+        '''Пробный запрос этого потока завершился без исхода (исключение не из requests): пробу можно повторить'''
+        with self.lock:
+            if self.probe_in_flight and self.probe_thread == threading.get_ident():
+                self.probe_in_flight = False
+    
+    def record_probe(self, healthy: bool) -> None:
+        '''
+        Итог активной проверки eKomKassa: при недоступности всех адресов breaker размыкается, не дожидаясь
+        CIRCUIT_MIN_CALLS, но только если за окно уже были ошибки вызовов самой операции (проверки ходят
+        GET-запросами и не проходят путь чеков). После восстановления сразу пропускается пробный запрос
+        '''
+        now = time.monotonic()
+        with self.lock:
+            while self.calls and now - self.calls[0][0] > CIRCUIT_WINDOW_SECONDS:
+                self.calls.popleft()
+            failed_calls = any(call[1] for call in self.calls)
+            if not healthy and failed_calls and self.state == 'closed':
+                self.opened_at = now
+                self.calls.clear()
+                self._transition('open')
+            elif healthy and self.state == 'open':
+                self._transition('half_open')
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'state': self.state,
+                'window_calls': len(self.calls),
+                'window_errors': sum(1 for call in self.calls if call[1]),
+                'open_for_seconds': round(time.monotonic() - self.opened_at, 1) if self.state != 'closed' else None
             }
-        }
-        
-        log_to_db('auth', 'ERROR', f'eKomKassa API error: {error_msg}',
-                  request_data={'login': login},
-                  request_id=request_id,
-                  duration_ms=duration_ms,
-                  status_code=500)
-        
-        # Логируем ошибку в request_logs
-        log_request_to_db(
-            method=request.method,
-            url=request.url,
-            path=request.path,
-            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
-            user_agent=request.headers.get('User-Agent', ''),
-            request_headers=dict(request.headers),
-            request_body=body_data,
-            target_url=EKOMKASSA_AUTH_URL,
-            target_method='POST',
-            client_response_status=500,
-            client_response_body=ferma_error_response,
-            duration_ms=duration_ms,
-            error_message=error_msg,
-            request_id=request_id
-        )
-        
-        flask_response = jsonify(ferma_error_response)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, 500
+
+
+CIRCUIT_BREAKERS = {
+    operation: CircuitBreaker(operation, slow_call_seconds)
+    for operation, slow_call_seconds in CIRCUIT_SLOW_CALL_SECONDS.items()
+} if CIRCUIT_BREAKER_ENABLED else {}
 
 
 # ============================================
-# STATUS ENDPOINT
+# UPSTREAM HEALTH PROBES
 # ============================================
-@app.route('/api/kkt/cloud/status', methods=['GET', 'POST', 'OPTIONS'])
-def status_handler():
-    '''
-    Ferma-совместимый API для получения статуса чека
-    Ferma URL: GET https://ferma.ofd.ru/api/kkt/cloud/status?uuid={uuid}&AuthToken={token}
-    Target: https://app.ecomkassa.ru/fiscalorder/v5/{group_code}/report/{uuid}
+_upstream_prober_pid = None
+_upstream_prober_lock = threading.Lock()
+
+
+def ensure_upstream_prober() -> None:
+    '''Запуск активной проверки адресов eKomKassa в текущем воркере (после fork у каждого свой поток)'''
+    global _upstream_prober_pid
+    
+    if not UPSTREAM_PROBE_ENABLED or _upstream_prober_pid == os.getpid():
+        return
+    with _upstream_prober_lock:
+        if _upstream_prober_pid != os.getpid():
+            threading.Thread(target=upstream_prober, name='upstream-prober', daemon=True).start()
+            _upstream_prober_pid = os.getpid()
+
+
+def probe_endpoint(pool: UpstreamPool, endpoint: UpstreamEndpoint) -> bool:
     '''
-    start_time = time.time()
-    request_id = request.headers.get('X-Request-ID', str(time.time()))
+    Проверка адреса: время TCP соединения и ответ на GET к API авторизации и fiscalorder.
+    Адрес исправен, если на все запросы пришёл ответ не 5xx (405/404 на GET без параметров - норма)
+    '''
+    parsed = urlparse(endpoint.base_url)
+    latencies = {}
+    ok = True
     
-    if request.method == 'OPTIONS':
-        response = jsonify({})
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        response.headers['Access-Control-Max-Age'] = '86400'
-        return response, 200
+    started = time.perf_counter()
+    try:
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        socket.create_connection((parsed.hostname, port), timeout=UPSTREAM_PROBE_TIMEOUT_SECONDS).close()
+        latencies['connect'] = time.perf_counter() - started
+    except OSError as e:
+        logger.warning(f"[PROBE] {endpoint.base_url}: connect failed: {str(e)}")
+        endpoint.record_probe(False, latencies)
+        return False
     
-    # Читаем body (если есть)
-    body_data = request.get_json(silent=True) or {}
-    request_data = body_data.get('Request', {})
+    for target, path in UPSTREAM_PROBE_PATHS.items():
+        started = time.perf_counter()
+        try:
+            response = pool.session.get(endpoint.base_url + path, timeout=UPSTREAM_PROBE_TIMEOUT_SECONDS)
+            response.close()
+            latencies[target] = time.perf_counter() - started
+            if response.status_code >= 500:
+                logger.warning(f"[PROBE] {endpoint.base_url}{path}: HTTP {response.status_code}")
+                ok = False
+        except requests.RequestException as e:
+            logger.warning(f"[PROBE] {endpoint.base_url}{path}: {str(e)}")
+            ok = False
     
-    # Ferma использует AuthToken, GroupCode, uuid - проверяем и query, и body
-    auth_token = (
-        request.args.get('AuthToken') or 
-        request.args.get('token') or
-        body_data.get('AuthToken') or
-        body_data.get('token')
-    )
-    group_code = (
-        request.args.get('GroupCode') or 
-        request.args.get('group_code') or
-        body_data.get('GroupCode') or
-        body_data.get('groupCode') or
-        request_data.get('groupCode', '700')
-    ).lower()
-    uuid = (
-        request.args.get('uuid') or 
-        request.args.get('Uuid') or
-        body_data.get('uuid') or
-        body_data.get('Uuid') or
-        request_data.get('ReceiptId')
-    )
+    endpoint.record_probe(ok, latencies)
+    return ok
+
+
+def upstream_prober() -> None:
+    '''Фоновый поток воркера: проверка всех адресов пулов, итог по пулу по умолчанию - в circuit breaker'''
+    logger.info("[PROBE] Upstream prober started")
+    while True:
+        try:
+            for pool in UPSTREAM_POOLS.values():
+                for endpoint in pool.endpoints:
+                    probe_endpoint(pool, endpoint)
+            
+            # Breaker'ы общие для всех пулов: судим по пулу по умолчанию, через который идёт основной трафик
+            healthy = any(endpoint.available() for endpoint in UPSTREAM_POOLS[UPSTREAM_DEFAULT_POOL].endpoints)
+            for breaker in CIRCUIT_BREAKERS.values():
+                breaker.record_probe(healthy)
+        except Exception as e:
+            logger.error(f"[PROBE] Probe iteration failed: {str(e)}")
+        time.sleep(UPSTREAM_PROBE_INTERVAL_SECONDS)
+
+
+# ============================================
+# BULKHEADS (CONCURRENCY LIMITS)
+# ============================================
+class Bulkhead:
+    '''Лимит одновременных запросов класса endpoint в воркере; для upstream-классов лимит адаптивный (AIMD)'''
     
-    logger.info(f"[STATUS] Incoming request: uuid={uuid}, GroupCode={group_code}, AuthToken={'***' if auth_token else None}")
-    log_to_db('status', 'INFO', 'Incoming status check request',
-              request_data={'uuid': uuid, 'GroupCode': group_code, 'has_token': bool(auth_token)},
-              request_id=request_id)
+    def __init__(self, endpoint_class: str, max_limit: int, min_target_latency: Optional[float]):
+        self.endpoint_class = endpoint_class
+        self.max_limit = max(max_limit, BULKHEAD_MIN_LIMIT)
+        self.min_target_latency = min_target_latency
+        self.limit = float(self.max_limit)
+        # Минимальная задержка: текущее окно и базовая (минимум прошлого окна или меньше)
+        self.min_latency: Optional[float] = None
+        self.window_min_latency: Optional[float] = None
+        self.window_started = time.monotonic()
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        BULKHEAD_LIMIT.labels(endpoint_class=endpoint_class).set(self.max_limit)
     
-    if not auth_token:
-        ferma_error = {
-            'Status': 'Failed',
-            'Error': {
-                'Code': 401,
-                'Message': 'AuthToken обязателен'
-            }
-        }
-        flask_response = jsonify(ferma_error)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, 401
+    def try_acquire(self) -> bool:
+        with self.lock:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+        BULKHEAD_IN_FLIGHT.labels(endpoint_class=self.endpoint_class).inc()
+        return True
     
-    if not uuid:
-        ferma_error = {
-            'Status': 'Failed',
-            'Error': {
-                'Code': 400,
-                'Message': 'uuid обязателен'
-            }
-        }
-        flask_response = jsonify(ferma_error)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, 400
+    def release(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+        BULKHEAD_IN_FLIGHT.labels(endpoint_class=self.endpoint_class).dec()
     
-    ekomkassa_url = f'https://app.ecomkassa.ru/fiscalorder/v5/{group_code}/report/{uuid}'
-    logger.info(f"[STATUS] Request to eKomKassa: {ekomkassa_url}")
+    def target_latency(self) -> float:
+        '''Целевая задержка по минимальной наблюдаемой (вызывается под self.lock)'''
+        if self.min_latency is None:
+            return self.min_target_latency
+        return max(self.min_target_latency, self.min_latency * BULKHEAD_LATENCY_TOLERANCE)
     
-    try:
-        response = requests.get(
-            ekomkassa_url,
-            headers={
-                'Content-Type': 'application/json',
-                'Token': auth_token
-            },
-            timeout=10
-        )
-        
-        duration_ms = int((time.time() - start_time) * 1000)
-        logger.info(f"[STATUS] Response from eKomKassa: status={response.status_code}, body={response.text}")
-        
-        try:
-            response_json = response.json()
-        except:
-            response_json = {'raw': response.text}
-        
-        # Конвертируем в формат Атол/Ferma
-        if response.status_code == 200 and isinstance(response_json, dict):
-            # Маппинг статусов eKomKassa -> Ferma
-            status_code = 0  # NEW по умолчанию
-            status_name = 'NEW'
-            status_message = 'Запрос на чек получен'
-            
-            ekomkassa_status = response_json.get('status', 'wait')
-            
-            if ekomkassa_status == 'done':
-                status_code = 1
-                status_name = 'PROCEED'
-                status_message = 'Чек сформирован на кассе'
-            elif ekomkassa_status == 'wait':
-                status_code = 0
-                status_name = 'NEW'
-                status_message = 'Запрос на чек получен'
-            elif ekomkassa_status == 'error' or ekomkassa_status == 'fail':
-                status_code = 2
-                status_name = 'ERROR'
-                # Для fail берём текст ошибки из разных мест
-                error_message = 'Ошибка создания чека'
-                if response_json.get('error'):
-                    if isinstance(response_json['error'], dict):
-                        error_message = response_json['error'].get('text', error_message)
-                    else:
-                        error_message = str(response_json['error'])
-                elif response_json.get('message'):
-                    error_message = response_json['message']
-                status_message = error_message
-            
-            # Получаем payload для извлечения данных
-            payload = response_json.get('payload', {})
-            timestamp_raw = response_json.get('timestamp')
-            receipt_datetime = payload.get('receipt_datetime') if payload else None
-            
-            logger.info(f"[DATE] Raw timestamp: '{timestamp_raw}'")
-            logger.info(f"[DATE] Raw receipt_datetime: '{receipt_datetime}'")
-            
-            # Конвертируем даты с помощью функции
-            timestamp_iso = convert_ekomkassa_datetime(timestamp_raw) if timestamp_raw else None
-            receipt_date_iso = convert_ekomkassa_datetime(receipt_datetime) if ekomkassa_status == 'done' and receipt_datetime else None
-            
-            logger.info(f"[DATE] Converted timestamp: '{timestamp_iso}'")
-            logger.info(f"[DATE] Converted receipt_datetime: '{receipt_date_iso}'")
-            
-            ferma_data = {
-                'StatusCode': status_code,
-                'StatusName': status_name,
-                'StatusMessage': status_message,
-                'ModifiedDateUtc': timestamp_iso,
-                'ReceiptDateUtc': receipt_date_iso,
-                'ModifiedDateTimeIso': timestamp_iso,
-                'ReceiptDateTimeIso': receipt_date_iso,
-                'ReceiptId': uuid,
-                'Device': None
-            }
-            
-            # Добавляем информацию об устройстве из payload
-            if payload:
-                # OfdReceiptUrl берём из permalink (приоритет) или ofd_receipt_url
-                ofd_url = response_json.get('permalink') or payload.get('ofd_receipt_url') or None
-                
-                ferma_data['Device'] = {
-                    'DeviceId': payload.get('kkt_reg_id') or None,
-                    'RNM': payload.get('ecr_registration_number') or None,
-                    'ZN': payload.get('serial_number') or None,
-                    'FN': payload.get('fn_number') or None,
-                    'FDN': str(payload.get('fiscal_document_number')) if payload.get('fiscal_document_number') is not None else None,
-                    'FPD': str(payload.get('fiscal_document_attribute')) if payload.get('fiscal_document_attribute') is not None else None,
-                    'ShiftNumber': payload.get('shift_number') if payload.get('shift_number') is not None else None,
-                    'ReceiptNumInShift': payload.get('fiscal_receipt_number') if payload.get('fiscal_receipt_number') is not None else None,
-                    'DeviceType': None,
-                    'OfdReceiptUrl': ofd_url
-                }
-            
-            ferma_response = create_ferma_response(status='Success', data=ferma_data)
-            client_status = 200
-            
-        elif response.status_code == 404 or (isinstance(response_json, dict) and 
-                                             response_json.get('error', {}).get('code') == 31):
-            # Документ не найден
-            ferma_response = create_ferma_response(
-                status='Failed',
-                error={'Code': 1004, 'Message': 'Документ не найден'}
-            )
-            client_status = 404
+    def observe_upstream(self, duration: float, failed: bool) -> None:
+        '''Подстройка лимита по задержке eKomKassa: аддитивный рост, мультипликативное снижение'''
+        if self.min_target_latency is None:
+            return
+        with self.lock:
+            if not failed:
+                now = time.monotonic()
+                self.window_min_latency = min(duration, self.window_min_latency or duration)
+                self.min_latency = min(duration, self.min_latency or duration)
+                # Раз в окно базовая задержка берётся заново: она может и вырасти вслед за eKomKassa
+                if now - self.window_started >= BULKHEAD_MIN_LATENCY_WINDOW_SECONDS:
+                    self.min_latency = self.window_min_latency
+                    self.window_min_latency = None
+                    self.window_started = now
+            if failed or duration > self.target_latency():
+                self.limit = max(float(BULKHEAD_MIN_LIMIT), self.limit * BULKHEAD_BACKOFF)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            limit = int(self.limit)
+        BULKHEAD_LIMIT.labels(endpoint_class=self.endpoint_class).set(limit)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            snapshot = {'limit': int(self.limit), 'max_limit': self.max_limit, 'in_flight': self.in_flight}
+            if self.min_target_latency is not None:
+                snapshot['target_latency_ms'] = int(self.target_latency() * 1000)
+            return snapshot
+
+
+BULKHEADS = {
+    endpoint_class: Bulkhead(endpoint_class, max_limit, BULKHEAD_MIN_TARGET_LATENCY_SECONDS.get(endpoint_class))
+    for endpoint_class, max_limit in BULKHEAD_MAX_LIMITS.items()
+} if BULKHEAD_ENABLED else {}
+
+# Одновременные запросы по клиентам в воркере
+bulkhead_clients: Dict[str, int] = {}
+bulkhead_clients_lock = threading.Lock()
+
+
+def bulkhead_class_for(path: str, rule: Optional[str]) -> Optional[str]:
+    '''Класс endpoint для bulkhead; None - запрос не ограничивается'''
+    if path in BULKHEAD_EXCLUDED_PATHS:
+        return None
+    if rule in BULKHEAD_ENDPOINTS:
+        return BULKHEAD_ENDPOINTS[rule]
+    if path.startswith('/api/') or path.startswith('/request-logs'):
+        return 'admin'
+    return None
+
+
+def acquire_client_slot(client_key: str) -> bool:
+    with bulkhead_clients_lock:
+        in_flight = bulkhead_clients.get(client_key, 0)
+        if in_flight >= BULKHEAD_CLIENT_LIMIT:
+            return False
+        bulkhead_clients[client_key] = in_flight + 1
+        return True
+
+
+def release_client_slot(client_key: str) -> None:
+    with bulkhead_clients_lock:
+        in_flight = bulkhead_clients.get(client_key, 0) - 1
+        if in_flight > 0:
+            bulkhead_clients[client_key] = in_flight
         else:
-            # Другие ошибки
-            error_code = 1000
-            error_message = 'Ошибка получения статуса'
-            
-            if isinstance(response_json, dict) and response_json.get('error'):
-                error_obj = response_json['error']
-                if isinstance(error_obj, dict):
-                    error_code = error_obj.get('code', error_code)
-                    error_message = error_obj.get('text', error_message)
-                elif isinstance(error_obj, str):
-                    error_message = error_obj
-            
-            ferma_response = create_ferma_response(
-                status='Failed',
-                error={'Code': error_code, 'Message': error_message}
-            )
-            client_status = response.status_code
-        
-        log_to_db('status', 'INFO', 'eKomKassa status response received',
-                  request_data={'uuid': uuid, 'group_code': group_code},
-                  response_data={'ferma_format': ferma_response, 'ekomkassa_raw': response_json},
-                  request_id=request_id,
-                  duration_ms=duration_ms,
-                  status_code=response.status_code)
-        
-        flask_response = jsonify(ferma_response)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, client_status
-        
-    except requests.RequestException as e:
-        duration_ms = int((time.time() - start_time) * 1000)
-        error_msg = str(e)
-        logger.error(f"[STATUS] eKomKassa API error: {error_msg}")
-        
-        ferma_error_response = {
-            'Status': 'Failed',
-            'Error': {
-                'Code': 500,
-                'Message': f'Ошибка подключения к сервису кассы: {error_msg}'
-            }
-        }
-        
-        log_to_db('status', 'ERROR', f'eKomKassa API error: {error_msg}',
-                  request_data={'uuid': uuid, 'group_code': group_code},
-                  request_id=request_id,
-                  duration_ms=duration_ms,
-                  status_code=500)
-        
-        flask_response = jsonify(ferma_error_response)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, 500
+            bulkhead_clients.pop(client_key, None)
 
 
 # ============================================
-# RECEIPT ENDPOINT
+# RATE LIMITS (TOKEN BUCKETS)
 # ============================================
-@app.route('/api/kkt/cloud/receipt', methods=['POST', 'OPTIONS'])
-def receipt_handler():
+def token_fingerprint(token: str) -> str:
+    '''SHA-256 токена клиента: сам токен в служебных таблицах не хранится'''
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def rate_limit_keys(login: Optional[str] = None, token: Optional[str] = None, group_code: Optional[str] = None) -> list:
+    '''Ключи bucket запроса; токен хранится в БД только в виде хэша'''
+    keys = []
+    if login:
+        keys.append(f'login:{login}')
+    if token:
+        keys.append(f'token:{token_fingerprint(token)[:32]}')
+    if group_code:
+        keys.append(f'group:{group_code}')
+    return [key for key in keys if key in RATE_LIMIT_OVERRIDES or key.split(':', 1)[0] in RATE_LIMIT_QUOTAS]
+
+
+def rate_limit_wait(keys: list) -> float:
+    '''Берёт по токену из bucket каждого ключа: 0 - запрос разрешён, иначе секунд до появления токена'''
+    quotas = [(key, *RATE_LIMIT_OVERRIDES.get(key, RATE_LIMIT_QUOTAS.get(key.split(':', 1)[0]))) for key in keys]
+    try:
+        return shared_state.take_tokens(quotas)
+    except SharedStateError as e:
+        # Недоступность общего хранилища не должна останавливать приём чеков
+        logger.warning(f"[RATE LIMIT] Check skipped: {str(e)}")
+        return 0.0
+
+
+def enforce_rate_limit(endpoint_class: str, keys: list):
     '''
-    Ferma-совместимый API для создания чеков
-    Ferma URL: POST https://ferma.ofd.ru/api/kkt/cloud/receipt
-    Target: https://app.ecomkassa.ru/fiscalorder/v5/{group_code}/{operation}
+    Проверка квот перед обращением к eKomKassa. None - запрос можно выполнять,
+    иначе готовый ответ 429 в формате Ferma (запрос не уходит в eKomKassa и не пишется в лог)
     '''
-    start_time = time.time()
-    request_id = request.headers.get('X-Request-ID', str(time.time()))
-    
-    if request.method == 'OPTIONS':
-        response = jsonify({})
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        response.headers['Access-Control-Max-Age'] = '86400'
-        return response, 200
+    if not RATE_LIMIT_ENABLED or not keys:
+        return None
     
-    body_data = request.get_json(silent=True) or {}
+    deadline = time.monotonic() + RATE_LIMIT_MAX_DELAY_MS / 1000
+    delayed = False
+    while True:
+        wait = rate_limit_wait(keys)
+        if wait <= 0:
+            if delayed:
+                RATE_LIMITED.labels(endpoint_class=endpoint_class, outcome='delayed').inc()
+            return None
+        if time.monotonic() + wait > deadline:
+            break
+        delayed = True
+        time.sleep(wait)
     
-    logger.info(f"[RECEIPT] Incoming request: {json.dumps(body_data, ensure_ascii=False)}")
-    log_to_db('receipt', 'INFO', 'Incoming receipt request',
-              request_data=body_data,
-              request_id=request_id)
+    RATE_LIMITED.labels(endpoint_class=endpoint_class, outcome='rejected').inc()
+    logger.warning(f"[RATE LIMIT] {endpoint_class} rejected, retry after {wait:.2f}s")
+    response = jsonify(create_ferma_response('Failed', error={
+        'Code': 429,
+        'Message': 'Превышен лимит запросов к сервису кассы, повторите запрос позже'
+    }))
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response, 429
+
+
+def upstream_failure_status(error: Exception) -> int:
+    '''HTTP статус клиенту при ошибке обращения к eKomKassa: 503 без попытки при открытом breaker, 504 по бюджету'''
+    if isinstance(error, CircuitOpenError):
+        return 503
+    if isinstance(error, DeadlineExceededError):
+        return 504
+    return 500
+
+
+# ============================================
+# RETRIES AND HEDGING
+# ============================================
+class RetryBudget:
+    '''Бюджет повторов операции в воркере: пополняется долей каждого запроса, повтор тратит единицу'''
     
-    # Ferma формат использует Request с заглавной буквы
-    ferma_request = body_data.get('Request')
+    def __init__(self):
+        self.tokens = RETRY_BUDGET_MAX
+        self.lock = threading.Lock()
     
-    # AuthToken или token - читаем из URL и body (совместимость)
-    auth_token = (
-        request.args.get('AuthToken') or 
-        request.args.get('token') or
-        body_data.get('AuthToken') or 
-        body_data.get('token')
-    )
+    def deposit(self) -> None:
+        with self.lock:
+            self.tokens = min(RETRY_BUDGET_MAX, self.tokens + RETRY_BUDGET_RATIO)
     
-    # GroupCode или group_code - читаем из URL и body (совместимость)
-    group_code = (
-        request.args.get('GroupCode') or 
-        request.args.get('group_code') or
-        body_data.get('GroupCode') or 
-        body_data.get('group_code', '700')
-    ).lower()
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+RETRY_BUDGETS = {operation: RetryBudget() for operation in RETRY_POLICIES}
+
+# Задержки успешных запросов статуса для порога hedging
+hedge_latencies = deque(maxlen=HEDGE_SAMPLE_SIZE)
+hedge_latencies_lock = threading.Lock()
+
+
+def is_connect_error(error: Exception) -> bool:
+    '''Ошибка до отправки запроса (соединение не установлено) - повтор не создаст дубль чека'''
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', error.args[0]), NewConnectionError)
+    return False
+
+
+def retry_fits_deadline(delay: float) -> bool:
+    '''Успеет ли повтор после паузы delay в остаток времени запроса клиента'''
+    remaining = remaining_request_time()
+    if remaining is None or remaining - delay >= UPSTREAM_MIN_TIMEOUT_SECONDS:
+        return True
+    DEADLINE_EXCEEDED.labels(stage='retry').inc()
+    return False
+
+
+def retry_delay(attempt: int) -> float:
+    '''Пауза перед повтором (секунды): экспоненциальная с полным jitter'''
+    return random.uniform(0, min(RETRY_MAX_DELAY_MS, RETRY_BASE_DELAY_MS * 2 ** (attempt - 1))) / 1000
+
+
+def hedge_delay(operation: str) -> Optional[float]:
+    '''Через сколько секунд отправлять hedged запрос; None - hedging не используется'''
+    if operation != 'status' or not HEDGE_STATUS_ENABLED:
+        return None
+    breaker = CIRCUIT_BREAKERS.get(operation)
+    if breaker is not None and breaker.state != 'closed':
+        return None
+    with hedge_latencies_lock:
+        if len(hedge_latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(hedge_latencies)
+    threshold = latencies[min(len(latencies) - 1, int(len(latencies) * HEDGE_QUANTILE))]
+    return max(threshold, HEDGE_MIN_DELAY_MS / 1000)
+
+
+def close_response_future(future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def hedged_send(operation: str, delay: float, session: requests.Session,
+                method: str, url: str, **kwargs) -> requests.Response:
+    '''Запрос с hedging: второй запрос через delay секунд, если первый ещё не ответил; берётся первый ответ'''
+    primary = hedge_executor.submit(session.request, method, url, **kwargs)
+    try:
+        return primary.result(timeout=delay)
+    except FuturesTimeoutError:
+        pass
     
-    if ferma_request:
-        result = convert_ferma_to_ekomkassa(ferma_request, auth_token, 
-                                           group_code, 
-                                           start_time, request_id)
-    else:
-        result = convert_simple_format(body_data, start_time, request_id)
+    budget = RETRY_BUDGETS.get(operation)
+    if budget is not None and not budget.withdraw():
+        UPSTREAM_RETRY_BUDGET_EXHAUSTED.labels(operation=operation).inc()
+        return primary.result()
     
-    return result
+    hedge = hedge_executor.submit(session.request, method, url, **kwargs)
+    pending = {primary: 'primary', hedge: 'hedge'}
+    error = None
+    while pending:
+        done, _ = futures_wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            winner = pending.pop(future)
+            try:
+                response = future.result()
+            except requests.RequestException as e:
+                error = e
+                continue
+            UPSTREAM_HEDGED.labels(operation=operation, winner=winner).inc()
+            # Ответ проигравшего запроса не нужен: закрываем, когда он придёт
+            for other in pending:
+                other.add_done_callback(close_response_future)
+            return response
+    raise error
 
 
-def convert_ferma_to_ekomkassa(ferma_request: Dict[str, Any], token: Optional[str], 
-                               group_code: str, start_time: float, request_id: Optional[str]):
-    '''Конвертация полного формата Ferma API в eKomKassa'''
+def upstream_request(operation: str, method: str, url: str, pool: Optional[UpstreamPool] = None,
+                     **kwargs) -> requests.Response:
+    '''
+    Запрос к eKomKassa с повторами по RETRY_POLICIES (операции без политики - одна попытка)
+    С pool url - путь от базового адреса пула: каждая попытка идёт на выбранный адрес пула,
+    повтор - по возможности на другой; таймаут по умолчанию - из настроек пула
+    Повторы ограничены бюджетом операции и остатком времени запроса клиента;
+    ответ 502/503/504 после последней попытки возвращается как есть
+    '''
+    ensure_upstream_prober()
+    tried = []
     
-    # Определяем operation в самом начале для использования в логах
-    logger.info(f"[RECEIPT-ENTER] Function called, request_id={request_id}")
-    operation_mapping = {
-        'Income': 'sell',
-        'IncomeReturn': 'sell_refund',
-        'Outcome': 'buy',
-        'OutcomeReturn': 'buy_refund',
-        'IncomeCorrection': 'sell_correction',
-        'SellCorrection': 'sell_correction',
-        'OutcomeCorrection': 'buy_correction',
-        'BuyCorrection': 'buy_correction',
-        'IncomeReturnCorrection': 'sell_refund_correction',
-        'SellRefundCorrection': 'sell_refund_correction',
-        'OutcomeReturnCorrection': 'buy_refund_correction',
-        'BuyRefundCorrection': 'buy_refund_correction'
-    }
-    operation = operation_mapping.get(ferma_request.get('Type', 'Income'), 'sell')
-    is_correction = operation in ['sell_correction', 'buy_correction', 'sell_refund_correction', 'buy_refund_correction']
+    def attempt_once() -> requests.Response:
+        if pool is None:
+            return upstream_attempt(operation, method, url, **kwargs)
+        endpoint = pool.choose(exclude=tuple(tried))
+        tried.append(endpoint)
+        return upstream_attempt(operation, method, endpoint.base_url + url,
+                                session=pool.session, endpoint=endpoint, **kwargs)
     
-    if not token:
-        ferma_error = {
-            'Status': 'Failed',
-            'Error': {
-                'Code': 401,
-                'Message': 'AuthToken обязателен'
-            }
-        }
-        flask_response = jsonify(ferma_error)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, 401
+    if pool is not None:
+        kwargs.setdefault('timeout', pool.timeouts.get(operation))
+    policy = RETRY_POLICIES.get(operation)
+    if policy is None:
+        return attempt_once()
     
-    receipt = ferma_request.get('CustomerReceipt', {})
-    items = receipt.get('Items', [])
+    budget = RETRY_BUDGETS[operation]
+    budget.deposit()
+    attempt = 1
+    while True:
+        delay = retry_delay(attempt)
+        try:
+            response = attempt_once()
+        except (CircuitOpenError, DeadlineExceededError):
+            raise
+        except requests.RequestException as e:
+            retryable = policy['retry_on'] == 'any' or is_connect_error(e)
+            if not retryable or attempt >= policy['attempts'] or not retry_fits_deadline(delay):
+                raise
+            if not budget.withdraw():
+                UPSTREAM_RETRY_BUDGET_EXHAUSTED.labels(operation=operation).inc()
+                raise
+            reason = 'error'
+            logger.warning(f"[RETRY] {operation} attempt {attempt} failed: {str(e)}")
+        else:
+            if policy['retry_on'] != 'any' or response.status_code not in RETRY_STATUS_CODES or attempt >= policy['attempts']:
+                return response
+            if not retry_fits_deadline(delay):
+                return response
+            if not budget.withdraw():
+                UPSTREAM_RETRY_BUDGET_EXHAUSTED.labels(operation=operation).inc()
+                return response
+            response.close()
+            reason = 'status'
+            logger.warning(f"[RETRY] {operation} attempt {attempt} got HTTP {response.status_code}")
+        
+        UPSTREAM_RETRIES.labels(operation=operation, reason=reason).inc()
+        time.sleep(delay)
+        attempt += 1
+
+
+def upstream_attempt(operation: str, method: str, url: str, session: Optional[requests.Session] = None,
+                     endpoint: Optional[UpstreamEndpoint] = None, **kwargs) -> requests.Response:
+    '''
+    Одна попытка запроса к eKomKassa с учётом метрик (operation: auth/receipt/status/...)
+    Сессия пула eKomKassa или общая (для произвольных URL из логов); endpoint получает исход попытки
+    Фазы: upstream_connect (0 при переиспользовании соединения), upstream_ttfb (до заголовков ответа), upstream (всего)
+    '''
+    kwargs['timeout'] = deadline_timeout(kwargs.get('timeout'))
+    breaker = CIRCUIT_BREAKERS.get(operation)
+    if breaker is not None and not breaker.allow_request():
+        CIRCUIT_REJECTED.labels(operation=operation).inc()
+        raise CircuitOpenError('eKomKassa временно недоступна, запрос не отправлялся')
     
-    if not items:
-        ferma_error = {
-            'Status': 'Failed',
-            'Error': {
-                'Code': 400,
-                'Message': 'Items обязательны в чеке'
-            }
-        }
-        flask_response = jsonify(ferma_error)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, 400
-    
-    # VAT mapping
-    ferma_vat_mapping = {
-        'VatNo': 'none',
-        'Vat0': 'vat0',
-        'Vat10': 'vat10',
-        'Vat20': 'vat20',
-        'CalculatedVat20120': 'vat20',
-        'CalculatedVat10110': 'vat10'
-    }
+    try:
+        return upstream_call(operation, method, url, session, endpoint, breaker, **kwargs)
+    finally:
+        # Исход уже записан (record снял пробу) или вызов упал не на сети - half_open не должен зависнуть
+        if breaker is not None:
+            breaker.release_probe()
+
+
+def upstream_call(operation: str, method: str, url: str, session: Optional[requests.Session],
+                  endpoint: Optional[UpstreamEndpoint], breaker: Optional[CircuitBreaker], **kwargs) -> requests.Response:
+    '''Запрос к eKomKassa после проверки circuit breaker: метрики, фазы, span и исход для breaker/адреса/bulkhead'''
+    record_phase('upstream_connect', 0.0)
+    started = time.perf_counter()
+    span_attributes = {'http.method': method, 'http.url': url, 'ekomkassa.operation': operation}
     
-    # Payment method mapping
-    payment_method_mapping = {
-        0: 'full_prepayment',
-        1: 'prepayment',
-        2: 'advance',
-        3: 'full_payment',
-        4: 'partial_payment',
-        5: 'credit',
-        6: 'credit_payment'
-    }
+    with trace_span(f'ekomkassa {operation}', client=True, attributes=span_attributes) as span:
+        if span is not None:
+            # W3C traceparent для eKomKassa
+            kwargs['headers'] = dict(kwargs.get('headers') or {})
+            otel_propagate.inject(kwargs['headers'])
+        
+        session = session or upstream_session
+        delay = hedge_delay(operation)
+        try:
+            if delay is not None:
+                response = hedged_send(operation, delay, session, method, url, **kwargs)
+            else:
+                response = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            UPSTREAM_RESPONSES.labels(operation=operation, status_code='error').inc()
+            if endpoint is not None:
+                endpoint.record(True, time.perf_counter() - started)
+            if breaker is not None:
+                breaker.record(True, time.perf_counter() - started)
+            if operation in BULKHEADS:
+                BULKHEADS[operation].observe_upstream(time.perf_counter() - started, True)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            UPSTREAM_DURATION.labels(operation=operation).observe(elapsed)
+            record_phase('upstream', elapsed * 1000)
+        
+        if endpoint is not None:
+            endpoint.record(response.status_code >= 500, elapsed)
+        if breaker is not None:
+            breaker.record(response.status_code >= 500, elapsed)
+        if operation in BULKHEADS:
+            BULKHEADS[operation].observe_upstream(elapsed, response.status_code >= 500)
+        if operation == 'status' and HEDGE_STATUS_ENABLED and response.status_code < 500:
+            with hedge_latencies_lock:
+                hedge_latencies.append(elapsed)
+        
+        if span is not None:
+            span.set_attribute('http.status_code', response.status_code)
     
-    # Measure mapping
-    measure_mapping = {
-        'PIECE': 0, 'GRAM': 10, 'KILOGRAM': 11, 'TON': 12,
-        'CENTIMETER': 20, 'DECIMETER': 21, 'METER': 22,
-        'SQUARE_CENTIMETER': 30, 'SQUARE_DECIMETER': 31, 'SQUARE_METER': 32,
-        'MILLILITER': 40, 'LITER': 41, 'CUBIC_METER': 42,
-        'KILOWATT_HOUR': 50, 'GIGACALORIE': 51,
-        'DAY': 70, 'HOUR': 71, 'MINUTE': 72, 'SECOND': 73,
-        'KILOBYTE': 80, 'MEGABYTE': 81, 'GIGABYTE': 82, 'TERABYTE': 83,
-        'OTHER': 255
+    record_phase('upstream_ttfb', response.elapsed.total_seconds() * 1000)
+    UPSTREAM_RESPONSES.labels(operation=operation, status_code=str(response.status_code)).inc()
+    return response
+
+def convert_ekomkassa_datetime(dt_str: str) -> str:
+    '''Convert eKomKassa datetime to ISO 8601 with timezone'''
+    try:
+        dt = datetime.strptime(dt_str, '%d.%m.%Y %H:%M:%S')
+        return dt.strftime('%Y-%m-%dT%H:%M:%S.000+03:00[Europe/Moscow]')
+    except Exception as e:
+        logger.error(f"Failed to convert datetime '{dt_str}': {e}")
+        return dt_str
+
+def create_ferma_response(status: str, data: Optional[Dict] = None, error: Optional[Dict] = None) -> OrderedDict:
+    '''Helper function to create Ferma-compatible response with guaranteed field order'''
+    response = OrderedDict()
+    response['Status'] = status
+    if data is not None:
+        response['Data'] = data
+    if error is not None:
+        response['Error'] = error
+    return response
+
+def require_auth(f):
+    '''Decorator for routes that require authentication'''
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get('authenticated'):
+            return jsonify({'error': 'Unauthorized', 'message': 'Authentication required'}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ============================================
+# LOGGING POLICY
+# ============================================
+# Ошибки записи request_logs не прерывают запрос; их серия делает воркер неготовым (/health/ready)
+log_write_health = {'consecutive_failures': 0, 'last_error': None, 'last_error_at': None}
+
+
+def mask_pii(key: str, value: Any) -> Any:
+    '''Маскирование Email/Phone с сохранением формы значения (домен почты, последние цифры телефона)'''
+    if not isinstance(value, str) or not value:
+        return value
+    if key == 'email' and '@' in value:
+        local, domain = value.split('@', 1)
+        return f'{local[:1]}***@{domain}'
+    return f'***{value[-2:]}' if len(value) > 4 else '***'
+
+
+def redact_url(url: Any) -> Any:
+    '''URL без значений секретных параметров запроса (AuthToken, key, ...)'''
+    if not isinstance(url, str) or '?' not in url:
+        return url
+    parsed = urlparse(url)
+    query = [
+        (name, '***' if name.lower() in LOG_SECRET_QUERY_PARAMS and value else value)
+        for name, value in parse_qsl(parsed.query, keep_blank_values=True)
+    ]
+    return parsed._replace(query=urlencode(query, safe='*')).geturl()
+
+
+def redact_payload(value: Any) -> Any:
+    '''Рекурсивное удаление секретов и маскирование персональных данных'''
+    if isinstance(value, dict):
+        redacted = {}
+        for key, item in value.items():
+            lowered = str(key).lower()
+            if lowered in LOG_SECRET_KEYS:
+                redacted[key] = '***' if item else item
+            elif lowered in LOG_URL_KEYS:
+                redacted[key] = redact_url(item)
+            elif LOG_REDACT_PII and lowered in LOG_PII_KEYS:
+                redacted[key] = mask_pii(lowered, item)
+            else:
+                redacted[key] = redact_payload(item)
+        return redacted
+    if isinstance(value, list):
+        return [redact_payload(item) for item in value]
+    return value
+
+
+def sanitize_payload(value: Any) -> Any:
+    '''Тело для лога: редактирование и обрезка по LOG_PAYLOAD_MAX_BYTES'''
+    redacted = redact_payload(value)
+    serialized = json.dumps(redacted, ensure_ascii=False)
+    if len(serialized.encode('utf-8')) <= LOG_PAYLOAD_MAX_BYTES:
+        return redacted
+    return {
+        '_truncated': True,
+        '_size': len(serialized.encode('utf-8')),
+        'preview': serialized.encode('utf-8')[:LOG_PAYLOAD_MAX_BYTES].decode('utf-8', 'ignore')
     }
+
+
+def capture_full_payloads(is_error: bool) -> bool:
+    '''Писать ли тела и заголовки в лог по LOG_TIER и бюджету запроса; решение о выборке одно на весь запрос'''
+    if LOG_TIER in ('off', 'summary'):
+        return False
+    if request_deadline_expired():
+        # Клиент уже не ждёт ответа: пишем только метаданные запроса
+        DEADLINE_EXCEEDED.labels(stage='log').inc()
+        return False
+    if is_error:
+        return True
+    if LOG_TIER == 'errors-full':
+        return False
+    if not has_request_context():
+        return True
     
-    # Convert items
-    atol_items = []
-    for item in items:
-        vat_type = ferma_vat_mapping.get(item.get('Vat', 'VatNo'), 'none')
-        payment_method = payment_method_mapping.get(item.get('PaymentMethod', 4), 'full_payment')
-        measure = measure_mapping.get(item.get('Measure', 'PIECE'), 0)
+    if 'log_full_sampled' not in g:
+        rate = LOG_FULL_SAMPLE_RATES.get(request.path, LOG_FULL_SAMPLE_RATE_DEFAULT)
+        g.log_full_sampled = random.random() < rate
+    return g.log_full_sampled
+
+
+def log_payload_line(message: str, payload: Any = None, is_error: bool = False) -> None:
+    '''Строка журнала процесса; тело добавляется по тем же правилам, что и в БД'''
+    if payload is not None and capture_full_payloads(is_error):
+        message = f'{message}, body={json.dumps(sanitize_payload(payload), ensure_ascii=False)}'
+    if is_error:
+        logger.warning(message)
+    else:
+        logger.info(message)
+
+
+def log_request_to_db(
+    method: str,
+    url: str,
+    path: str,
+    source_ip: str,
+    user_agent: str,
+    request_headers: Dict,
+    request_body: Any,
+    target_url: Optional[str] = None,
+    target_method: Optional[str] = None,
+    target_headers: Optional[Dict] = None,
+    target_body: Any = None,
+    response_status: Optional[int] = None,
+    response_headers: Optional[Dict] = None,
+    response_body: Any = None,
+    client_response_status: Optional[int] = None,
+    client_response_body: Any = None,
+    duration_ms: Optional[int] = None,
+    error_message: Optional[str] = None,
+    request_id: Optional[str] = None,
+    group_code: Optional[str] = None,
+    function_name: Optional[str] = None,
+    log_level: str = 'INFO',
+    message: Optional[str] = None
+) -> None:
+    '''
+    Единая запись о запросе в БД (с обновлением rollup-статистики)
+    function_name/log_level/message заполняют совместимое представление logs (миграция 005)
+    Фазы берутся из текущего запроса; phase_log_ms - запись логов, выполненная до этой строки
+    '''
+    started = time.perf_counter()
+    phase_timings = dict(current_phase_timings())
+    try:
+        if not DATABASE_URL:
+            return
         
-        atol_item = {
-            'name': item.get('Label', 'Товар'),
-            'price': float(item.get('Price', 0)),
-            'quantity': float(item.get('Quantity', 1)),
-            'sum': float(item.get('Amount', 0)),
-            'payment_method': payment_method,
-            'payment_object': 4,
-            'measure': measure,
-            'vat': {'type': vat_type}
-        }
-        atol_items.append(atol_item)
-    
-    # Convert payments
-    # Ferma API: либо PaymentItems (payments), либо CashlessPayments (cashless_payments)
-    payment_items = receipt.get('PaymentItems', [])
-    ferma_cashless_payments = receipt.get('CashlessPayments', [])
-    atol_payments = []
-    atol_cashless_payments = []
-    
-    # Если есть CashlessPayments - мапим в cashless_payments eKomKassa
-    if ferma_cashless_payments:
-        for payment in ferma_cashless_payments:
-            cashless_payment = {
-                'sum': float(payment.get('PaymentSum') or 0),
-                'method': int(payment.get('PaymentMethodFlag', '1')),
-                'id': payment.get('PaymentIdentifiers', ''),
-                'additional_info': payment.get('AdditionalInformation', '')
-            }
-            atol_cashless_payments.append(cashless_payment)
-    # Иначе используем PaymentItems - мапим в payments eKomKassa
-    elif payment_items:
-        for payment in payment_items:
-            payment_sum = float(payment.get('PaymentSum') or 0)
-            payment_type = payment.get('PaymentType', 1)  # 0-наличные, 1-безнал, 2-аванс, 3-кредит, 4-встречное
-            atol_payments.append({'type': payment_type, 'sum': payment_sum})
-    
-    if not atol_payments and not atol_cashless_payments:
-        total = sum(item['sum'] for item in atol_items)
-        atol_payments.append({'type': 1, 'sum': total})
-    
-    # Taxation system mapping
-    taxation_system_mapping = {
-        'Common': 'osn',
-        'Simplified': 'usn_income',
-        'SimplifiedWithExpenses': 'usn_income_outcome',
-        'Unified': 'envd',
-        'Patent': 'patent',
-        'UnifiedAgricultural': 'esn'
-    }
+        if LOG_TIER == 'off':
+            record_request_metrics(path, group_code, client_response_status, duration_ms)
+            return
+        
+        if not capture_full_payloads(bool(error_message) or (client_response_status or 500) >= 400):
+            request_headers = request_body = target_headers = target_body = None
+            response_headers = response_body = client_response_body = None
+        
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            cur.execute(
+                """
+                INSERT INTO request_logs (
+                    method, url, path, source_ip, user_agent,
+                    request_headers, request_body,
+                    target_url, target_method, target_headers, target_body,
+                    response_status, response_headers, response_body,
+                    client_response_status, client_response_body,
+                    duration_ms, error_message, request_id, group_code,
+                    function_name, log_level, message,
+                    phase_parse_ms, phase_convert_ms, phase_upstream_connect_ms, phase_upstream_ttfb_ms,
+                    phase_upstream_ms, phase_serialize_ms, phase_log_ms
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                          %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id, created_at
+                """,
+                (
+                    method, redact_url(url), path, source_ip, user_agent,
+                    json.dumps(sanitize_payload(request_headers)) if request_headers else None,
+                    json.dumps(sanitize_payload(request_body)) if request_body else None,
+                    target_url, target_method,
+                    json.dumps(sanitize_payload(target_headers)) if target_headers else None,
+                    json.dumps(sanitize_payload(target_body)) if target_body else None,
+                    response_status,
+                    json.dumps(sanitize_payload(response_headers)) if response_headers else None,
+                    json.dumps(sanitize_payload(response_body)) if response_body else None,
+                    client_response_status,
+                    json.dumps(sanitize_payload(client_response_body)) if client_response_body else None,
+                    duration_ms, error_message, request_id, group_code,
+                    function_name, log_level, message,
+                    *(phase_timings.get(phase) for phase in REQUEST_PHASES)
+                )
+            )
+            
+            # Сводка для live tail уходит подписчикам после commit
+            if LIVE_TAIL_ENABLED and live_tail_has_subscribers():
+                log_id, created_at = cur.fetchone()
+                notify_live_tail(cur, {
+                    'id': log_id,
+                    'created_at': created_at.isoformat(),
+                    'method': method,
+                    'path': path,
+                    'function_name': function_name,
+                    'group_code': group_code,
+                    'request_id': request_id,
+                    'client_response_status': client_response_status,
+                    'duration_ms': duration_ms,
+                    'error_message': error_message[:200] if error_message else None
+                })
+            
+            conn.commit()
+            
+            # Rollup обновляем отдельной транзакцией: ошибка статистики не должна терять сам лог
+            try:
+                update_metrics_rollups(cur, path, group_code, client_response_status, duration_ms)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Failed to update metrics rollups: {str(e)}")
+            
+            cur.close()
+        log_write_health['consecutive_failures'] = 0
+    except Exception as e:
+        logger.error(f"Failed to write request log to DB: {str(e)}")
+        log_write_health['consecutive_failures'] += 1
+        log_write_health['last_error'] = str(e)[:200]
+        log_write_health['last_error_at'] = datetime.now().isoformat()
+    finally:
+        if DATABASE_URL:
+            elapsed = time.perf_counter() - started
+            LOG_WRITE_DURATION.labels(table='request_logs').observe(elapsed)
+            record_phase('log', elapsed * 1000)
+            record_span('db insert request_logs', started, {'db.system': 'postgresql', 'db.sql.table': 'request_logs'})
+
+
+def status_class_for(status_code: Optional[int]) -> str:
+    '''Класс HTTP статуса для статистики: 2xx / 4xx / 5xx (нет ответа считаем 5xx)'''
+    if not status_code:
+        return '5xx'
+    return f'{status_code // 100}xx'
+
+
+def latency_bucket_vector(duration_ms: Optional[int]) -> list:
+    '''Вектор гистограммы с единицей в корзине, куда попадает duration_ms'''
+    vector = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    vector[bisect_left(LATENCY_BUCKETS_MS, duration_ms or 0)] = 1
+    return vector
+
+
+def update_metrics_rollups(cur, endpoint: str, group_code: Optional[str],
+                           status_code: Optional[int], duration_ms: Optional[int]) -> None:
+    '''Инкрементальное обновление поминутного и почасового rollup одним запросом'''
+    duration = duration_ms or 0
+    params = (endpoint, group_code or '', status_class_for(status_code),
+              duration, duration, latency_bucket_vector(duration))
     
-    sno = taxation_system_mapping.get(receipt.get('TaxationSystem', 'Common'), 'osn')
+    for table, precision in (('request_metrics_minute', 'minute'), ('request_metrics_hour', 'hour')):
+        cur.execute(
+            f"""
+            INSERT INTO {table} AS m (
+                bucket_start, endpoint, group_code, status_class,
+                request_count, duration_sum_ms, duration_max_ms, latency_buckets
+            ) VALUES (date_trunc('{precision}', CURRENT_TIMESTAMP), %s, %s, %s, 1, %s, %s, %s)
+            ON CONFLICT (bucket_start, endpoint, group_code, status_class) DO UPDATE SET
+                request_count = m.request_count + 1,
+                duration_sum_ms = m.duration_sum_ms + EXCLUDED.duration_sum_ms,
+                duration_max_ms = GREATEST(m.duration_max_ms, EXCLUDED.duration_max_ms),
+                latency_buckets = ARRAY(
+                    SELECT a + b FROM unnest(m.latency_buckets, EXCLUDED.latency_buckets) AS t(a, b)
+                )
+            """,
+            params
+        )
+
+
+def record_request_metrics(endpoint: str, group_code: Optional[str],
+                           status_code: Optional[int], duration_ms: Optional[int]) -> None:
+    '''Обновление rollup-статистики без записи в request_logs (LOG_TIER=off)'''
+    try:
+        if not DATABASE_URL:
+            return
+        
+        with db_connection() as conn:
+            cur = conn.cursor()
+            update_metrics_rollups(cur, endpoint, group_code, status_code, duration_ms)
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        logger.error(f"Failed to update metrics rollups: {str(e)}")
+
+
+def proxy_and_log(target_url: str, target_method: str = None) -> tuple:
+    '''
+    Универсальная функция для проксирования запроса с полным логированием
+    Возвращает (response_json, status_code)
+    '''
+    start_time = time.time()
+    request_id = request.headers.get('X-Request-ID', f'req_{int(time.time() * 1000)}')
     
-    # Client info
-    client_info = {}
-    if receipt.get('Email'):
-        client_info['email'] = receipt['Email']
-    if receipt.get('Phone'):
-        client_info['phone'] = receipt['Phone']
+    # Информация о входящем запросе
+    method = request.method
+    url = request.url
+    path = request.path
+    source_ip = request.headers.get('X-Real-IP', request.remote_addr)
+    user_agent = request.headers.get('User-Agent', '')
+    request_headers = dict(request.headers)
+    with timed_phase('parse'):
+        request_body = request.get_json(silent=True) or {}
     
-    timestamp = datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+    # Для проксирования используем метод запроса или переданный
+    if target_method is None:
+        target_method = method
     
-    # Build eKomKassa payload
-    company_data = {
-        'email': client_info.get('email', 'shop@example.com'),
-        'sno': sno,
-        'inn': ferma_request.get('Inn', '0000000000'),
-        'payment_address': ferma_request.get('CallbackUrl', 'https://example.com')
-    }
+    response_status = None
+    response_headers = None
+    response_body = None
+    client_response_status = None
+    client_response_body = None
+    error_message = None
     
-    if is_correction:
-        correction_info = receipt.get('CorrectionInfo', {})
-        correction_type_mapping = {
-            'SELF': 'self',
-            'INSTRUCTION': 'instruction'
+    try:
+        # Подготовка заголовков для проксирования
+        proxy_headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'eKomKassa-Gateway/1.0'
         }
         
-        correction_block = {
-            'client': client_info,
-            'company': company_data,
-            'correction_info': {
-                'type': correction_type_mapping.get(correction_info.get('Type', 'SELF'), 'self'),
-                'base_date': correction_info.get('ReceiptDate', '01.01.2025'),
-                'base_number': correction_info.get('ReceiptId', '1'),
-                'base_name': correction_info.get('Description', 'Корректировка')
-            },
-            'items': atol_items,
-            'total': sum(item['sum'] for item in atol_items)
+        # Отправка запроса к целевому API
+        logger.info(f"[PROXY] {method} {path} -> {target_method} {target_url}")
+        
+        if target_method == 'GET':
+            resp = upstream_request('proxy', 'GET', target_url, headers=proxy_headers, params=request.args, timeout=30)
+        else:
+            resp = upstream_request('proxy', 'POST', target_url, headers=proxy_headers, json=request_body, timeout=30)
+        
+        response_status = resp.status_code
+        response_headers = dict(resp.headers)
+        
+        try:
+            response_body = resp.json()
+        except:
+            response_body = {'raw': resp.text}
+        
+        # Формируем ответ клиенту
+        client_response_status = response_status
+        client_response_body = response_body
+        
+        duration_ms = int((time.time() - start_time) * 1000)
+        
+        # Логируем всё в БД
+        log_request_to_db(
+            method=method, url=url, path=path,
+            source_ip=source_ip, user_agent=user_agent,
+            request_headers=request_headers, request_body=request_body,
+            target_url=target_url, target_method=target_method,
+            target_headers=proxy_headers, target_body=request_body,
+            response_status=response_status,
+            response_headers=response_headers,
+            response_body=response_body,
+            client_response_status=client_response_status,
+            client_response_body=client_response_body,
+            duration_ms=duration_ms,
+            request_id=request_id
+        )
+        
+        return client_response_body, client_response_status
+        
+    except requests.exceptions.RequestException as e:
+        error_message = str(e)
+        client_response_status = 504 if isinstance(e, DeadlineExceededError) else 502
+        client_response_body = {'error': 'Gateway error', 'message': error_message}
+        duration_ms = int((time.time() - start_time) * 1000)
+        
+        logger.error(f"[PROXY] Error: {error_message}")
+        
+        # Логируем ошибку
+        log_request_to_db(
+            method=method, url=url, path=path,
+            source_ip=source_ip, user_agent=user_agent,
+            request_headers=request_headers, request_body=request_body,
+            target_url=target_url, target_method=target_method,
+            target_headers=proxy_headers, target_body=request_body,
+            client_response_status=client_response_status,
+            client_response_body=client_response_body,
+            duration_ms=duration_ms,
+            error_message=error_message,
+            request_id=request_id
+        )
+        
+        return client_response_body, client_response_status
+
+
+# ============================================
+# AUTH ENDPOINT
+# ============================================
+@app.route('/api/Authorization/CreateAuthToken', methods=['POST', 'OPTIONS'])
+def auth_handler():
+    '''
+    Ferma-совместимый API для получения токена авторизации
+    Ferma URL: POST https://ferma.ofd.ru/api/Authorization/CreateAuthToken
+    Target: https://app.ecomkassa.ru/fiscalorder/v5/getToken
+    '''
+    start_time = time.time()
+    request_id = request.headers.get('X-Request-ID', str(time.time()))
+    
+    if request.method == 'OPTIONS':
+        response = jsonify({})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        response.headers['Access-Control-Max-Age'] = '86400'
+        return response, 200
+    
+    with timed_phase('parse'):
+        body_data = request.get_json(silent=True) or {}
+    # Ferma формат использует Login и Password с заглавной буквы
+    login = body_data.get('Login') or body_data.get('login')
+    password = body_data.get('Password') or body_data.get('password')
+    
+    logger.info(f"[AUTH] Incoming request: Login={login}, Password={'***' if password else None}")
+    
+    if not login or not password:
+        ferma_error = {
+            'Status': 'Failed',
+            'Error': {
+                'Code': 400,
+                'Message': 'Login и Password обязательны'
+            }
+        }
+        flask_response = jsonify(ferma_error)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        return flask_response, 400
+    
+    rate_limited = enforce_rate_limit('auth', rate_limit_keys(login=login))
+    if rate_limited:
+        return rate_limited
+    
+    pool = upstream_pool_for(login=login)
+    ekomkassa_url = pool.url(EKOMKASSA_AUTH_PATH)
+    
+    try:
+        request_payload = {'login': login, 'pass': password}
+        logger.info(f"[AUTH] Request to eKomKassa ({pool.name}): {json.dumps({'login': login, 'pass': '***'})}")
+        
+        response = upstream_request(
+            'auth', 'POST',
+            EKOMKASSA_AUTH_PATH,
+            pool=pool,
+            json=request_payload,
+            headers={'Content-Type': 'application/json'}
+        )
+        ekomkassa_url = response.url
+        
+        duration_ms = int((time.time() - start_time) * 1000)
+        
+        try:
+            response_json = response.json()
+        except:
+            response_json = {'raw': response.text}
+        
+        log_payload_line(f"[AUTH] Response from eKomKassa: status={response.status_code}", response_json,
+                         is_error=response.status_code >= 400)
+        
+        conversion_started = time.perf_counter()
+        
+        # Конвертируем в формат Атол/Ferma
+        if response.status_code == 200 and isinstance(response_json, dict) and response_json.get('token'):
+            remember_token_pool(response_json['token'], login, pool)
+            ferma_response = create_ferma_response(
+                status='Success',
+                data={
+                    'AuthToken': response_json['token'],
+                    'ExpirationDateUtc': '2099-12-31T23:59:59'
+                }
+            )
+            client_status = 200
+        else:
+            # В случае ошибки возвращаем формат с Status Failed и Error
+            error_code = 2
+            error_message = 'Авторизация невозможна. Неверные учетные данные'
+            
+            if isinstance(response_json, dict):
+                if response_json.get('code') is not None:
+                    error_code = response_json['code']
+                if response_json.get('text'):
+                    error_message = response_json['text']
+                elif response_json.get('error'):
+                    error_obj = response_json['error']
+                    if isinstance(error_obj, dict):
+                        error_code = error_obj.get('code', error_code)
+                        error_message = error_obj.get('text', str(error_obj))
+                    elif isinstance(error_obj, str):
+                        error_message = error_obj
+            
+            ferma_response = create_ferma_response(
+                status='Failed',
+                error={
+                    'Code': error_code,
+                    'Message': error_message
+                }
+            )
+            client_status = 401
+        
+        record_conversion('auth', conversion_started)
+        
+        # Сериализуем до записи логов, чтобы фаза serialize попала в request_logs
+        with timed_phase('serialize'):
+            flask_response = jsonify(ferma_response)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        
+        # Одна запись о запросе (request_logs + представление logs)
+        log_request_to_db(
+            method=request.method,
+            url=request.url,
+            path=request.path,
+            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+            user_agent=request.headers.get('User-Agent', ''),
+            request_headers=dict(request.headers),
+            request_body=body_data,
+            target_url=ekomkassa_url,
+            target_method='POST',
+            target_headers={'Content-Type': 'application/json'},
+            target_body=request_payload,
+            response_status=response.status_code,
+            response_headers=dict(response.headers),
+            response_body=response_json,
+            client_response_status=client_status,
+            client_response_body=ferma_response,
+            duration_ms=duration_ms,
+            request_id=request_id,
+            function_name='auth',
+            message='eKomKassa response received'
+        )
+        
+        return flask_response, client_status
+        
+    except requests.RequestException as e:
+        duration_ms = int((time.time() - start_time) * 1000)
+        error_msg = str(e)
+        error_status = upstream_failure_status(e)
+        logger.error(f"[AUTH] eKomKassa API error: {error_msg}")
+        
+        ferma_error_response = {
+            'Status': 'Failed',
+            'Error': {
+                'Code': error_status,
+                'Message': f'Ошибка подключения к сервису кассы: {error_msg}'
+            }
+        }
+        
+        # Логируем ошибку одной записью
+        log_request_to_db(
+            method=request.method,
+            url=request.url,
+            path=request.path,
+            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+            user_agent=request.headers.get('User-Agent', ''),
+            request_headers=dict(request.headers),
+            request_body=body_data,
+            target_url=ekomkassa_url,
+            target_method='POST',
+            client_response_status=error_status,
+            client_response_body=ferma_error_response,
+            duration_ms=duration_ms,
+            error_message=error_msg,
+            request_id=request_id,
+            function_name='auth',
+            log_level='ERROR',
+            message=f'eKomKassa API error: {error_msg}'
+        )
+        
+        flask_response = jsonify(ferma_error_response)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        return flask_response, error_status
+
+
+# ============================================
+# STATUS ENDPOINT
+# ============================================
+def map_ekomkassa_status(http_status: int, response_json: Any, uuid: Optional[str]) -> tuple:
+    '''
+    Ответ eKomKassa на запрос статуса -> (ответ в формате Ferma, HTTP статус для клиента)
+    Чистая функция: используется обработчиком и регрессионным прогоном
+    '''
+    # Конвертируем в формат Атол/Ferma
+    if http_status == 200 and isinstance(response_json, dict):
+        # Маппинг статусов eKomKassa -> Ferma
+        status_code = 0  # NEW по умолчанию
+        status_name = 'NEW'
+        status_message = 'Запрос на чек получен'
+        
+        ekomkassa_status = response_json.get('status', 'wait')
+        
+        if ekomkassa_status == 'done':
+            status_code = 1
+            status_name = 'PROCEED'
+            status_message = 'Чек сформирован на кассе'
+        elif ekomkassa_status == 'wait':
+            status_code = 0
+            status_name = 'NEW'
+            status_message = 'Запрос на чек получен'
+        elif ekomkassa_status == 'error' or ekomkassa_status == 'fail':
+            status_code = 2
+            status_name = 'ERROR'
+            # Для fail берём текст ошибки из разных мест
+            error_message = 'Ошибка создания чека'
+            if response_json.get('error'):
+                if isinstance(response_json['error'], dict):
+                    error_message = response_json['error'].get('text', error_message)
+                else:
+                    error_message = str(response_json['error'])
+            elif response_json.get('message'):
+                error_message = response_json['message']
+            status_message = error_message
+        
+        # Получаем payload для извлечения данных
+        payload = response_json.get('payload', {})
+        timestamp_raw = response_json.get('timestamp')
+        receipt_datetime = payload.get('receipt_datetime') if payload else None
+        
+        logger.debug(f"[DATE] Raw timestamp: '{timestamp_raw}'")
+        logger.debug(f"[DATE] Raw receipt_datetime: '{receipt_datetime}'")
+        
+        # Конвертируем даты с помощью функции
+        timestamp_iso = convert_ekomkassa_datetime(timestamp_raw) if timestamp_raw else None
+        receipt_date_iso = convert_ekomkassa_datetime(receipt_datetime) if ekomkassa_status == 'done' and receipt_datetime else None
+        
+        logger.debug(f"[DATE] Converted timestamp: '{timestamp_iso}'")
+        logger.debug(f"[DATE] Converted receipt_datetime: '{receipt_date_iso}'")
+        
+        ferma_data = {
+            'StatusCode': status_code,
+            'StatusName': status_name,
+            'StatusMessage': status_message,
+            'ModifiedDateUtc': timestamp_iso,
+            'ReceiptDateUtc': receipt_date_iso,
+            'ModifiedDateTimeIso': timestamp_iso,
+            'ReceiptDateTimeIso': receipt_date_iso,
+            'ReceiptId': uuid,
+            'Device': None
         }
         
-        if atol_cashless_payments:
-            correction_block['cashless_payments'] = atol_cashless_payments
-        else:
-            correction_block['payments'] = atol_payments
+        # Добавляем информацию об устройстве из payload
+        if payload:
+            # OfdReceiptUrl берём из permalink (приоритет) или ofd_receipt_url
+            ofd_url = response_json.get('permalink') or payload.get('ofd_receipt_url') or None
+            
+            ferma_data['Device'] = {
+                'DeviceId': payload.get('kkt_reg_id') or None,
+                'RNM': payload.get('ecr_registration_number') or None,
+                'ZN': payload.get('serial_number') or None,
+                'FN': payload.get('fn_number') or None,
+                'FDN': str(payload.get('fiscal_document_number')) if payload.get('fiscal_document_number') is not None else None,
+                'FPD': str(payload.get('fiscal_document_attribute')) if payload.get('fiscal_document_attribute') is not None else None,
+                'ShiftNumber': payload.get('shift_number') if payload.get('shift_number') is not None else None,
+                'ReceiptNumInShift': payload.get('fiscal_receipt_number') if payload.get('fiscal_receipt_number') is not None else None,
+                'DeviceType': None,
+                'OfdReceiptUrl': ofd_url
+            }
+        
+        ferma_response = create_ferma_response(status='Success', data=ferma_data)
+        client_status = 200
+    
+    elif http_status == 404 or (isinstance(response_json, dict) and 
+                                response_json.get('error', {}).get('code') == 31):
+        # Документ не найден
+        ferma_response = create_ferma_response(
+            status='Failed',
+            error={'Code': 1004, 'Message': 'Документ не найден'}
+        )
+        client_status = 404
+    else:
+        # Другие ошибки
+        error_code = 1000
+        error_message = 'Ошибка получения статуса'
+        
+        if isinstance(response_json, dict) and response_json.get('error'):
+            error_obj = response_json['error']
+            if isinstance(error_obj, dict):
+                error_code = error_obj.get('code', error_code)
+                error_message = error_obj.get('text', error_message)
+            elif isinstance(error_obj, str):
+                error_message = error_obj
+        
+        ferma_response = create_ferma_response(
+            status='Failed',
+            error={'Code': error_code, 'Message': error_message}
+        )
+        client_status = http_status
+    
+    return ferma_response, client_status
+
+
+@app.route('/api/kkt/cloud/status', methods=['GET', 'POST', 'OPTIONS'])
+def status_handler():
+    '''
+    Ferma-совместимый API для получения статуса чека
+    Ferma URL: GET https://ferma.ofd.ru/api/kkt/cloud/status?uuid={uuid}&AuthToken={token}
+    Target: https://app.ecomkassa.ru/fiscalorder/v5/{group_code}/report/{uuid}
+    '''
+    start_time = time.time()
+    request_id = request.headers.get('X-Request-ID', str(time.time()))
+    
+    if request.method == 'OPTIONS':
+        response = jsonify({})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        response.headers['Access-Control-Max-Age'] = '86400'
+        return response, 200
+    
+    # Читаем body (если есть)
+    with timed_phase('parse'):
+        body_data = request.get_json(silent=True) or {}
+    request_data = body_data.get('Request', {})
+    
+    # Ferma использует AuthToken, GroupCode, uuid - проверяем и query, и body
+    auth_token = (
+        request.args.get('AuthToken') or 
+        request.args.get('token') or
+        body_data.get('AuthToken') or
+        body_data.get('token')
+    )
+    group_code = (
+        request.args.get('GroupCode') or 
+        request.args.get('group_code') or
+        body_data.get('GroupCode') or
+        body_data.get('groupCode') or
+        request_data.get('groupCode', '700')
+    ).lower()
+    uuid = (
+        request.args.get('uuid') or 
+        request.args.get('Uuid') or
+        body_data.get('uuid') or
+        body_data.get('Uuid') or
+        request_data.get('ReceiptId')
+    )
+    
+    logger.info(f"[STATUS] Incoming request: uuid={uuid}, GroupCode={group_code}, AuthToken={'***' if auth_token else None}")
+    
+    if not auth_token:
+        ferma_error = {
+            'Status': 'Failed',
+            'Error': {
+                'Code': 401,
+                'Message': 'AuthToken обязателен'
+            }
+        }
+        flask_response = jsonify(ferma_error)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        return flask_response, 401
+    
+    if not uuid:
+        ferma_error = {
+            'Status': 'Failed',
+            'Error': {
+                'Code': 400,
+                'Message': 'uuid обязателен'
+            }
+        }
+        flask_response = jsonify(ferma_error)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        return flask_response, 400
+    
+    stored = stored_receipt_status(uuid, group_code, auth_token)
+    if stored is not None:
+        ferma_response, client_status = stored
+        with timed_phase('serialize'):
+            flask_response = jsonify(ferma_response)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        
+        log_request_to_db(
+            method=request.method,
+            url=request.url,
+            path=request.path,
+            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+            user_agent=request.headers.get('User-Agent', ''),
+            request_headers=dict(request.headers),
+            request_body=body_data or dict(request.args),
+            client_response_status=client_status,
+            client_response_body=ferma_response,
+            duration_ms=int((time.time() - start_time) * 1000),
+            request_id=request_id,
+            group_code=group_code,
+            function_name='status',
+            message='Final status served from receipt_statuses'
+        )
+        return flask_response, client_status
+    
+    rate_limited = enforce_rate_limit('status', rate_limit_keys(token=auth_token, group_code=group_code))
+    if rate_limited:
+        return rate_limited
+    
+    pool = upstream_pool_for(group_code=group_code, auth_token=auth_token)
+    ekomkassa_path = f'/fiscalorder/v5/{group_code}/report/{uuid}'
+    ekomkassa_url = pool.url(ekomkassa_path)
+    logger.info(f"[STATUS] Request to eKomKassa ({pool.name}): {ekomkassa_path}")
+    
+    try:
+        response = upstream_request(
+            'status', 'GET',
+            ekomkassa_path,
+            pool=pool,
+            headers={
+                'Content-Type': 'application/json',
+                'Token': auth_token
+            }
+        )
+        ekomkassa_url = response.url
+        
+        duration_ms = int((time.time() - start_time) * 1000)
+        
+        try:
+            response_json = response.json()
+        except:
+            response_json = {'raw': response.text}
+        
+        log_payload_line(f"[STATUS] Response from eKomKassa: status={response.status_code}", response_json,
+                         is_error=response.status_code >= 400)
+        
+        conversion_started = time.perf_counter()
+        
+        ferma_response, client_status = map_ekomkassa_status(response.status_code, response_json, uuid)
+        
+        record_conversion('status', conversion_started)
+        
+        if response.status_code == 200 and isinstance(response_json, dict):
+            final_state = FINAL_EKOMKASSA_STATUSES.get(response_json.get('status'))
+            if final_state is not None:
+                record_receipt_final(uuid, final_state, response_json, ferma_response)
+        
+        # Сериализуем до записи логов, чтобы фаза serialize попала в request_logs
+        with timed_phase('serialize'):
+            flask_response = jsonify(ferma_response)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        
+        # Одна запись о запросе (request_logs + представление logs)
+        log_request_to_db(
+            method=request.method,
+            url=request.url,
+            path=request.path,
+            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+            user_agent=request.headers.get('User-Agent', ''),
+            request_headers=dict(request.headers),
+            request_body=body_data or dict(request.args),
+            target_url=ekomkassa_url,
+            target_method='GET',
+            target_headers={'Content-Type': 'application/json', 'Token': auth_token},
+            response_status=response.status_code,
+            response_headers=dict(response.headers),
+            response_body=response_json,
+            client_response_status=client_status,
+            client_response_body=ferma_response,
+            duration_ms=duration_ms,
+            request_id=request_id,
+            group_code=group_code,
+            function_name='status',
+            message='eKomKassa status response received'
+        )
+        
+        return flask_response, client_status
+        
+    except requests.RequestException as e:
+        duration_ms = int((time.time() - start_time) * 1000)
+        error_msg = str(e)
+        error_status = upstream_failure_status(e)
+        logger.error(f"[STATUS] eKomKassa API error: {error_msg}")
+        
+        ferma_error_response = {
+            'Status': 'Failed',
+            'Error': {
+                'Code': error_status,
+                'Message': f'Ошибка подключения к сервису кассы: {error_msg}'
+            }
+        }
+        
+        log_request_to_db(
+            method=request.method,
+            url=request.url,
+            path=request.path,
+            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+            user_agent=request.headers.get('User-Agent', ''),
+            request_headers=dict(request.headers),
+            request_body=body_data or dict(request.args),
+            target_url=ekomkassa_url,
+            target_method='GET',
+            client_response_status=error_status,
+            client_response_body=ferma_error_response,
+            duration_ms=duration_ms,
+            error_message=error_msg,
+            request_id=request_id,
+            group_code=group_code,
+            function_name='status',
+            log_level='ERROR',
+            message=f'eKomKassa API error: {error_msg}'
+        )
+        
+        flask_response = jsonify(ferma_error_response)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        return flask_response, error_status
+
+
+# ============================================
+# RECEIPT ENDPOINT
+# ============================================
+@app.route('/api/kkt/cloud/receipt', methods=['POST', 'OPTIONS'])
+def receipt_handler():
+    '''
+    Ferma-совместимый API для создания чеков
+    Ferma URL: POST https://ferma.ofd.ru/api/kkt/cloud/receipt
+    Target: https://app.ecomkassa.ru/fiscalorder/v5/{group_code}/{operation}
+    '''
+    start_time = time.time()
+    request_id = request.headers.get('X-Request-ID', str(time.time()))
+    
+    if request.method == 'OPTIONS':
+        response = jsonify({})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        response.headers['Access-Control-Max-Age'] = '86400'
+        return response, 200
+    
+    with timed_phase('parse'):
+        body_data = request.get_json(silent=True) or {}
+    
+    log_payload_line(f"[RECEIPT] Incoming request: request_id={request_id}", body_data)
+    
+    # Ferma формат использует Request с заглавной буквы
+    ferma_request = body_data.get('Request')
+    
+    # AuthToken или token - читаем из URL и body (совместимость)
+    auth_token = (
+        request.args.get('AuthToken') or 
+        request.args.get('token') or
+        body_data.get('AuthToken') or 
+        body_data.get('token')
+    )
+    
+    # GroupCode или group_code - читаем из URL и body (совместимость)
+    group_code = (
+        request.args.get('GroupCode') or 
+        request.args.get('group_code') or
+        body_data.get('GroupCode') or 
+        body_data.get('group_code', '700')
+    ).lower()
+    
+    rate_limited = enforce_rate_limit('receipt', rate_limit_keys(token=auth_token, group_code=group_code))
+    if rate_limited:
+        return rate_limited
+    
+    if ferma_request:
+        result = convert_ferma_to_ekomkassa(ferma_request, auth_token, 
+                                           group_code, 
+                                           start_time, request_id)
+    else:
+        result = convert_simple_format(body_data, start_time, request_id)
+    
+    return result
+
+
+# Тип чека Ferma -> операция eKomKassa
+FERMA_OPERATION_MAPPING = {
+    'Income': 'sell',
+    'IncomeReturn': 'sell_refund',
+    'Outcome': 'buy',
+    'OutcomeReturn': 'buy_refund',
+    'IncomeCorrection': 'sell_correction',
+    'SellCorrection': 'sell_correction',
+    'OutcomeCorrection': 'buy_correction',
+    'BuyCorrection': 'buy_correction',
+    'IncomeReturnCorrection': 'sell_refund_correction',
+    'SellRefundCorrection': 'sell_refund_correction',
+    'OutcomeReturnCorrection': 'buy_refund_correction',
+    'BuyRefundCorrection': 'buy_refund_correction'
+}
+CORRECTION_OPERATIONS = ('sell_correction', 'buy_correction', 'sell_refund_correction', 'buy_refund_correction')
+
+
+def build_ekomkassa_payload(ferma_request: Dict[str, Any], operation: str) -> Dict[str, Any]:
+    '''
+    Тело запроса eKomKassa из чека Ferma (без обращения к сети и БД, используется и регрессионным прогоном)
+    Поле timestamp - текущее время, external_id без InvoiceId - текущий unix time
+    '''
+    is_correction = operation in CORRECTION_OPERATIONS
+    receipt = ferma_request.get('CustomerReceipt', {})
+    items = receipt.get('Items', [])
+    
+    # VAT mapping
+    ferma_vat_mapping = {
+        'VatNo': 'none',
+        'Vat0': 'vat0',
+        'Vat10': 'vat10',
+        'Vat20': 'vat20',
+        'CalculatedVat20120': 'vat20',
+        'CalculatedVat10110': 'vat10'
+    }
+    
+    # Payment method mapping
+    payment_method_mapping = {
+        0: 'full_prepayment',
+        1: 'prepayment',
+        2: 'advance',
+        3: 'full_payment',
+        4: 'partial_payment',
+        5: 'credit',
+        6: 'credit_payment'
+    }
+    
+    # Measure mapping
+    measure_mapping = {
+        'PIECE': 0, 'GRAM': 10, 'KILOGRAM': 11, 'TON': 12,
+        'CENTIMETER': 20, 'DECIMETER': 21, 'METER': 22,
+        'SQUARE_CENTIMETER': 30, 'SQUARE_DECIMETER': 31, 'SQUARE_METER': 32,
+        'MILLILITER': 40, 'LITER': 41, 'CUBIC_METER': 42,
+        'KILOWATT_HOUR': 50, 'GIGACALORIE': 51,
+        'DAY': 70, 'HOUR': 71, 'MINUTE': 72, 'SECOND': 73,
+        'KILOBYTE': 80, 'MEGABYTE': 81, 'GIGABYTE': 82, 'TERABYTE': 83,
+        'OTHER': 255
+    }
+    
+    # Convert items
+    atol_items = []
+    for item in items:
+        vat_type = ferma_vat_mapping.get(item.get('Vat', 'VatNo'), 'none')
+        payment_method = payment_method_mapping.get(item.get('PaymentMethod', 4), 'full_payment')
+        measure = measure_mapping.get(item.get('Measure', 'PIECE'), 0)
+        
+        atol_item = {
+            'name': item.get('Label', 'Товар'),
+            'price': float(item.get('Price', 0)),
+            'quantity': float(item.get('Quantity', 1)),
+            'sum': float(item.get('Amount', 0)),
+            'payment_method': payment_method,
+            'payment_object': 4,
+            'measure': measure,
+            'vat': {'type': vat_type}
+        }
+        atol_items.append(atol_item)
+    
+    # Convert payments
+    # Ferma API: либо PaymentItems (payments), либо CashlessPayments (cashless_payments)
+    payment_items = receipt.get('PaymentItems', [])
+    ferma_cashless_payments = receipt.get('CashlessPayments', [])
+    atol_payments = []
+    atol_cashless_payments = []
+    
+    # Если есть CashlessPayments - мапим в cashless_payments eKomKassa
+    if ferma_cashless_payments:
+        for payment in ferma_cashless_payments:
+            cashless_payment = {
+                'sum': float(payment.get('PaymentSum') or 0),
+                'method': int(payment.get('PaymentMethodFlag', '1')),
+                'id': payment.get('PaymentIdentifiers', ''),
+                'additional_info': payment.get('AdditionalInformation', '')
+            }
+            atol_cashless_payments.append(cashless_payment)
+    # Иначе используем PaymentItems - мапим в payments eKomKassa
+    elif payment_items:
+        for payment in payment_items:
+            payment_sum = float(payment.get('PaymentSum') or 0)
+            payment_type = payment.get('PaymentType', 1)  # 0-наличные, 1-безнал, 2-аванс, 3-кредит, 4-встречное
+            atol_payments.append({'type': payment_type, 'sum': payment_sum})
+    
+    if not atol_payments and not atol_cashless_payments:
+        total = sum(item['sum'] for item in atol_items)
+        atol_payments.append({'type': 1, 'sum': total})
+    
+    # Taxation system mapping
+    taxation_system_mapping = {
+        'Common': 'osn',
+        'Simplified': 'usn_income',
+        'SimplifiedWithExpenses': 'usn_income_outcome',
+        'Unified': 'envd',
+        'Patent': 'patent',
+        'UnifiedAgricultural': 'esn'
+    }
+    
+    sno = taxation_system_mapping.get(receipt.get('TaxationSystem', 'Common'), 'osn')
+    
+    # Client info
+    client_info = {}
+    if receipt.get('Email'):
+        client_info['email'] = receipt['Email']
+    if receipt.get('Phone'):
+        client_info['phone'] = receipt['Phone']
+    
+    timestamp = datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+    
+    # Build eKomKassa payload
+    company_data = {
+        'email': client_info.get('email', 'shop@example.com'),
+        'sno': sno,
+        'inn': ferma_request.get('Inn', '0000000000'),
+        'payment_address': ferma_request.get('CallbackUrl', 'https://example.com')
+    }
+    
+    if is_correction:
+        correction_info = receipt.get('CorrectionInfo', {})
+        correction_type_mapping = {
+            'SELF': 'self',
+            'INSTRUCTION': 'instruction'
+        }
+        
+        correction_block = {
+            'client': client_info,
+            'company': company_data,
+            'correction_info': {
+                'type': correction_type_mapping.get(correction_info.get('Type', 'SELF'), 'self'),
+                'base_date': correction_info.get('ReceiptDate', '01.01.2025'),
+                'base_number': correction_info.get('ReceiptId', '1'),
+                'base_name': correction_info.get('Description', 'Корректировка')
+            },
+            'items': atol_items,
+            'total': sum(item['sum'] for item in atol_items)
+        }
+        
+        if atol_cashless_payments:
+            correction_block['cashless_payments'] = atol_cashless_payments
+        else:
+            correction_block['payments'] = atol_payments
+        
+        ekomkassa_payload = {
+            'timestamp': timestamp,
+            'external_id': ferma_request.get('InvoiceId', str(int(time.time()))),
+            'correction': correction_block
+        }
+    else:
+        receipt_block = {
+            'client': client_info,
+            'company': company_data,
+            'items': atol_items,
+            'total': sum(item['sum'] for item in atol_items)
+        }
+        
+        if atol_cashless_payments:
+            receipt_block['cashless_payments'] = atol_cashless_payments
+        else:
+            receipt_block['payments'] = atol_payments
+        
+        ekomkassa_payload = {
+            'timestamp': timestamp,
+            'external_id': ferma_request.get('InvoiceId', str(int(time.time()))),
+            'receipt': receipt_block
+        }
+    
+    if EKOMKASSA_CALLBACK_URL:
+        # Результат чека eKomKassa пришлёт на /api/ekomkassa/callback шлюза
+        ekomkassa_payload['service'] = {'callback_url': EKOMKASSA_CALLBACK_URL}
+    
+    return ekomkassa_payload
+
+
+def convert_ferma_to_ekomkassa(ferma_request: Dict[str, Any], token: Optional[str], 
+                               group_code: str, start_time: float, request_id: Optional[str]):
+    '''Конвертация полного формата Ferma API в eKomKassa'''
+    
+    conversion_started = time.perf_counter()
+    
+    # Определяем operation в самом начале для использования в логах
+    logger.debug(f"[RECEIPT-ENTER] Function called, request_id={request_id}")
+    operation = FERMA_OPERATION_MAPPING.get(ferma_request.get('Type', 'Income'), 'sell')
+    
+    if not token:
+        ferma_error = {
+            'Status': 'Failed',
+            'Error': {
+                'Code': 401,
+                'Message': 'AuthToken обязателен'
+            }
+        }
+        flask_response = jsonify(ferma_error)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        return flask_response, 401
+    
+    receipt = ferma_request.get('CustomerReceipt', {})
+    items = receipt.get('Items', [])
+    
+    if not items:
+        ferma_error = {
+            'Status': 'Failed',
+            'Error': {
+                'Code': 400,
+                'Message': 'Items обязательны в чеке'
+            }
+        }
+        flask_response = jsonify(ferma_error)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        return flask_response, 400
+    
+    ekomkassa_payload = build_ekomkassa_payload(ferma_request, operation)
+    
+    record_conversion('receipt', conversion_started)
+    
+    pool = upstream_pool_for(group_code=group_code, auth_token=token)
+    ekomkassa_path = f'/fiscalorder/v5/{group_code}/{operation}'
+    ekomkassa_url = pool.url(ekomkassa_path)
+    
+    logger.info(f"[RECEIPT] Request to eKomKassa ({pool.name}): {ekomkassa_path}")
+    log_payload_line("[RECEIPT] Payload prepared", ekomkassa_payload)
+    
+    try:
+        response = upstream_request(
+            'receipt', 'POST',
+            ekomkassa_path,
+            pool=pool,
+            json=ekomkassa_payload,
+            headers={
+                'Content-Type': 'application/json',
+                'Token': token
+            }
+        )
+        ekomkassa_url = response.url
+        
+        duration_ms = int((time.time() - start_time) * 1000)
+        
+        try:
+            response_json = response.json()
+        except:
+            response_json = {'raw': response.text}
+        
+        log_payload_line(f"[RECEIPT] Response from eKomKassa: status={response.status_code}", response_json,
+                         is_error=response.status_code >= 400)
+        
+        # Конвертируем в формат Атол/Ferma
+        if response.status_code == 200 and isinstance(response_json, dict):
+            if response_json.get('uuid'):
+                # Успешное создание чека
+                ferma_response = create_ferma_response(
+                    status='Success',
+                    data={'ReceiptId': response_json['uuid']}
+                )
+                client_status = 200
+                register_receipt(response_json['uuid'], group_code, operation, ferma_request, ekomkassa_payload)
+                register_receipt_status(
+                    response_json['uuid'], group_code, token,
+                    ferma_request.get('InvoiceId'), ferma_request.get('CallbackUrl')
+                )
+            
+            elif response_json.get('error'):
+                # Ошибка от eKomKassa
+                error_obj = response_json['error']
+                error_code = error_obj.get('code', 1000) if isinstance(error_obj, dict) else 1000
+                error_message = error_obj.get('text', str(error_obj)) if isinstance(error_obj, dict) else str(error_obj)
+                
+                ferma_response = create_ferma_response(
+                    status='Failed',
+                    error={'Code': error_code, 'Message': error_message}
+                )
+                client_status = 400
+            else:
+                # Неизвестный формат ответа
+                ferma_response = {
+                    'Status': 'Failed',
+                    'Error': {
+                        'Code': 1000,
+                        'Message': 'Неизвестный формат ответа от кассы'
+                    }
+                }
+                client_status = 500
+        else:
+            # HTTP ошибка
+            error_message = 'Ошибка создания чека'
+            error_code = response.status_code
+            
+            if isinstance(response_json, dict) and response_json.get('error'):
+                error_obj = response_json['error']
+                if isinstance(error_obj, dict):
+                    error_code = error_obj.get('code', error_code)
+                    error_message = error_obj.get('text', error_message)
+                elif isinstance(error_obj, str):
+                    error_message = error_obj
+            
+            ferma_response = {
+                'Status': 'Failed',
+                'Error': {
+                    'Code': error_code,
+                    'Message': error_message
+                }
+            }
+            client_status = response.status_code
+        
+        # Сериализуем до записи логов, чтобы фаза serialize попала в request_logs
+        with timed_phase('serialize'):
+            flask_response = jsonify(ferma_response)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        
+        # Одна запись о запросе (request_logs + представление logs)
+        log_request_to_db(
+            method='POST',
+            url=request.url,
+            path=request.path,
+            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+            user_agent=request.headers.get('User-Agent', ''),
+            request_headers=dict(request.headers),
+            request_body=ferma_request,
+            target_url=ekomkassa_url,
+            target_method='POST',
+            target_headers={'Content-Type': 'application/json', 'Token': token},
+            target_body=ekomkassa_payload,
+            response_status=response.status_code,
+            response_headers=dict(response.headers),
+            response_body=response_json,
+            client_response_status=client_status,
+            client_response_body=ferma_response,
+            duration_ms=duration_ms,
+            request_id=request_id,
+            group_code=group_code,
+            function_name='receipt',
+            message='eKomKassa receipt response received'
+        )
+        
+        return flask_response, client_status
+        
+    except requests.RequestException as e:
+        duration_ms = int((time.time() - start_time) * 1000)
+        error_msg = str(e)
+        error_status = upstream_failure_status(e)
+        logger.error(f"[RECEIPT] eKomKassa API error: {error_msg}")
+        
+        ferma_error_response = {
+            'Status': 'Failed',
+            'Error': {
+                'Code': error_status,
+                'Message': f'Ошибка подключения к сервису кассы: {error_msg}'
+            }
+        }
+        
+        log_request_to_db(
+            method='POST',
+            url=request.url,
+            path=request.path,
+            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+            user_agent=request.headers.get('User-Agent', ''),
+            request_headers=dict(request.headers),
+            request_body=ferma_request,
+            target_url=ekomkassa_url,
+            target_method='POST',
+            target_headers={'Content-Type': 'application/json', 'Token': token},
+            target_body=ekomkassa_payload,
+            client_response_status=error_status,
+            client_response_body=ferma_error_response,
+            duration_ms=duration_ms,
+            error_message=error_msg,
+            request_id=request_id,
+            group_code=group_code,
+            function_name='receipt',
+            log_level='ERROR',
+            message=f'eKomKassa API error: {error_msg}'
+        )
+        
+        flask_response = jsonify(ferma_error_response)
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        return flask_response, error_status
+
+
+def convert_simple_format(body_data: Dict[str, Any], start_time: float, request_id: Optional[str]):
+    '''Упрощённый формат (прямая проксация в eKomKassa)'''
+    
+    token = body_data.get('token')
+    group_code = body_data.get('group_code', '700')
+    operation = body_data.get('operation', 'sell')
+    
+    if not token:
+        return jsonify({'error': 'Token required'}), 401
+    
+    receipt_data = body_data.get('receipt', {})
+    
+    if not receipt_data:
+        return jsonify({'error': 'Receipt data required'}), 400
+    
+    pool = upstream_pool_for(group_code=group_code, auth_token=token)
+    ekomkassa_path = f'/fiscalorder/v5/{group_code}/{operation}'
+    ekomkassa_url = pool.url(ekomkassa_path)
+    
+    logger.info(f"[RECEIPT-SIMPLE] Request to eKomKassa ({pool.name}): {ekomkassa_path}")
+    
+    try:
+        response = upstream_request(
+            'receipt', 'POST',
+            ekomkassa_path,
+            pool=pool,
+            json=body_data,
+            headers={
+                'Content-Type': 'application/json',
+                'Token': token
+            }
+        )
+        ekomkassa_url = response.url
+        
+        duration_ms = int((time.time() - start_time) * 1000)
+        
+        try:
+            response_json = response.json()
+        except:
+            response_json = {'raw': response.text}
+        
+        log_payload_line(f"[RECEIPT-SIMPLE] Response: status={response.status_code}", response_json,
+                         is_error=response.status_code >= 400)
+        
+        log_request_to_db(
+            method='POST',
+            url=request.url,
+            path=request.path,
+            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+            user_agent=request.headers.get('User-Agent', ''),
+            request_headers=dict(request.headers),
+            request_body=body_data,
+            target_url=ekomkassa_url,
+            target_method='POST',
+            target_headers={'Content-Type': 'application/json', 'Token': token},
+            target_body=body_data,
+            response_status=response.status_code,
+            response_headers=dict(response.headers),
+            response_body=response_json,
+            client_response_status=response.status_code,
+            client_response_body=response_json,
+            duration_ms=duration_ms,
+            request_id=request_id,
+            group_code=group_code,
+            function_name='receipt',
+            message='Simple format receipt response'
+        )
+        
+        flask_response = app.response_class(
+            response=response.text,
+            status=response.status_code,
+            mimetype='application/json'
+        )
+        flask_response.headers['Access-Control-Allow-Origin'] = '*'
+        return flask_response
+        
+    except requests.RequestException as e:
+        duration_ms = int((time.time() - start_time) * 1000)
+        logger.error(f"[RECEIPT-SIMPLE] eKomKassa API error: {str(e)}")
+        error_status = upstream_failure_status(e)
+        error_response = {'error': f'eKomKassa API error: {str(e)}'}
+        log_request_to_db(
+            method='POST',
+            url=request.url,
+            path=request.path,
+            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+            user_agent=request.headers.get('User-Agent', ''),
+            request_headers=dict(request.headers),
+            request_body=body_data,
+            target_url=ekomkassa_url,
+            target_method='POST',
+            target_headers={'Content-Type': 'application/json', 'Token': token},
+            target_body=body_data,
+            client_response_status=error_status,
+            client_response_body=error_response,
+            duration_ms=duration_ms,
+            error_message=str(e),
+            request_id=request_id,
+            group_code=group_code,
+            function_name='receipt',
+            log_level='ERROR',
+            message=f'Simple format API error: {str(e)}'
+        )
+        return jsonify(error_response), error_status
+
+
+# ============================================
+# RECEIPTS REGISTRY
+# ============================================
+# Статусы eKomKassa, после которых чек больше не меняется
+FINAL_EKOMKASSA_STATUSES = {'done': 'done', 'fail': 'fail', 'error': 'fail'}
+
+
+def register_receipt(uuid: str, group_code: str, operation: str,
+                     ferma_request: Dict[str, Any], ekomkassa_payload: Dict[str, Any]) -> None:
+    '''Запись созданного чека в реестр receipts (ошибки не влияют на ответ клиенту)'''
+    if not DATABASE_URL:
+        return
+    receipt_block = ekomkassa_payload.get('receipt') or ekomkassa_payload.get('correction') or {}
+    
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    '''
+                    INSERT INTO receipts (uuid, invoice_id, group_code, operation, inn, total, items_count)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (uuid) DO NOTHING
+                    ''',
+                    (
+                        uuid, ferma_request.get('InvoiceId'), group_code, operation, ferma_request.get('Inn'),
+                        receipt_block.get('total'), len(receipt_block.get('items', []))
+                    )
+                )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"[RECEIPTS] Failed to register receipt {uuid}: {str(e)}")
+
+
+def record_receipt_final(uuid: str, final_state: str, report: Dict[str, Any], ferma_response: Dict[str, Any]) -> None:
+    '''Финальный статус чека в реестре (из запроса статуса, опроса или результата от eKomKassa); пишется один раз'''
+    if not DATABASE_URL:
+        return
+    
+    data = ferma_response.get('Data') or {}
+    payload = report.get('payload') or {}
+    try:
+        receipt_datetime = datetime.strptime(payload['receipt_datetime'], '%d.%m.%Y %H:%M:%S')
+    except (KeyError, TypeError, ValueError):
+        receipt_datetime = None
+    
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    '''
+                    UPDATE receipts
+                    SET state = %s, finalized_at = NOW(), updated_at = NOW(),
+                        receipt_datetime = %s, device = %s, error_message = %s
+                    WHERE uuid = %s AND state = 'wait'
+                    ''',
+                    (
+                        final_state, receipt_datetime,
+                        json.dumps(data.get('Device'), ensure_ascii=False) if data.get('Device') else None,
+                        data.get('StatusMessage') if final_state == 'fail' else None,
+                        uuid
+                    )
+                )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"[RECEIPTS] Failed to update receipt {uuid}: {str(e)}")
+
+
+# ============================================
+# STATUS POLLER AND CALLBACKS
+# ============================================
+_status_poller_pid = None
+_status_poller_lock = threading.Lock()
+
+# Доставка на CallbackUrl клиентов: отдельная сессия, не смешивается с пулом соединений к eKomKassa
+callback_session = requests.Session()
+
+
+def valid_callback_url(url: Any) -> bool:
+    '''
+    http(s) URL с хостом - проверка без DNS (при регистрации чека, после ответа eKomKassa).
+    Хост-IP сразу проверяется на публичность; имена разрешаются только перед доставкой (public_callback_url)
+    '''
+    if not isinstance(url, str):
+        return False
+    parsed = urlparse(url)
+    try:
+        parsed.port
+    except ValueError:
+        return False
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return False
+    if STATUS_CALLBACK_ALLOW_PRIVATE:
+        return True
+    try:
+        return ipaddress.ip_address(parsed.hostname).is_global
+    except ValueError:
+        return True
+
+
+def public_callback_url(url: str) -> bool:
+    '''Все адреса хоста CallbackUrl публичные (перед каждой доставкой: адрес мог смениться после регистрации)'''
+    if not valid_callback_url(url):
+        return False
+    if STATUS_CALLBACK_ALLOW_PRIVATE:
+        return True
+    
+    parsed = urlparse(url)
+    try:
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        addresses = {info[4][0] for info in socket.getaddrinfo(parsed.hostname, port, proto=socket.IPPROTO_TCP)}
+    except (OSError, ValueError):
+        return False
+    # is_global исключает loopback, частные сети, link-local (169.254.169.254), CGNAT и зарезервированные
+    return bool(addresses) and all(ipaddress.ip_address(address.split('%', 1)[0]).is_global for address in addresses)
+
+
+def ensure_status_poller() -> None:
+    '''Запуск фонового опроса статусов в текущем воркере (после fork у каждого свой поток)'''
+    global _status_poller_pid
+    
+    if not STATUS_POLL_ENABLED or _status_poller_pid == os.getpid():
+        return
+    with _status_poller_lock:
+        if _status_poller_pid != os.getpid():
+            threading.Thread(target=status_poller, name='status-poller', daemon=True).start()
+            _status_poller_pid = os.getpid()
+
+
+def register_receipt_status(uuid: str, group_code: str, token: str,
+                            invoice_id: Optional[str], callback_url: Optional[str]) -> None:
+    '''Постановка созданного чека на опрос статуса (ошибки не влияют на ответ клиенту)'''
+    if not STATUS_POLL_ENABLED or not DATABASE_URL:
+        return
+    callback_url = callback_url if valid_callback_url(callback_url) else None
+    if STATUS_POLL_MODE == 'callback' and callback_url is None:
+        return
+    
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    '''
+                    INSERT INTO receipt_statuses (uuid, group_code, invoice_id, auth_token, auth_token_hash,
+                                                  callback_url, next_poll_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, NOW() + %s * INTERVAL '1 second')
+                    ON CONFLICT (uuid) DO NOTHING
+                    ''',
+                    (uuid, group_code, invoice_id, token, token_fingerprint(token), callback_url,
+                     STATUS_POLL_SCHEDULE_SECONDS[0])
+                )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"[STATUS POLL] Failed to register receipt {uuid}: {str(e)}")
+        return
+    ensure_status_poller()
+
+
+def stored_receipt_status(uuid: str, group_code: str, auth_token: str) -> Optional[tuple]:
+    '''
+    Сохранённый финальный статус чека (ответ Ferma, HTTP статус) или None - спрашивать eKomKassa.
+    Отдаётся только по токену, которым чек создан: чужой или просроченный токен проверяет eKomKassa
+    '''
+    if not STATUS_POLL_ENABLED or not DATABASE_URL:
+        return None
+    ensure_status_poller()
+    
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    '''
+                    SELECT status_response, status_http FROM receipt_statuses
+                    WHERE uuid = %s AND group_code = %s AND auth_token_hash = %s
+                      AND state IN ('done', 'fail') AND status_response IS NOT NULL
+                    ''',
+                    (uuid, group_code, token_fingerprint(auth_token))
+                )
+                row = cur.fetchone()
+    except Exception as e:
+        logger.warning(f"[STATUS POLL] Stored status lookup failed: {str(e)}")
+        return None
+    
+    CACHE_REQUESTS.labels(cache='receipt_status', result='hit' if row else 'miss').inc()
+    if row is None:
+        return None
+    return json_column(row[0]), row[1]
+
+
+def claim_due_row(query: str) -> Optional[tuple]:
+    '''
+    Забирает очередную строку receipt_statuses на STATUS_POLL_LEASE_SECONDS (SKIP LOCKED между воркерами).
+    По одной: аренда пачки истекала бы раньше, чем обработаны её последние строки
+    '''
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, {'lease': STATUS_POLL_LEASE_SECONDS, 'max_age_hours': STATUS_POLL_MAX_AGE_HOURS})
+            row = cur.fetchone()
+        conn.commit()
+    return row
+
+
+def save_final_receipt_status(uuid: str, group_code: str, final_state: str,
+                              ferma_response: Dict[str, Any], client_status: int) -> bool:
+    '''
+    Финальный статус чека (из опроса или от eKomKassa) в receipt_statuses; ставит доставку на CallbackUrl.
+    False - статус уже был сохранён раньше (повторная доставка не планируется)
+    '''
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                '''
+                INSERT INTO receipt_statuses AS r (uuid, group_code, state, status_response, status_http)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (uuid) DO UPDATE SET
+                    state = EXCLUDED.state,
+                    auth_token = NULL,
+                    status_response = EXCLUDED.status_response,
+                    status_http = EXCLUDED.status_http,
+                    callback_state = CASE WHEN r.callback_url IS NOT NULL THEN 'pending' END,
+                    next_callback_at = CASE WHEN r.callback_url IS NOT NULL THEN NOW() END,
+                    updated_at = NOW()
+                WHERE r.state = 'wait'
+                RETURNING uuid
+                ''',
+                (uuid, group_code, final_state, json.dumps(ferma_response, ensure_ascii=False), client_status)
+            )
+            saved = cur.fetchone() is not None
+        conn.commit()
+    return saved
+
+
+def poll_receipt_status(row: tuple) -> None:
+    '''Один запрос статуса чека в eKomKassa и сохранение результата'''
+    uuid, group_code, auth_token, poll_attempts, expired, callback_url = row
+    
+    if expired or not auth_token:
+        STATUS_POLLS.labels(outcome='expired').inc()
+        update = ("state = 'expired', auth_token = NULL", ())
+    else:
+        try:
+            response = upstream_request(
+                'status', 'GET',
+                f'/fiscalorder/v5/{group_code}/report/{uuid}',
+                pool=upstream_pool_for(group_code=group_code, auth_token=auth_token),
+                headers={'Content-Type': 'application/json', 'Token': auth_token}
+            )
+            try:
+                response_json = response.json()
+            except ValueError:
+                response_json = {'raw': response.text}
+        except requests.RequestException as e:
+            logger.warning(f"[STATUS POLL] {uuid}: {str(e)}")
+            response, response_json = None, None
+        
+        final_state = None
+        if response is not None and response.status_code == 200 and isinstance(response_json, dict):
+            final_state = FINAL_EKOMKASSA_STATUSES.get(response_json.get('status'))
+        
+        if final_state is not None:
+            STATUS_POLLS.labels(outcome=final_state).inc()
+            ferma_response, client_status = map_ekomkassa_status(response.status_code, response_json, uuid)
+            save_final_receipt_status(uuid, group_code, final_state, ferma_response, client_status)
+            record_receipt_final(uuid, final_state, response_json, ferma_response)
+            update = ("auth_token = NULL", ())
+        else:
+            STATUS_POLLS.labels(outcome='wait' if response is not None and response.status_code == 200 else 'error').inc()
+            delay = STATUS_POLL_SCHEDULE_SECONDS[min(poll_attempts + 1, len(STATUS_POLL_SCHEDULE_SECONDS) - 1)]
+            update = ("next_poll_at = NOW() + %s * INTERVAL '1 second'", (delay,))
+    
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f'''
+                UPDATE receipt_statuses
+                SET {update[0]}, poll_attempts = poll_attempts + 1, last_polled_at = NOW(), updated_at = NOW()
+                WHERE uuid = %s
+                ''',
+                (*update[1], uuid)
+            )
+        conn.commit()
+
+
+def deliver_status_callback(row: tuple) -> None:
+    '''POST финального статуса в формате Ferma на CallbackUrl клиента'''
+    uuid, callback_url, status_response, callback_attempts = row
+    
+    error = None
+    if not public_callback_url(callback_url):
+        callback_attempts = len(STATUS_CALLBACK_SCHEDULE_SECONDS)
+        error = 'CallbackUrl does not resolve to public addresses'
+    else:
+        try:
+            # Без перехода по редиректам: иначе проверку адреса можно обойти
+            response = callback_session.post(
+                callback_url,
+                data=json.dumps(json_column(status_response), ensure_ascii=False).encode('utf-8'),
+                headers={'Content-Type': 'application/json; charset=utf-8', 'Idempotency-Key': str(uuid)},
+                timeout=STATUS_CALLBACK_TIMEOUT_SECONDS,
+                allow_redirects=False
+            )
+            if not 200 <= response.status_code < 300:
+                error = f'HTTP {response.status_code}'
+            response.close()
+        except requests.RequestException as e:
+            error = str(e)
+    
+    if error is None:
+        STATUS_CALLBACKS.labels(outcome='delivered').inc()
+        update = ("callback_state = 'delivered', callback_delivered_at = NOW(), callback_last_error = NULL", ())
+    elif callback_attempts < len(STATUS_CALLBACK_SCHEDULE_SECONDS):
+        STATUS_CALLBACKS.labels(outcome='retry').inc()
+        update = (
+            "callback_last_error = %s, next_callback_at = NOW() + %s * INTERVAL '1 second'",
+            (error, STATUS_CALLBACK_SCHEDULE_SECONDS[callback_attempts])
+        )
+    else:
+        STATUS_CALLBACKS.labels(outcome='failed').inc()
+        logger.warning(f"[STATUS CALLBACK] {uuid}: giving up after {callback_attempts + 1} attempts: {error}")
+        update = ("callback_state = 'failed', callback_last_error = %s", (error,))
+    
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f'''
+                UPDATE receipt_statuses
+                SET {update[0]}, callback_attempts = callback_attempts + 1, updated_at = NOW()
+                WHERE uuid = %s AND callback_state = 'pending'
+                ''',
+                (*update[1], uuid)
+            )
+        conn.commit()
+
+
+def status_poller() -> None:
+    '''Фоновый поток воркера: опрос чеков в ожидании и доставка финальных статусов на CallbackUrl'''
+    logger.info("[STATUS POLL] Poller started")
+    while True:
+        processed = 0
+        try:
+            for _ in range(STATUS_POLL_BATCH_ROWS):
+                row = claim_due_row(
+                    '''
+                    UPDATE receipt_statuses SET next_poll_at = NOW() + %(lease)s * INTERVAL '1 second'
+                    WHERE uuid = (
+                        SELECT uuid FROM receipt_statuses
+                        WHERE state = 'wait' AND next_poll_at <= NOW()
+                        ORDER BY next_poll_at LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING uuid, group_code, auth_token, poll_attempts,
+                              created_at < LOCALTIMESTAMP - make_interval(hours => %(max_age_hours)s) AS expired,
+                              callback_url
+                    '''
+                )
+                if row is None:
+                    break
+                poll_receipt_status(row)
+                processed += 1
+            
+            for _ in range(STATUS_POLL_BATCH_ROWS):
+                row = claim_due_row(
+                    '''
+                    UPDATE receipt_statuses SET next_callback_at = NOW() + %(lease)s * INTERVAL '1 second'
+                    WHERE uuid = (
+                        SELECT uuid FROM receipt_statuses
+                        WHERE callback_state = 'pending' AND next_callback_at <= NOW()
+                        ORDER BY next_callback_at LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING uuid, callback_url, status_response, callback_attempts
+                    '''
+                )
+                if row is None:
+                    break
+                deliver_status_callback(row)
+                processed += 1
+        except Exception as e:
+            logger.error(f"[STATUS POLL] Poller iteration failed: {str(e)}")
+        
+        if processed == 0:
+            time.sleep(STATUS_POLL_IDLE_SECONDS)
+
+
+def receipt_group_code(uuid: str) -> Optional[str]:
+    '''Группа касс чека, созданного через шлюз (реестр чеков или receipt_statuses)'''
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                '''
+                SELECT group_code FROM receipts WHERE uuid = %(uuid)s
+                UNION ALL
+                SELECT group_code FROM receipt_statuses WHERE uuid = %(uuid)s
+                LIMIT 1
+                ''',
+                {'uuid': uuid}
+            )
+            row = cur.fetchone()
+    return row[0] if row else None
+
+
+@app.route('/api/ekomkassa/callback', methods=['POST'])
+def ekomkassa_callback():
+    '''
+    Результат чека от eKomKassa (service.callback_url): тело в формате ответа /report/{uuid}.
+    Сохраняется в receipt_statuses с тем же маппингом, что и в status_handler
+    '''
+    start_time = time.time()
+    
+    if not EKOMKASSA_CALLBACK_SECRET:
+        return jsonify({'error': 'Not found'}), 404
+    if not hmac.compare_digest(request.args.get('key', '').encode('utf-8'), EKOMKASSA_CALLBACK_SECRET.encode('utf-8')):
+        EKOMKASSA_CALLBACKS.labels(outcome='rejected').inc()
+        logger.warning(f"[CALLBACK] Rejected callback from {request.headers.get('X-Real-IP', request.remote_addr)}")
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    report = request.get_json(silent=True)
+    uuid = report.get('uuid') if isinstance(report, dict) else None
+    if not uuid:
+        EKOMKASSA_CALLBACKS.labels(outcome='rejected').inc()
+        return jsonify({'error': 'uuid required'}), 400
+    
+    final_state = FINAL_EKOMKASSA_STATUSES.get(report.get('status'))
+    
+    try:
+        group_code = receipt_group_code(uuid)
+        if final_state is None or not group_code:
+            # Чек создан не через шлюз: привязать результат не к чему, строка без владельца не создаётся
+            outcome = 'ignored'
+        else:
+            ferma_response, client_status = map_ekomkassa_status(200, report, uuid)
+            outcome = 'stored' if save_final_receipt_status(
+                uuid, group_code, final_state, ferma_response, client_status
+            ) else 'duplicate'
+            record_receipt_final(uuid, final_state, report, ferma_response)
+    except Exception as e:
+        logger.error(f"[CALLBACK] Failed to store report {uuid}: {str(e)}")
+        return jsonify({'error': 'Internal error'}), 500
+    
+    EKOMKASSA_CALLBACKS.labels(outcome=outcome).inc()
+    logger.info(f"[CALLBACK] Report {uuid}: status={report.get('status')}, {outcome}")
+    
+    log_request_to_db(
+        method=request.method,
+        url=request.base_url,
+        path=request.path,
+        source_ip=request.headers.get('X-Real-IP', request.remote_addr),
+        user_agent=request.headers.get('User-Agent', ''),
+        request_headers=dict(request.headers),
+        request_body=report,
+        client_response_status=200,
+        client_response_body={'status': outcome},
+        duration_ms=int((time.time() - start_time) * 1000),
+        request_id=request.headers.get('X-Request-ID', str(time.time())),
+        group_code=group_code,
+        function_name='callback',
+        message=f'eKomKassa report received: {outcome}'
+    )
+    
+    return jsonify({'status': outcome}), 200
+
+
+# ============================================
+# REQUEST LOGS ARCHIVE (COLD STORAGE)
+# ============================================
+# Колонки request_logs, которые переносятся в архив
+ARCHIVE_PAYLOAD_COLUMNS = (
+    'request_headers', 'request_body', 'target_headers', 'target_body',
+    'response_headers', 'response_body', 'client_response_body'
+)
+
+# Индексы сегментов: имя сегмента -> (первые id блоков, [(смещение, длина), ...])
+_archive_index_cache: 'OrderedDict[str, tuple]' = OrderedDict()
+_archive_index_lock = threading.Lock()
+
+
+def json_column(value: Any) -> Any:
+    '''Значение JSONB колонки: psycopg2 уже разбирает JSONB, строка встречается у старых записей'''
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+def archive_segment_path(segment: str, suffix: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f'{segment}{suffix}')
+
+
+def write_archive_segment(segment: str, records: list) -> None:
+    '''
+    Запись сегмента: NDJSON блоками по ARCHIVE_BLOCK_ROWS строк, каждый блок - отдельный zstd frame
+    (файл целиком читается и обычным zstd -d). Рядом пишется индекс блоков .idx.json
+    '''
+    compressor = zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL)
+    data_path = archive_segment_path(segment, '.ndjson.zst')
+    index_path = archive_segment_path(segment, '.idx.json')
+    blocks = []
+    
+    with open(data_path + '.tmp', 'wb') as f:
+        for start in range(0, len(records), ARCHIVE_BLOCK_ROWS):
+            chunk = records[start:start + ARCHIVE_BLOCK_ROWS]
+            lines = ''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in chunk)
+            frame = compressor.compress(lines.encode('utf-8'))
+            blocks.append([chunk[0]['id'], f.tell(), len(frame)])
+            f.write(frame)
+        f.flush()
+        os.fsync(f.fileno())
+    
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'blocks': blocks}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def load_archive_index(segment: str) -> tuple:
+    '''Индекс сегмента из LRU кэша воркера (несколько сотен чисел на сегмент)'''
+    with _archive_index_lock:
+        index = _archive_index_cache.get(segment)
+        if index is not None:
+            _archive_index_cache.move_to_end(segment)
+            return index
+    
+    with open(archive_segment_path(segment, '.idx.json')) as f:
+        blocks = json.load(f)['blocks']
+    index = ([block[0] for block in blocks], [(block[1], block[2]) for block in blocks])
+    
+    with _archive_index_lock:
+        _archive_index_cache[segment] = index
+        while len(_archive_index_cache) > ARCHIVE_INDEX_CACHE_SEGMENTS:
+            _archive_index_cache.popitem(last=False)
+    return index
+
+
+def read_archived_payload(segment: str, log_id: int) -> Dict[str, Any]:
+    '''Payload колонки записи из архива: читается и распаковывается только один блок'''
+    first_ids, blocks = load_archive_index(segment)
+    position = bisect_right(first_ids, log_id) - 1
+    if position < 0:
+        return {}
+    
+    offset, length = blocks[position]
+    with open(archive_segment_path(segment, '.ndjson.zst'), 'rb') as f:
+        f.seek(offset)
+        data = zstandard.ZstdDecompressor().decompress(f.read(length))
+    
+    for line in data.splitlines():
+        record = json.loads(line)
+        if record['id'] == log_id:
+            return record
+    return {}
+
+
+def archive_request_logs(older_than: timedelta, max_segments: Optional[int] = None) -> int:
+    '''
+    Перенос payload записей request_logs старше older_than в сегменты архива
+    Сегмент пишется на диск до UPDATE; при ошибке БД файлы удаляются, строки остаются нетронутыми
+    Возвращает число перенесённых записей
+    '''
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    archived = 0
+    segments = 0
+    
+    while max_segments is None or segments < max_segments:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f"""
+                SELECT id, {', '.join(ARCHIVE_PAYLOAD_COLUMNS)}
+                FROM request_logs
+                WHERE archive_segment IS NULL AND created_at < CURRENT_TIMESTAMP - %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+                """,
+                (older_than, ARCHIVE_SEGMENT_ROWS)
+            )
+            rows = cur.fetchall()
+            
+            if not rows:
+                conn.rollback()
+                cur.close()
+                break
+            
+            records = [dict(zip(('id',) + ARCHIVE_PAYLOAD_COLUMNS, row)) for row in rows]
+            segment = f'request_logs_{rows[0][0]:012d}_{rows[-1][0]:012d}'
+            write_archive_segment(segment, records)
+            
+            try:
+                cur.execute(
+                    f"""
+                    UPDATE request_logs
+                    SET archive_segment = %s, {', '.join(f'{column} = NULL' for column in ARCHIVE_PAYLOAD_COLUMNS)}
+                    WHERE id = ANY(%s)
+                    """,
+                    (segment, [record['id'] for record in records])
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                for suffix in ('.ndjson.zst', '.idx.json'):
+                    os.remove(archive_segment_path(segment, suffix))
+                raise
+            finally:
+                cur.close()
+        
+        logger.info(f"[ARCHIVE] Segment {segment}: {len(records)} rows")
+        archived += len(records)
+        segments += 1
+    
+    return archived
+
+
+@app.cli.command('archive-request-logs')
+@click.option('--older-than-days', type=int, default=ARCHIVE_AFTER_DAYS, show_default=True)
+@click.option('--max-segments', type=int, default=None, help='Ограничить число сегментов за запуск')
+def archive_request_logs_command(older_than_days, max_segments):
+    '''Перенести payload старых записей request_logs в архив (запуск из cron/systemd timer)'''
+    archived = archive_request_logs(timedelta(days=older_than_days), max_segments)
+    click.echo(f'Archived {archived} request log rows to {ARCHIVE_DIR}')
+
+
+# ============================================
+# AUTH ENDPOINTS FOR WEB INTERFACE
+# ============================================
+@app.route('/api/admin/login', methods=['POST', 'OPTIONS'])
+def admin_login():
+    '''Login endpoint for admin panel'''
+    if request.method == 'OPTIONS':
+        response = jsonify({})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        response.headers['Access-Control-Max-Age'] = '86400'
+        return response, 200
+    
+    body_data = request.get_json(silent=True) or {}
+    login = body_data.get('login')
+    password = body_data.get('password')
+    
+    logger.info(f"[ADMIN] Login attempt: login={login}")
+    
+    if login == ADMIN_LOGIN and password == ADMIN_PASSWORD:
+        session['authenticated'] = True
+        session['login'] = login
+        logger.info(f"[ADMIN] Login successful: {login}")
+        
+        response = jsonify({'success': True, 'message': 'Authentication successful'})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        return response, 200
+    else:
+        logger.warning(f"[ADMIN] Login failed: {login}")
+        response = jsonify({'success': False, 'message': 'Invalid credentials'})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        return response, 401
+
+@app.route('/api/admin/logout', methods=['POST', 'OPTIONS'])
+def admin_logout():
+    '''Logout endpoint for admin panel'''
+    if request.method == 'OPTIONS':
+        response = jsonify({})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        response.headers['Access-Control-Max-Age'] = '86400'
+        return response, 200
+    
+    session.clear()
+    logger.info("[ADMIN] User logged out")
+    
+    response = jsonify({'success': True, 'message': 'Logged out successfully'})
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Credentials'] = 'true'
+    return response, 200
+
+@app.route('/api/admin/check', methods=['GET'])
+def admin_check():
+    '''Check if user is authenticated'''
+    is_authenticated = session.get('authenticated', False)
+    
+    response = jsonify({
+        'authenticated': is_authenticated,
+        'login': session.get('login') if is_authenticated else None
+    })
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Credentials'] = 'true'
+    return response, 200
+
+@app.route('/api/logs', methods=['GET'])
+@require_auth
+def get_logs():
+    '''Get logs from database with pagination and filtering'''
+    try:
+        if not DATABASE_URL:
+            return jsonify({'error': 'Database not configured'}), 500
+        
+        limit = int(request.args.get('limit', 500))
+        offset = int(request.args.get('offset', 0))
+        function_name = request.args.get('function')
+        log_level = request.args.get('level')
+        
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            query = "SELECT id, created_at, function_name, log_level, message, request_id, duration_ms, status_code FROM logs WHERE 1=1"
+            params = []
+            
+            if function_name:
+                query += " AND function_name = %s"
+                params.append(function_name)
+            
+            if log_level:
+                query += " AND log_level = %s"
+                params.append(log_level)
+            
+            query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
+            params.extend([limit, offset])
+            
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            
+            logs = []
+            for row in rows:
+                logs.append({
+                    'id': row[0],
+                    'created_at': row[1].isoformat() if row[1] else None,
+                    'function_name': row[2],
+                    'log_level': row[3],
+                    'message': row[4],
+                    'request_id': row[5],
+                    'duration_ms': row[6],
+                    'status_code': row[7]
+                })
+            
+            cur.close()
+        
+        response = jsonify({'logs': logs, 'count': len(logs)})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        return response, 200
+        
+    except Exception as e:
+        logger.error(f"Failed to fetch logs: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/request-logs', methods=['GET'])
+@require_auth
+def get_request_logs():
+    '''Получить полные логи запросов с возможностью фильтрации'''
+    try:
+        if not DATABASE_URL:
+            return jsonify({'error': 'Database not configured'}), 500
+        
+        limit = int(request.args.get('limit', 500))
+        offset = int(request.args.get('offset', 0))
+        path_filter = request.args.get('path')
+        status_filter = request.args.get('status')
+        
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            query = """
+                SELECT id, created_at, method, url, path, source_ip, 
+                       request_body, target_url, response_status, response_body,
+                       client_response_status, duration_ms, error_message, request_id
+                FROM request_logs WHERE 1=1
+            """
+            params = []
+            
+            if path_filter:
+                query += " AND path LIKE %s"
+                params.append(f'%{path_filter}%')
+            
+            if status_filter:
+                query += " AND client_response_status = %s"
+                params.append(int(status_filter))
+            
+            query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
+            params.extend([limit, offset])
+            
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            
+            logs = []
+            for row in rows:
+                logs.append({
+                    'id': row[0],
+                    'created_at': row[1].isoformat() if row[1] else None,
+                    'method': row[2],
+                    'url': row[3],
+                    'path': row[4],
+                    'source_ip': row[5],
+                    'request_body': json_column(row[6]),
+                    'target_url': row[7],
+                    'response_status': row[8],
+                    'response_body': json_column(row[9]),
+                    'client_response_status': row[10],
+                    'duration_ms': row[11],
+                    'error_message': row[12],
+                    'request_id': row[13]
+                })
+            
+            cur.close()
+        
+        response = jsonify({'logs': logs, 'count': len(logs)})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        return response, 200
+        
+    except Exception as e:
+        logger.error(f"Failed to fetch request logs: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/receipts', methods=['GET'])
+@require_auth
+def get_receipts():
+    '''Реестр чеков: поиск по uuid, invoice_id, group_code, state и периоду создания'''
+    try:
+        if not DATABASE_URL:
+            return jsonify({'error': 'Database not configured'}), 500
+        
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        conditions = []
+        params = []
+        for column in ('uuid', 'invoice_id', 'group_code', 'state'):
+            if request.args.get(column):
+                conditions.append(f"{column} = %s")
+                params.append(request.args[column])
+        if request.args.get('from'):
+            conditions.append("created_at >= %s")
+            params.append(datetime.fromisoformat(request.args['from']))
+        if request.args.get('to'):
+            conditions.append("created_at < %s")
+            params.append(datetime.fromisoformat(request.args['to']))
+        
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f'''
+                    SELECT uuid, invoice_id, group_code, operation, inn, total, items_count, state,
+                           created_at, finalized_at, receipt_datetime, device, error_message
+                    FROM receipts
+                    {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+                    ORDER BY created_at DESC LIMIT %s
+                    ''',
+                    params + [limit]
+                )
+                rows = cur.fetchall()
+        
+        receipts = [{
+            'uuid': row[0],
+            'invoice_id': row[1],
+            'group_code': row[2],
+            'operation': row[3],
+            'inn': row[4],
+            'total': float(row[5]) if row[5] is not None else None,
+            'items_count': row[6],
+            'state': row[7],
+            'created_at': row[8].isoformat() if row[8] else None,
+            'finalized_at': row[9].isoformat() if row[9] else None,
+            'receipt_datetime': row[10].isoformat() if row[10] else None,
+            'device': json_column(row[11]),
+            'error_message': row[12]
+        } for row in rows]
+        
+        response = jsonify({'receipts': receipts, 'count': len(receipts)})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        return response, 200
+    
+    except ValueError as e:
+        return jsonify({'error': f'Invalid parameter: {str(e)}'}), 400
+    except Exception as e:
+        logger.error(f"Failed to fetch receipts: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+def request_log_filter_conditions(filters: Dict[str, Any]) -> tuple:
+    '''Условия WHERE для фильтров path (подстрока), status, group_code, function: (conditions, params)'''
+    conditions = []
+    params = []
+    if filters.get('path'):
+        conditions.append("path LIKE %s")
+        params.append(f"%{filters['path']}%")
+    if filters.get('status'):
+        conditions.append("client_response_status = %s")
+        params.append(int(filters['status']))
+    if filters.get('group_code'):
+        conditions.append("group_code = %s")
+        params.append(str(filters['group_code']).lower())
+    if filters.get('function'):
+        conditions.append("function_name = %s")
+        params.append(filters['function'])
+    return conditions, params
+
+
+# Колонки выгрузки; тела добавляются параметром payloads=true
+EXPORT_COLUMNS = (
+    'id', 'created_at', 'method', 'path', 'source_ip', 'function_name', 'group_code', 'request_id',
+    'target_url', 'response_status', 'client_response_status', 'duration_ms', 'error_message', 'archive_segment'
+)
+EXPORT_PAYLOAD_COLUMNS = ('request_body', 'target_body', 'response_body', 'client_response_body')
+
+
+def iter_request_log_export(query: str, params: list, columns: tuple, export_format: str):
+    '''
+    Генератор выгрузки: строки приходят батчами по EXPORT_BATCH_ROWS из server-side курсора,
+    поэтому память воркера не зависит от числа строк
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == 'csv':
+        writer.writerow(columns)
+    
+    for rows in iter_cursor_batches(query, params, EXPORT_BATCH_ROWS, 'request_logs_export'):
+        for row in rows:
+            values = [value.isoformat() if isinstance(value, datetime) else value for value in row]
+            if export_format == 'csv':
+                writer.writerow([
+                    json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+                    for value in values
+                ])
+            else:
+                buffer.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False) + '\n')
+        
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+@app.route('/api/request-logs/export', methods=['GET'])
+@require_auth
+def export_request_logs():
+    '''
+    Потоковая выгрузка request_logs в NDJSON или CSV за период
+    Параметры: from/to (ISO 8601, по умолчанию последние 24 часа), format=ndjson|csv,
+    path, status, group_code, function, payloads=true (добавить тела запросов и ответов)
+    '''
+    try:
+        if not DATABASE_URL:
+            return jsonify({'error': 'Database not configured'}), 500
+        
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            return jsonify({'error': 'format must be one of: ndjson, csv'}), 400
+        
+        try:
+            range_to = datetime.fromisoformat(request.args['to']) if request.args.get('to') else None
+            range_from = datetime.fromisoformat(request.args['from']) if request.args.get('from') else None
+        except ValueError:
+            return jsonify({'error': 'from/to must be ISO 8601 datetimes'}), 400
+        
+        # Недостающая граница - от текущего времени БД, как и created_at
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                range_from, range_to = resolve_time_range(
+                    cur, range_from, range_to, STATS_WINDOWS[STATS_DEFAULT_WINDOW]
+                )
+        
+        columns = EXPORT_COLUMNS
+        if request.args.get('payloads', 'false').lower() in ('1', 'true', 'yes'):
+            columns = EXPORT_COLUMNS + EXPORT_PAYLOAD_COLUMNS
+        
+        conditions, params = request_log_filter_conditions(request.args)
+        query = (f"SELECT {', '.join(columns)} FROM request_logs "
+                 f"WHERE {' AND '.join(['created_at >= %s', 'created_at < %s'] + conditions)}")
+        params = [range_from, range_to] + params
+        
+        # Порядок по индексу created_at - первые строки уходят клиенту без сортировки всего периода
+        query += " ORDER BY created_at"
+        
+        filename = f"request_logs_{range_from:%Y%m%d%H%M}_{range_to:%Y%m%d%H%M}.{export_format}"
+        response = Response(
+            iter_request_log_export(query, params, columns, export_format),
+            mimetype='text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        )
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        return response
+    
+    except Exception as e:
+        logger.error(f"Failed to export request logs: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/request-logs/<int:log_id>', methods=['GET'])
+@require_auth
+def get_request_log_detail(log_id):
+    '''Получить детальную информацию об одном запросе'''
+    try:
+        if not DATABASE_URL:
+            return jsonify({'error': 'Database not configured'}), 500
+        
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            cur.execute("""
+                SELECT id, created_at, method, url, path, source_ip, user_agent,
+                       request_headers, request_body,
+                       target_url, target_method, target_headers, target_body,
+                       response_status, response_headers, response_body,
+                       client_response_status, client_response_body,
+                       duration_ms, error_message, request_id, archive_segment
+                FROM request_logs WHERE id = %s
+            """, (log_id,))
+            
+            row = cur.fetchone()
+            cur.close()
+        
+        if not row:
+            return jsonify({'error': 'Log not found'}), 404
         
-        ekomkassa_payload = {
-            'timestamp': timestamp,
-            'external_id': ferma_request.get('InvoiceId', str(int(time.time()))),
-            'correction': correction_block
-        }
-    else:
-        receipt_block = {
-            'client': client_info,
-            'company': company_data,
-            'items': atol_items,
-            'total': sum(item['sum'] for item in atol_items)
+        log_detail = {
+            'id': row[0],
+            'created_at': row[1].isoformat() if row[1] else None,
+            'method': row[2],
+            'url': row[3],
+            'path': row[4],
+            'source_ip': row[5],
+            'user_agent': row[6],
+            'request_headers': json_column(row[7]),
+            'request_body': json_column(row[8]),
+            'target_url': row[9],
+            'target_method': row[10],
+            'target_headers': json_column(row[11]),
+            'target_body': json_column(row[12]),
+            'response_status': row[13],
+            'response_headers': json_column(row[14]),
+            'response_body': json_column(row[15]),
+            'client_response_status': row[16],
+            'client_response_body': json_column(row[17]),
+            'duration_ms': row[18],
+            'error_message': row[19],
+            'request_id': row[20],
+            'archived': row[21] is not None
         }
         
-        if atol_cashless_payments:
-            receipt_block['cashless_payments'] = atol_cashless_payments
-        else:
-            receipt_block['payments'] = atol_payments
+        # Payload перенесён в холодный архив - подставляем из сегмента
+        if row[21]:
+            archived_payload = read_archived_payload(row[21], log_id)
+            for column in ARCHIVE_PAYLOAD_COLUMNS:
+                log_detail[column] = archived_payload.get(column)
         
-        ekomkassa_payload = {
-            'timestamp': timestamp,
-            'external_id': ferma_request.get('InvoiceId', str(int(time.time()))),
-            'receipt': receipt_block
-        }
-    
-    ekomkassa_url = f'https://app.ecomkassa.ru/fiscalorder/v5/{group_code}/{operation}'
-    
-    logger.info(f"[RECEIPT] Request to eKomKassa: {ekomkassa_url}")
-    logger.info(f"[RECEIPT] Payload: {json.dumps(ekomkassa_payload, ensure_ascii=False)}")
-    
+        response = jsonify(log_detail)
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        return response, 200
+        
+    except Exception as e:
+        logger.error(f"Failed to fetch request log detail: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/request-logs/<int:log_id>/replay', methods=['POST'])
+@require_auth
+def replay_request(log_id):
+    '''Повторить запрос из истории'''
     try:
-        response = requests.post(
-            ekomkassa_url,
-            json=ekomkassa_payload,
-            headers={
-                'Content-Type': 'application/json',
-                'Token': token
-            },
-            timeout=15
-        )
+        if not DATABASE_URL:
+            return jsonify({'error': 'Database not configured'}), 500
         
-        duration_ms = int((time.time() - start_time) * 1000)
-        logger.info(f"[RECEIPT] Response from eKomKassa: status={response.status_code}, body={response.text}")
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            cur.execute("""
+                SELECT target_url, target_method, target_body, archive_segment, request_body
+                FROM request_logs WHERE id = %s
+            """, (log_id,))
+            
+            row = cur.fetchone()
+            cur.close()
+        
+        if not row:
+            return jsonify({'error': 'Log not found'}), 404
+        
+        target_url, target_method, target_body, archive_segment, request_body = row
+        
+        if archive_segment:
+            archived_payload = read_archived_payload(archive_segment, log_id)
+            target_body = archived_payload.get('target_body')
+            request_body = archived_payload.get('request_body')
+        
+        if not target_url:
+            return jsonify({'error': 'No target URL in log'}), 400
+        
+        # Повтор обрезанного или замаскированного тела создал бы чек с испорченными данными
+        loss = capture_loss(json_column(request_body)) or capture_loss(json_column(target_body))
+        if loss:
+            return jsonify({'error': f'Payload was {loss} when logged, request is not replayable'}), 409
+        
+        # Повторяем запрос
+        start_time = time.time()
+        headers = {'Content-Type': 'application/json'}
         
         try:
-            response_json = response.json()
-        except:
-            response_json = {'raw': response.text}
+            body = replay_target_body(target_body)
+        except ValueError:
+            body = {}
         
-        # Конвертируем в формат Атол/Ferma
-        if response.status_code == 200 and isinstance(response_json, dict):
-            if response_json.get('uuid'):
-                # Успешное создание чека
-                ferma_response = create_ferma_response(
-                    status='Success',
-                    data={'ReceiptId': response_json['uuid']}
-                )
-                client_status = 200
-            
-            elif response_json.get('error'):
-                # Ошибка от eKomKassa
-                error_obj = response_json['error']
-                error_code = error_obj.get('code', 1000) if isinstance(error_obj, dict) else 1000
-                error_message = error_obj.get('text', str(error_obj)) if isinstance(error_obj, dict) else str(error_obj)
-                
-                ferma_response = create_ferma_response(
-                    status='Failed',
-                    error={'Code': error_code, 'Message': error_message}
-                )
-                client_status = 400
+        try:
+            if target_method == 'GET':
+                resp = upstream_request('replay', 'GET', target_url, headers=headers, timeout=30)
             else:
-                # Неизвестный формат ответа
-                ferma_response = {
-                    'Status': 'Failed',
-                    'Error': {
-                        'Code': 1000,
-                        'Message': 'Неизвестный формат ответа от кассы'
-                    }
-                }
-                client_status = 500
-        else:
-            # HTTP ошибка
-            error_message = 'Ошибка создания чека'
-            error_code = response.status_code
+                resp = upstream_request('replay', 'POST', target_url, headers=headers, json=body, timeout=30)
             
-            if isinstance(response_json, dict) and response_json.get('error'):
-                error_obj = response_json['error']
-                if isinstance(error_obj, dict):
-                    error_code = error_obj.get('code', error_code)
-                    error_message = error_obj.get('text', error_message)
-                elif isinstance(error_obj, str):
-                    error_message = error_obj
+            duration_ms = int((time.time() - start_time) * 1000)
             
-            ferma_response = {
-                'Status': 'Failed',
-                'Error': {
-                    'Code': error_code,
-                    'Message': error_message
-                }
-            }
-            client_status = response.status_code
-        
-        log_to_db('receipt', 'INFO', 'eKomKassa receipt response received',
-                  request_data={'operation': operation, 'group_code': group_code},
-                  response_data={'ferma_format': ferma_response, 'ekomkassa_raw': response_json},
-                  request_id=request_id,
-                  duration_ms=duration_ms,
-                  status_code=response.status_code)
+            try:
+                response_body = resp.json()
+            except:
+                response_body = {'raw': resp.text}
+            
+            return jsonify({
+                'success': True,
+                'status': resp.status_code,
+                'body': response_body,
+                'duration_ms': duration_ms
+            }), 200
+            
+        except requests.RequestException as e:
+            duration_ms = int((time.time() - start_time) * 1000)
+            return jsonify({
+                'success': False,
+                'error': str(e),
+                'duration_ms': duration_ms
+            }), 504 if isinstance(e, DeadlineExceededError) else 502
         
-        # Логируем в request_logs
-        log_request_to_db(
-            method='POST',
-            url=request.url,
-            path=request.path,
-            source_ip=request.headers.get('X-Real-IP', request.remote_addr),
-            user_agent=request.headers.get('User-Agent', ''),
-            request_headers=dict(request.headers),
-            request_body=ferma_request,
-            target_url=ekomkassa_url,
-            target_method='POST',
-            target_headers={'Content-Type': 'application/json', 'Token': token},
-            target_body=ekomkassa_payload,
-            response_status=response.status_code,
-            response_headers=dict(response.headers),
-            response_body=response_json,
-            client_response_status=client_status,
-            client_response_body=ferma_response,
-            duration_ms=duration_ms,
-            request_id=request_id
-        )
+    except Exception as e:
+        logger.error(f"Failed to replay request: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+# ============================================
+# BULK REPLAY JOBS
+# ============================================
+def capture_loss(value: Any) -> Optional[str]:
+    '''
+    Почему тело из лога нельзя отправить повторно: truncated - обрезано по LOG_PAYLOAD_MAX_BYTES,
+    redacted - контакты или секреты замаскированы при записи; None - тело сохранено полностью
+    '''
+    if isinstance(value, dict):
+        if value.get('_truncated'):
+            return 'truncated'
+        for key, item in value.items():
+            lowered = str(key).lower()
+            if isinstance(item, str) and '***' in item and (lowered in LOG_SECRET_KEYS or lowered in LOG_PII_KEYS):
+                return 'redacted'
+            reason = capture_loss(item)
+            if reason:
+                return reason
+    elif isinstance(value, list):
+        for item in value:
+            reason = capture_loss(item)
+            if reason:
+                return reason
+    return None
+
+
+def replay_target_body(target_body: Any) -> Any:
+    '''Тело для повтора: service.callback_url в логе замаскирован, подставляется текущий адрес шлюза'''
+    body = json_column(target_body) or {}
+    service = body.get('service') if isinstance(body, dict) else None
+    if isinstance(service, dict) and 'callback_url' in service:
+        service = dict(service)
+        if EKOMKASSA_CALLBACK_URL:
+            service['callback_url'] = EKOMKASSA_CALLBACK_URL
+        else:
+            service.pop('callback_url')
+        body = dict(body, service=service)
+    return body
+
+
+def json_diff(original: Any, replayed: Any, ignore_keys: frozenset, path: str = '') -> list:
+    '''Различия двух JSON значений: [{'path', 'original', 'replayed'}], ключи ignore_keys пропускаются'''
+    if isinstance(original, dict) and isinstance(replayed, dict):
+        diff = []
+        for key in list(original) + [key for key in replayed if key not in original]:
+            if key in ignore_keys:
+                continue
+            diff.extend(json_diff(original.get(key), replayed.get(key), ignore_keys, f'{path}.{key}' if path else key))
+        return diff
+    
+    if isinstance(original, list) and isinstance(replayed, list) and len(original) == len(replayed):
+        diff = []
+        for index, (left, right) in enumerate(zip(original, replayed)):
+            diff.extend(json_diff(left, right, ignore_keys, f'{path}[{index}]'))
+        return diff
+    
+    if original != replayed:
+        return [{'path': path, 'original': original, 'replayed': replayed}]
+    return []
+
+
+def fetch_replay_token(credentials: Dict[str, str]) -> Optional[str]:
+    '''Токен eKomKassa для повтора (в логах токены замаскированы, поэтому берётся новый)'''
+    response = upstream_request(
+        'auth', 'POST',
+        EKOMKASSA_AUTH_PATH,
+        pool=upstream_pool_for(login=credentials['login']),
+        json={'login': credentials['login'], 'pass': credentials['password']},
+        headers={'Content-Type': 'application/json'}
+    )
+    try:
+        token = response.json().get('token')
+    except ValueError:
+        token = None
+    if not token:
+        raise RuntimeError(f'eKomKassa auth failed with status {response.status_code}')
+    return token
+
+
+def replay_log_row(row: tuple, state: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Повтор одной записи request_logs; state - общее состояние задания (токен, темп запросов)
+    При 401 токен обновляется один раз и запрос повторяется
+    '''
+    (log_id, target_url, target_method, target_body, archive_segment,
+     original_status, original_body, request_body) = row
+    result = {'log_id': log_id, 'original_status': original_status}
+    if archive_segment:
+        try:
+            archived_payload = read_archived_payload(archive_segment, log_id)
+        except OSError as e:
+            return dict(result, error=f'Archive segment unavailable: {str(e)}')
+        target_body = archived_payload.get('target_body')
+        original_body = archived_payload.get('response_body')
+        request_body = archived_payload.get('request_body')
+    
+    if not target_url:
+        return dict(result, error='No target URL in log')
+    
+    # Обрезанные и замаскированные при логировании тела не отправляются: это были бы реальные чеки с мусором
+    loss = capture_loss(json_column(request_body)) or capture_loss(json_column(target_body))
+    if loss:
+        return dict(result, skipped=True, error=f'not_replayable: payload {loss} when logged')
+    
+    for attempt in range(2):
+        # Темп задания: слоты не чаще rate_per_second, общие для всех потоков
+        with state['lock']:
+            slot = max(state['next_slot'], time.monotonic())
+            state['next_slot'] = slot + state['interval']
+            token = state['token']
+        time.sleep(max(0.0, slot - time.monotonic()))
         
-        flask_response = jsonify(ferma_response)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, client_status
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Token'] = token
         
-    except requests.RequestException as e:
-        duration_ms = int((time.time() - start_time) * 1000)
-        error_msg = str(e)
-        logger.error(f"[RECEIPT] eKomKassa API error: {error_msg}")
+        started = time.time()
+        try:
+            if target_method == 'GET':
+                response = upstream_request('replay', 'GET', target_url, headers=headers, timeout=30)
+            else:
+                response = upstream_request('replay', 'POST', target_url, headers=headers,
+                                            json=replay_target_body(target_body), timeout=30)
+        except requests.RequestException as e:
+            return dict(result, duration_ms=int((time.time() - started) * 1000), error=str(e))
         
-        ferma_error_response = {
-            'Status': 'Failed',
-            'Error': {
-                'Code': 500,
-                'Message': f'Ошибка подключения к сервису кассы: {error_msg}'
-            }
-        }
+        if response.status_code == 401 and attempt == 0 and state['credentials']:
+            with state['lock']:
+                if state['token'] == token:
+                    state['token'] = fetch_replay_token(state['credentials'])
+            continue
+        break
+    
+    try:
+        response_body = response.json()
+    except ValueError:
+        response_body = {'raw': response.text}
+    
+    diff = json_diff(json_column(original_body), response_body, state['ignore_keys'])
+    if original_status != response.status_code:
+        diff.insert(0, {'path': '$status', 'original': original_status, 'replayed': response.status_code})
+    
+    return dict(
+        result,
+        status_code=response.status_code,
+        response_body=response_body,
+        duration_ms=int((time.time() - started) * 1000),
+        diff=diff[:REPLAY_DIFF_MAX_ENTRIES]
+    )
+
+
+def save_replay_results(job_id: int, results: list) -> Optional[str]:
+    '''Сохранение батча результатов и прогресса задания; возвращает текущий статус задания'''
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            """
+            INSERT INTO replay_results (job_id, log_id, original_status, status_code, response_body,
+                                        duration_ms, error, diff)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (job_id, log_id) DO NOTHING
+            """,
+            [
+                (
+                    job_id, result['log_id'], result.get('original_status'), result.get('status_code'),
+                    json.dumps(sanitize_payload(result['response_body'])) if result.get('response_body') else None,
+                    result.get('duration_ms'), result.get('error'),
+                    json.dumps(result['diff'], ensure_ascii=False, default=str) if result.get('diff') else None
+                )
+                for result in results
+            ]
+        )
+        cur.execute(
+            """
+            UPDATE replay_jobs SET
+                processed = processed + %s,
+                succeeded = succeeded + %s,
+                failed = failed + %s,
+                skipped = skipped + %s,
+                changed = changed + %s,
+                heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+            RETURNING status
+            """,
+            (
+                len(results),
+                sum(1 for result in results if result.get('status_code') and result['status_code'] < 400),
+                sum(1 for result in results if not result.get('skipped') and (
+                    result.get('error') or (result.get('status_code') or 500) >= 400
+                )),
+                sum(1 for result in results if result.get('skipped')),
+                sum(1 for result in results if result.get('diff')),
+                job_id
+            )
+        )
+        row = cur.fetchone()
+        conn.commit()
+        cur.close()
+    return row[0] if row else None
+
+
+def finish_replay_job(job_id: int, status: str, error: Optional[str] = None) -> None:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE replay_jobs SET status = %s, error = %s, finished_at = CURRENT_TIMESTAMP WHERE id = %s",
+            (status, error, job_id)
+        )
+        conn.commit()
+        cur.close()
+
+
+def run_replay_job(job_id: int, log_ids: list, options: Dict[str, Any], credentials: Optional[Dict[str, str]]) -> None:
+    '''
+    Фоновый поток задания: строки читаются батчами по REPLAY_JOB_BATCH_ROWS, повторяются пулом потоков
+    (concurrency) с общим темпом rate_per_second, результаты пишутся батчем одним соединением
+    '''
+    state = {
+        'lock': threading.Lock(),
+        'next_slot': time.monotonic(),
+        'interval': 1.0 / options['rate_per_second'],
+        'credentials': credentials,
+        'token': None,
+        'ignore_keys': frozenset(options['ignore_keys'])
+    }
+    
+    try:
+        if credentials:
+            state['token'] = fetch_replay_token(credentials)
         
-        log_to_db('receipt', 'ERROR', f'eKomKassa API error: {error_msg}',
-                  request_data={'operation': operation, 'group_code': group_code},
-                  request_id=request_id,
-                  duration_ms=duration_ms,
-                  status_code=500)
+        with ThreadPoolExecutor(max_workers=options['concurrency'], thread_name_prefix=f'replay-{job_id}') as executor:
+            for start in range(0, len(log_ids), REPLAY_JOB_BATCH_ROWS):
+                with db_connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute(
+                        """
+                        SELECT id, target_url, target_method, target_body, archive_segment,
+                               response_status, response_body, request_body
+                        FROM request_logs WHERE id = ANY(%s) ORDER BY id
+                        """,
+                        (log_ids[start:start + REPLAY_JOB_BATCH_ROWS],)
+                    )
+                    rows = cur.fetchall()
+                    cur.close()
+                
+                results = list(executor.map(lambda row: replay_log_row(row, state), rows))
+                if save_replay_results(job_id, results) == 'cancelling':
+                    finish_replay_job(job_id, 'cancelled')
+                    return
         
-        flask_response = jsonify(ferma_error_response)
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response, 500
+        finish_replay_job(job_id, 'done')
+    except Exception as e:
+        logger.error(f"[REPLAY-JOB] Job {job_id} failed: {str(e)}")
+        finish_replay_job(job_id, 'failed', str(e))
 
 
-def convert_simple_format(body_data: Dict[str, Any], start_time: float, request_id: Optional[str]):
-    '''Упрощённый формат (прямая проксация в eKomKassa)'''
-    
-    token = body_data.get('token')
-    group_code = body_data.get('group_code', '700')
-    operation = body_data.get('operation', 'sell')
-    
-    if not token:
-        return jsonify({'error': 'Token required'}), 401
-    
-    receipt_data = body_data.get('receipt', {})
-    
-    if not receipt_data:
-        return jsonify({'error': 'Receipt data required'}), 400
-    
-    ekomkassa_url = f'https://app.ecomkassa.ru/fiscalorder/v5/{group_code}/{operation}'
-    
-    logger.info(f"[RECEIPT-SIMPLE] Request to eKomKassa: {ekomkassa_url}")
-    
+@app.route('/api/replay-jobs', methods=['POST'])
+@require_auth
+def create_replay_job():
+    '''
+    Пакетный повтор запросов из request_logs в фоне
+    Body: from/to (ISO 8601) и/или ids, фильтры path/status/group_code/function,
+          concurrency (1-8), rate_per_second, login/password (токен eKomKassa, не сохраняются),
+          ignore_keys (ключи, не учитываемые в diff)
+    '''
     try:
-        response = requests.post(
-            ekomkassa_url,
-            json=body_data,
-            headers={
-                'Content-Type': 'application/json',
-                'Token': token
-            },
-            timeout=15
-        )
+        if not DATABASE_URL:
+            return jsonify({'error': 'Database not configured'}), 500
         
-        duration_ms = int((time.time() - start_time) * 1000)
-        logger.info(f"[RECEIPT-SIMPLE] Response: status={response.status_code}, body={response.text}")
+        body = request.get_json(silent=True) or {}
         
         try:
-            response_json = response.json()
-        except:
-            response_json = {'raw': response.text}
+            range_from = datetime.fromisoformat(body['from']) if body.get('from') else None
+            range_to = datetime.fromisoformat(body['to']) if body.get('to') else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'from/to must be ISO 8601 datetimes'}), 400
         
-        log_to_db('receipt', 'INFO', 'Simple format receipt response',
-                  request_data={'operation': operation, 'group_code': group_code},
-                  response_data=response_json,
-                  request_id=request_id,
-                  duration_ms=duration_ms,
-                  status_code=response.status_code)
+        if not (range_from or body.get('ids')):
+            return jsonify({'error': 'from or ids is required'}), 400
         
-        flask_response = app.response_class(
-            response=response.text,
-            status=response.status_code,
-            mimetype='application/json'
-        )
-        flask_response.headers['Access-Control-Allow-Origin'] = '*'
-        return flask_response
+        options = {
+            'concurrency': max(1, min(int(body.get('concurrency', 4)), REPLAY_JOB_MAX_CONCURRENCY)),
+            'rate_per_second': max(0.1, float(body.get('rate_per_second', 5))),
+            'ignore_keys': list(body.get('ignore_keys') or REPLAY_DIFF_IGNORE_KEYS)
+        }
+        credentials = None
+        if body.get('login') and body.get('password'):
+            credentials = {'login': body['login'], 'password': body['password']}
         
-    except requests.RequestException as e:
-        duration_ms = int((time.time() - start_time) * 1000)
-        logger.error(f"[RECEIPT-SIMPLE] eKomKassa API error: {str(e)}")
-        log_to_db('receipt', 'ERROR', f'Simple format API error: {str(e)}',
-                  request_data={'operation': operation, 'group_code': group_code},
-                  request_id=request_id,
-                  duration_ms=duration_ms,
-                  status_code=500)
-        return jsonify({'error': f'eKomKassa API error: {str(e)}'}), 500
-
-
-# ============================================
-# AUTH ENDPOINTS FOR WEB INTERFACE
-# ============================================
-@app.route('/api/admin/login', methods=['POST', 'OPTIONS'])
-def admin_login():
-    '''Login endpoint for admin panel'''
-    if request.method == 'OPTIONS':
-        response = jsonify({})
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        response.headers['Access-Control-Max-Age'] = '86400'
-        return response, 200
-    
-    body_data = request.get_json(silent=True) or {}
-    login = body_data.get('login')
-    password = body_data.get('password')
-    
-    logger.info(f"[ADMIN] Login attempt: login={login}")
-    
-    if login == ADMIN_LOGIN and password == ADMIN_PASSWORD:
-        session['authenticated'] = True
-        session['login'] = login
-        logger.info(f"[ADMIN] Login successful: {login}")
+        filters = {key: body[key] for key in ('path', 'status', 'group_code', 'function') if body.get(key)}
+        conditions, params = request_log_filter_conditions(filters)
+        conditions.append("target_url IS NOT NULL")
+        if range_from:
+            conditions.append("created_at >= %s")
+            params.append(range_from)
+        if range_to:
+            conditions.append("created_at < %s")
+            params.append(range_to)
+        if body.get('ids'):
+            conditions.append("id = ANY(%s)")
+            params.append([int(log_id) for log_id in body['ids']])
         
-        response = jsonify({'success': True, 'message': 'Authentication successful'})
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f"SELECT id FROM request_logs WHERE {' AND '.join(conditions)} ORDER BY id LIMIT %s",
+                params + [REPLAY_JOB_MAX_ROWS + 1]
+            )
+            log_ids = [row[0] for row in cur.fetchall()]
+            
+            if len(log_ids) > REPLAY_JOB_MAX_ROWS:
+                cur.close()
+                return jsonify({'error': f'Too many rows selected (max {REPLAY_JOB_MAX_ROWS}), narrow the filter'}), 400
+            
+            job_filters = dict(filters)
+            job_filters.update({'from': body.get('from'), 'to': body.get('to'), 'ids': body.get('ids')})
+            cur.execute(
+                """
+                INSERT INTO replay_jobs (status, filters, options, total, started_at, heartbeat_at)
+                VALUES ('running', %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                RETURNING id
+                """,
+                (json.dumps(job_filters), json.dumps(dict(options, token_refresh=bool(credentials))), len(log_ids))
+            )
+            job_id = cur.fetchone()[0]
+            conn.commit()
+            cur.close()
+        
+        threading.Thread(
+            target=run_replay_job, args=(job_id, log_ids, options, credentials),
+            name=f'replay-job-{job_id}', daemon=True
+        ).start()
+        logger.info(f"[REPLAY-JOB] Job {job_id} started: {len(log_ids)} rows, options={options}")
+        
+        response = jsonify({'job_id': job_id, 'total': len(log_ids), 'status': 'running'})
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Credentials'] = 'true'
-        return response, 200
-    else:
-        logger.warning(f"[ADMIN] Login failed: {login}")
-        response = jsonify({'success': False, 'message': 'Invalid credentials'})
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        return response, 401
-
-@app.route('/api/admin/logout', methods=['POST', 'OPTIONS'])
-def admin_logout():
-    '''Logout endpoint for admin panel'''
-    if request.method == 'OPTIONS':
-        response = jsonify({})
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        response.headers['Access-Control-Max-Age'] = '86400'
-        return response, 200
-    
-    session.clear()
-    logger.info("[ADMIN] User logged out")
+        return response, 202
     
-    response = jsonify({'success': True, 'message': 'Logged out successfully'})
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Credentials'] = 'true'
-    return response, 200
+    except Exception as e:
+        logger.error(f"Failed to create replay job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-@app.route('/api/admin/check', methods=['GET'])
-def admin_check():
-    '''Check if user is authenticated'''
-    is_authenticated = session.get('authenticated', False)
-    
-    response = jsonify({
-        'authenticated': is_authenticated,
-        'login': session.get('login') if is_authenticated else None
-    })
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Credentials'] = 'true'
-    return response, 200
 
-@app.route('/api/logs', methods=['GET'])
+@app.route('/api/replay-jobs/<int:job_id>', methods=['GET'])
 @require_auth
-def get_logs():
-    '''Get logs from database with pagination and filtering'''
+def get_replay_job(job_id):
+    '''Прогресс задания повтора: счётчики, сводка различий по путям'''
     try:
         if not DATABASE_URL:
             return jsonify({'error': 'Database not configured'}), 500
         
-        limit = int(request.args.get('limit', 500))
-        offset = int(request.args.get('offset', 0))
-        function_name = request.args.get('function')
-        log_level = request.args.get('level')
-        
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        query = "SELECT id, created_at, function_name, log_level, message, request_id, duration_ms, status_code FROM logs WHERE 1=1"
-        params = []
-        
-        if function_name:
-            query += " AND function_name = %s"
-            params.append(function_name)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT id, created_at, started_at, finished_at, heartbeat_at, status, filters, options,
+                       total, processed, succeeded, failed, skipped, changed, error,
+                       -- Задание прервано перезапуском воркера: heartbeat давно не обновлялся (по часам БД)
+                       status IN ('running', 'cancelling') AND heartbeat_at < LOCALTIMESTAMP - INTERVAL '2 minutes'
+                FROM replay_jobs WHERE id = %s
+                """,
+                (job_id,)
+            )
+            row = cur.fetchone()
+            
+            if not row:
+                cur.close()
+                return jsonify({'error': 'Job not found'}), 404
+            
+            # Сводка: какие поля ответа изменились и сколько раз
+            cur.execute(
+                """
+                SELECT entry->>'path' AS path, COUNT(*) AS count
+                FROM replay_results, jsonb_array_elements(diff) AS entry
+                WHERE job_id = %s
+                GROUP BY 1 ORDER BY 2 DESC LIMIT 20
+                """,
+                (job_id,)
+            )
+            diff_summary = [{'path': path, 'count': count} for path, count in cur.fetchall()]
+            cur.close()
         
-        if log_level:
-            query += " AND log_level = %s"
-            params.append(log_level)
+        (job_id, created_at, started_at, finished_at, heartbeat_at, status, filters, options,
+         total, processed, succeeded, failed, skipped, changed, error, stale) = row
         
-        query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+        response = jsonify({
+            'id': job_id,
+            'created_at': created_at.isoformat() if created_at else None,
+            'started_at': started_at.isoformat() if started_at else None,
+            'finished_at': finished_at.isoformat() if finished_at else None,
+            'status': 'stale' if stale else status,
+            'filters': json_column(filters),
+            'options': json_column(options),
+            'total': total,
+            'processed': processed,
+            'progress': round(processed / total, 4) if total else 1.0,
+            'succeeded': succeeded,
+            'failed': failed,
+            'skipped': skipped,
+            'changed': changed,
+            'error': error,
+            'diff_summary': diff_summary
+        })
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        return response, 200
+    
+    except Exception as e:
+        logger.error(f"Failed to fetch replay job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/replay-jobs/<int:job_id>/results', methods=['GET'])
+@require_auth
+def get_replay_job_results(job_id):
+    '''Результаты задания повтора; changed=true - только строки с различиями'''
+    try:
+        if not DATABASE_URL:
+            return jsonify({'error': 'Database not configured'}), 500
         
-        cur.execute(query, params)
-        rows = cur.fetchall()
+        limit = min(int(request.args.get('limit', 100)), 500)
+        after_log_id = int(request.args.get('after_log_id', 0))
         
-        logs = []
-        for row in rows:
-            logs.append({
-                'id': row[0],
-                'created_at': row[1].isoformat() if row[1] else None,
-                'function_name': row[2],
-                'log_level': row[3],
-                'message': row[4],
-                'request_id': row[5],
-                'duration_ms': row[6],
-                'status_code': row[7]
-            })
+        query = """
+            SELECT log_id, replayed_at, original_status, status_code, duration_ms, error, diff
+            FROM replay_results WHERE job_id = %s AND log_id > %s
+        """
+        if request.args.get('changed', 'false').lower() in ('1', 'true', 'yes'):
+            query += " AND diff IS NOT NULL"
+        query += " ORDER BY log_id LIMIT %s"
         
-        cur.close()
-        conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, (job_id, after_log_id, limit))
+            results = [
+                {
+                    'log_id': row[0],
+                    'replayed_at': row[1].isoformat() if row[1] else None,
+                    'original_status': row[2],
+                    'status_code': row[3],
+                    'duration_ms': row[4],
+                    'error': row[5],
+                    'diff': json_column(row[6])
+                }
+                for row in cur.fetchall()
+            ]
+            cur.close()
         
-        response = jsonify({'logs': logs, 'count': len(logs)})
+        response = jsonify({'results': results, 'count': len(results)})
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Credentials'] = 'true'
         return response, 200
-        
+    
     except Exception as e:
-        logger.error(f"Failed to fetch logs: {str(e)}")
+        logger.error(f"Failed to fetch replay job results: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/request-logs', methods=['GET'])
+@app.route('/api/replay-jobs/<int:job_id>/cancel', methods=['POST'])
 @require_auth
-def get_request_logs():
-    '''Получить полные логи запросов с возможностью фильтрации'''
+def cancel_replay_job(job_id):
+    '''Отмена задания: поток задания останавливается после текущего батча'''
     try:
         if not DATABASE_URL:
             return jsonify({'error': 'Database not configured'}), 500
         
-        limit = int(request.args.get('limit', 500))
-        offset = int(request.args.get('offset', 0))
-        path_filter = request.args.get('path')
-        status_filter = request.args.get('status')
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE replay_jobs SET status = 'cancelling' WHERE id = %s AND status = 'running' RETURNING id",
+                (job_id,)
+            )
+            updated = cur.fetchone()
+            conn.commit()
+            cur.close()
+        
+        if not updated:
+            return jsonify({'error': 'Job not found or not running'}), 409
+        
+        response = jsonify({'job_id': job_id, 'status': 'cancelling'})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        return response, 200
+    
+    except Exception as e:
+        logger.error(f"Failed to cancel replay job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+# ============================================
+# OFFLINE REGRESSION REPLAY
+# ============================================
+def regression_check_row(row: tuple, ignore_keys: frozenset) -> Dict[str, Any]:
+    '''
+    Повторная конвертация одной записи без сети (выполняется в процессе пула)
+    receipt: build_ekomkassa_payload(request_body) против target_body
+    status: map_ekomkassa_status(response_status, response_body) против client_response_status/body
+    Результат: {'log_id', 'kind', 'result': match|mismatch|skipped|error, 'diff'|'error'}
+    '''
+    (log_id, kind, target_url, request_body, target_body, response_status, response_body,
+     client_response_status, client_response_body, archive_segment) = row
+    outcome = {'log_id': log_id, 'kind': kind}
+    
+    try:
+        if archive_segment:
+            archived_payload = read_archived_payload(archive_segment, log_id)
+            request_body = archived_payload.get('request_body')
+            target_body = archived_payload.get('target_body')
+            response_body = archived_payload.get('response_body')
+            client_response_body = archived_payload.get('client_response_body')
+        
+        request_body, target_body, response_body, client_response_body = (
+            json_column(value) for value in (request_body, target_body, response_body, client_response_body)
+        )
+        # Обрезанные при логировании тела сравнивать не с чем
+        truncated = any(isinstance(value, dict) and '_truncated' in value
+                        for value in (request_body, target_body, response_body, client_response_body))
+        
+        if kind == 'receipt':
+            if truncated or not isinstance(request_body, dict) or 'CustomerReceipt' not in request_body or not target_body:
+                return dict(outcome, result='skipped')
+            
+            operation = FERMA_OPERATION_MAPPING.get(request_body.get('Type', 'Income'), 'sell')
+            row_ignore_keys = ignore_keys if 'InvoiceId' in request_body else ignore_keys | {'external_id'}
+            # target_body в логе прошёл redact_payload (маски контактов, ключ в service.callback_url)
+            diff = json_diff(target_body, redact_payload(build_ekomkassa_payload(request_body, operation)), row_ignore_keys)
+            logged_operation = (target_url or '').rstrip('/').rsplit('/', 1)[-1]
+            if logged_operation != operation:
+                diff.insert(0, {'path': '$operation', 'original': logged_operation, 'replayed': operation})
+        else:
+            if truncated or response_status is None or client_response_body is None:
+                return dict(outcome, result='skipped')
+            
+            uuid = (target_url or '').rstrip('/').rsplit('/', 1)[-1]
+            ferma_response, client_status = map_ekomkassa_status(response_status, response_body, uuid)
+            diff = json_diff(client_response_body, ferma_response, ignore_keys)
+            if client_status != client_response_status:
+                diff.insert(0, {'path': '$status', 'original': client_response_status, 'replayed': client_status})
+    except Exception as e:
+        return dict(outcome, result='error', error=str(e))
+    
+    if diff:
+        return dict(outcome, result='mismatch', diff=diff[:REPLAY_DIFF_MAX_ENTRIES])
+    return dict(outcome, result='match')
+
+
+def run_regression_replay(range_from: Optional[datetime], range_to: Optional[datetime], kinds: tuple,
+                          workers: int, ignore_keys: frozenset, limit: Optional[int] = None,
+                          output=None) -> Dict[str, Any]:
+    '''
+    Прогон записей request_logs через текущий конвертер: строки читаются server-side курсором,
+    проверяются в пуле процессов (spawn - дочерние процессы не наследуют соединения с БД)
+    '''
+    conditions = ["function_name = ANY(%s)"]
+    params = [list(kinds)]
+    if range_from:
+        conditions.append("created_at >= %s")
+        params.append(range_from)
+    if range_to:
+        conditions.append("created_at < %s")
+        params.append(range_to)
+    
+    query = f"""
+        SELECT id, function_name, target_url, request_body, target_body, response_status, response_body,
+               client_response_status, client_response_body, archive_segment
+        FROM request_logs
+        WHERE {' AND '.join(conditions)}
+        ORDER BY id
+    """
+    if limit:
+        query += " LIMIT %s"
+        params.append(limit)
+    
+    counts = {kind: {'match': 0, 'mismatch': 0, 'skipped': 0, 'error': 0} for kind in kinds}
+    diff_paths: Dict[str, int] = {}
+    samples = []
+    rows_total = 0
+    started = last_report = time.perf_counter()
+    check = partial(regression_check_row, ignore_keys=ignore_keys)
+    
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for rows in iter_cursor_batches(query, params, EXPORT_BATCH_ROWS, 'regression_replay'):
+            for outcome in executor.map(check, rows, chunksize=max(1, len(rows) // (workers * 4))):
+                counts[outcome['kind']][outcome['result']] += 1
+                if outcome['result'] in ('mismatch', 'error'):
+                    for entry in outcome.get('diff', []):
+                        diff_paths[entry['path']] = diff_paths.get(entry['path'], 0) + 1
+                    if len(samples) < REPLAY_DIFF_MAX_ENTRIES:
+                        samples.append(outcome['log_id'])
+                    if output is not None:
+                        output.write(json.dumps(outcome, ensure_ascii=False, default=str) + '\n')
+            
+            rows_total += len(rows)
+            if time.perf_counter() - last_report >= 5:
+                last_report = time.perf_counter()
+                logger.info(f"[REGRESSION] {rows_total} rows, {rows_total / (last_report - started):.0f} rows/s")
+    
+    elapsed = time.perf_counter() - started
+    return {
+        'rows': rows_total,
+        'by_kind': counts,
+        'mismatched': sum(kind_counts['mismatch'] for kind_counts in counts.values()),
+        'errors': sum(kind_counts['error'] for kind_counts in counts.values()),
+        'elapsed_seconds': round(elapsed, 3),
+        'rows_per_second': round(rows_total / elapsed, 1) if elapsed else None,
+        'workers': workers,
+        'top_diff_paths': sorted(diff_paths.items(), key=lambda item: item[1], reverse=True)[:REPLAY_DIFF_MAX_ENTRIES],
+        'samples': samples
+    }
+
+
+@app.cli.command('regression-replay')
+@click.option('--from', 'range_from', type=click.DateTime(), default=None)
+@click.option('--to', 'range_to', type=click.DateTime(), default=None)
+@click.option('--kind', 'kinds', type=click.Choice(['receipt', 'status']), multiple=True,
+              default=('receipt', 'status'), show_default=True)
+@click.option('--workers', type=int, default=os.cpu_count() or 1, show_default=True)
+@click.option('--limit', type=int, default=None)
+@click.option('--ignore-key', 'ignore_keys', multiple=True, default=REPLAY_DIFF_IGNORE_KEYS, show_default=True)
+@click.option('--output', type=click.File('w'), default=None, help='NDJSON с расхождениями и ошибками')
+def regression_replay_command(range_from, range_to, kinds, workers, limit, ignore_keys, output):
+    '''Регрессионный прогон конвертера на записанном трафике (без обращений к eKomKassa)'''
+    report = run_regression_replay(range_from, range_to, tuple(kinds), workers, frozenset(ignore_keys), limit, output)
+    click.echo(json.dumps(report, ensure_ascii=False, indent=2))
+    if report['mismatched'] or report['errors']:
+        raise SystemExit(1)
+
+
+# ============================================
+# LIVE TAIL (SSE)
+# ============================================
+# Подписчики воркера: {'queue': Queue, 'filters': dict, 'dropped': int}
+_live_tail_subscribers: list = []
+_live_tail_lock = threading.Lock()
+_live_tail_listener_pid = None
+# Последняя проверка отметки подписчиков в общем хранилище
+_live_tail_presence = {'checked_at': float('-inf'), 'active': False}
+
+
+def mark_live_tail_presence() -> None:
+    '''Отметка в общем хранилище: у воркера есть подписчики, записи логов должны делать NOTIFY'''
+    try:
+        shared_state.set('live_tail:subscribers', True, LIVE_TAIL_PRESENCE_TTL_SECONDS)
+    except SharedStateError as e:
+        logger.warning(f"[LIVE-TAIL] Failed to mark subscribers: {str(e)}")
+
+
+def live_tail_has_subscribers() -> bool:
+    '''Есть ли подписчики хоть на одном узле (проверка общего хранилища кэшируется в воркере)'''
+    if _live_tail_subscribers:
+        return True
+    now = time.monotonic()
+    if now - _live_tail_presence['checked_at'] >= LIVE_TAIL_PRESENCE_CHECK_SECONDS:
+        try:
+            active = bool(shared_state.get('live_tail:subscribers'))
+        except SharedStateError:
+            # Без хранилища не знаем - уведомляем, чтобы live tail не терял события
+            active = True
+        _live_tail_presence.update(checked_at=now, active=active)
+    return _live_tail_presence['active']
+
+
+def notify_live_tail(cur, summary: Dict[str, Any]) -> None:
+    '''NOTIFY со сводкой записи (доставляется слушателям всех воркеров при commit транзакции)'''
+    cur.execute("SELECT pg_notify(%s, %s)", (LIVE_TAIL_CHANNEL, json.dumps(summary, ensure_ascii=False)))
+
+
+def live_tail_matches(summary: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    '''Фильтр подписчика: path - подстрока, status и group_code - точное совпадение'''
+    if filters.get('path') and filters['path'] not in (summary.get('path') or ''):
+        return False
+    if filters.get('status') is not None and summary.get('client_response_status') != filters['status']:
+        return False
+    if filters.get('group_code') and summary.get('group_code') != filters['group_code']:
+        return False
+    return True
+
+
+def broadcast_live_tail(summary: Dict[str, Any]) -> None:
+    '''Раздача события подписчикам без блокировки: при полной очереди событие отбрасывается'''
+    with _live_tail_lock:
+        subscribers = list(_live_tail_subscribers)
+    
+    for subscriber in subscribers:
+        if not live_tail_matches(summary, subscriber['filters']):
+            continue
+        try:
+            subscriber['queue'].put_nowait(summary)
+        except queue.Full:
+            subscriber['dropped'] += 1
+            LIVE_TAIL_DROPPED.inc()
+
+
+def live_tail_listener() -> None:
+    '''Фоновый поток воркера: LISTEN на отдельном соединении (не из пула), переподключение при ошибках'''
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {LIVE_TAIL_CHANNEL}")
+            marked_at = time.monotonic()
+            
+            while True:
+                # Отметка живёт LIVE_TAIL_PRESENCE_TTL_SECONDS: продлеваем, пока есть подписчики
+                if _live_tail_subscribers and time.monotonic() - marked_at >= LIVE_TAIL_KEEPALIVE_SECONDS:
+                    mark_live_tail_presence()
+                    marked_at = time.monotonic()
+                if select.select([conn], [], [], LIVE_TAIL_KEEPALIVE_SECONDS) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    broadcast_live_tail(json.loads(notify.payload))
+        except Exception as e:
+            logger.error(f"[LIVE-TAIL] Listener error: {str(e)}")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def subscribe_live_tail(filters: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''Новый подписчик воркера (None, если достигнут LIVE_TAIL_MAX_CLIENTS); слушатель стартует лениво'''
+    global _live_tail_listener_pid
+    
+    with _live_tail_lock:
+        if len(_live_tail_subscribers) >= LIVE_TAIL_MAX_CLIENTS:
+            return None
         
-        conn = psycopg2.connect(DATABASE_URL)
+        if _live_tail_listener_pid != os.getpid():
+            threading.Thread(target=live_tail_listener, name='live-tail-listener', daemon=True).start()
+            _live_tail_listener_pid = os.getpid()
+        
+        subscriber = {'queue': queue.Queue(maxsize=LIVE_TAIL_QUEUE_SIZE), 'filters': filters, 'dropped': 0}
+        _live_tail_subscribers.append(subscriber)
+    
+    LIVE_TAIL_CLIENTS.inc()
+    mark_live_tail_presence()
+    return subscriber
+
+
+def unsubscribe_live_tail(subscriber: Dict[str, Any]) -> None:
+    '''Удаление подписчика (повторный вызов ничего не делает)'''
+    with _live_tail_lock:
+        if subscriber not in _live_tail_subscribers:
+            return
+        _live_tail_subscribers.remove(subscriber)
+    LIVE_TAIL_CLIENTS.dec()
+
+
+def iter_live_tail_events(subscriber: Dict[str, Any]):
+    '''
+    Поток SSE: событие "log" на каждую запись, комментарий keepalive раз в LIVE_TAIL_KEEPALIVE_SECONDS
+    (он же обнаруживает отключившегося клиента). Потери из-за переполнения сообщаются событием "dropped"
+    '''
+    try:
+        yield 'retry: 3000\n\n'
+        reported_dropped = 0
+        while True:
+            try:
+                summary = subscriber['queue'].get(timeout=LIVE_TAIL_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            
+            if subscriber['dropped'] != reported_dropped:
+                reported_dropped = subscriber['dropped']
+                yield f'event: dropped\ndata: {json.dumps({"dropped": reported_dropped})}\n\n'
+            
+            yield f'id: {summary["id"]}\nevent: log\ndata: {json.dumps(summary, ensure_ascii=False)}\n\n'
+    finally:
+        unsubscribe_live_tail(subscriber)
+
+
+@app.route('/api/request-logs/tail', methods=['GET'])
+@require_auth
+def tail_request_logs():
+    '''
+    Live tail новых записей request_logs через Server-Sent Events (вместо опроса /api/request-logs)
+    Параметры: path (подстрока), status, group_code
+    '''
+    if not DATABASE_URL or not LIVE_TAIL_ENABLED:
+        return jsonify({'error': 'Live tail is not enabled'}), 503
+    
+    filters = {
+        'path': request.args.get('path'),
+        'status': request.args.get('status', type=int),
+        'group_code': request.args['group_code'].lower() if request.args.get('group_code') else None
+    }
+    
+    subscriber = subscribe_live_tail(filters)
+    if subscriber is None:
+        response = jsonify({'error': 'Too many live tail clients'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    
+    response = Response(iter_live_tail_events(subscriber), mimetype='text/event-stream')
+    # Генератор мог не запуститься (клиент отключился сразу) - подписку снимаем и при закрытии ответа
+    response.call_on_close(lambda: unsubscribe_live_tail(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Credentials'] = 'true'
+    return response
+
+
+def histogram_percentile(buckets: list, quantile: float, max_duration_ms: int) -> Optional[int]:
+    '''Оценка перцентиля по гистограмме LATENCY_BUCKETS_MS (линейная интерполяция внутри корзины)'''
+    total = sum(buckets)
+    if not total:
+        return None
+    
+    rank = quantile * total
+    seen = 0
+    for idx, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            lower = LATENCY_BUCKETS_MS[idx - 1] if idx > 0 else 0
+            # Верхняя граница последней корзины неизвестна — берём наблюдаемый максимум
+            upper = LATENCY_BUCKETS_MS[idx] if idx < len(LATENCY_BUCKETS_MS) else max(max_duration_ms, lower)
+            return min(round(lower + (upper - lower) * (rank - seen) / count), max_duration_ms or upper)
+        seen += count
+    return max_duration_ms
+
+
+def summarize_metrics(counts: Dict[str, int], duration_sum_ms: int, max_duration_ms: int, buckets: list) -> Dict[str, Any]:
+    '''Сводка по срезу: количество, доли успехов/ошибок, средняя и перцентили задержки'''
+    total_requests = sum(counts.values())
+    successful_requests = counts.get('2xx', 0)
+    error_requests = counts.get('4xx', 0) + counts.get('5xx', 0)
+    
+    return {
+        'total_requests': total_requests,
+        'successful_requests': successful_requests,
+        'error_requests': error_requests,
+        'success_rate': round(successful_requests / total_requests, 4) if total_requests else None,
+        'error_rate': round(error_requests / total_requests, 4) if total_requests else None,
+        'avg_duration_ms': round(duration_sum_ms / total_requests) if total_requests else 0,
+        'max_duration_ms': max_duration_ms,
+        'p50_duration_ms': histogram_percentile(buckets, 0.50, max_duration_ms),
+        'p90_duration_ms': histogram_percentile(buckets, 0.90, max_duration_ms),
+        'p95_duration_ms': histogram_percentile(buckets, 0.95, max_duration_ms),
+        'p99_duration_ms': histogram_percentile(buckets, 0.99, max_duration_ms)
+    }
+
+
+def query_stats(range_from: Optional[datetime], range_to: Optional[datetime], length: timedelta) -> Dict[str, Any]:
+    '''
+    Агрегирование rollup-таблиц за период с разбивкой по endpoint и group_code.
+    Границы - по часам БД (resolve_time_range), часовой пояс приложения не важен
+    '''
+    with db_connection() as conn:
         cur = conn.cursor()
         
-        query = """
-            SELECT id, created_at, method, url, path, source_ip, 
-                   request_body, target_url, response_status, response_body,
-                   client_response_status, duration_ms, error_message, request_id
-            FROM request_logs WHERE 1=1
-        """
-        params = []
-        
-        if path_filter:
-            query += " AND path LIKE %s"
-            params.append(f'%{path_filter}%')
+        range_from, range_to = resolve_time_range(cur, range_from, range_to, length)
         
-        if status_filter:
-            query += " AND client_response_status = %s"
-            params.append(int(status_filter))
+        # Короткие окна — поминутные срезы, длинные — почасовые
+        if range_to - range_from <= STATS_MINUTE_RANGE_LIMIT:
+            table, granularity = 'request_metrics_minute', 'minute'
+        else:
+            table, granularity = 'request_metrics_hour', 'hour'
         
-        query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+        range_params = (range_from, range_to)
         
-        cur.execute(query, params)
-        rows = cur.fetchall()
+        cur.execute(f"""
+            SELECT endpoint, group_code, status_class,
+                   SUM(request_count), SUM(duration_sum_ms), MAX(duration_max_ms)
+            FROM {table}
+            WHERE bucket_start >= date_trunc('{granularity}', %s::timestamp) AND bucket_start < %s
+            GROUP BY endpoint, group_code, status_class
+        """, range_params)
+        metric_rows = cur.fetchall()
         
-        logs = []
-        for row in rows:
-            logs.append({
-                'id': row[0],
-                'created_at': row[1].isoformat() if row[1] else None,
-                'method': row[2],
-                'url': row[3],
-                'path': row[4],
-                'source_ip': row[5],
-                'request_body': json.loads(row[6]) if row[6] else None,
-                'target_url': row[7],
-                'response_status': row[8],
-                'response_body': json.loads(row[9]) if row[9] else None,
-                'client_response_status': row[10],
-                'duration_ms': row[11],
-                'error_message': row[12],
-                'request_id': row[13]
-            })
+        # Гистограмма суммируется поэлементно по всем срезам окна
+        cur.execute(f"""
+            SELECT m.endpoint, m.group_code, b.idx, SUM(b.value)
+            FROM {table} m, unnest(m.latency_buckets) WITH ORDINALITY AS b(value, idx)
+            WHERE m.bucket_start >= date_trunc('{granularity}', %s::timestamp) AND m.bucket_start < %s
+            GROUP BY m.endpoint, m.group_code, b.idx
+        """, range_params)
+        bucket_rows = cur.fetchall()
         
         cur.close()
-        conn.close()
-        
-        response = jsonify({'logs': logs, 'count': len(logs)})
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Credentials'] = 'true'
-        return response, 200
-        
-    except Exception as e:
-        logger.error(f"Failed to fetch request logs: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+    
+    def empty_slice():
+        return {'counts': {}, 'duration_sum_ms': 0, 'max_duration_ms': 0,
+                'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+    
+    # Срезы: общий итог, по endpoint и по group_code
+    overall = empty_slice()
+    by_endpoint: Dict[str, Dict] = {}
+    by_group_code: Dict[str, Dict] = {}
+    
+    for endpoint, group_code, status_class, count, duration_sum, duration_max in metric_rows:
+        for target in (overall, by_endpoint.setdefault(endpoint, empty_slice()),
+                       by_group_code.setdefault(group_code, empty_slice())):
+            target['counts'][status_class] = target['counts'].get(status_class, 0) + int(count or 0)
+            target['duration_sum_ms'] += int(duration_sum or 0)
+            target['max_duration_ms'] = max(target['max_duration_ms'], int(duration_max or 0))
+    
+    for endpoint, group_code, idx, value in bucket_rows:
+        if not 1 <= idx <= len(LATENCY_BUCKETS_MS) + 1:
+            continue
+        for target in (overall, by_endpoint.setdefault(endpoint, empty_slice()),
+                       by_group_code.setdefault(group_code, empty_slice())):
+            target['buckets'][idx - 1] += int(value or 0)
+    
+    def summarize(slice_data):
+        return summarize_metrics(slice_data['counts'], slice_data['duration_sum_ms'],
+                                 slice_data['max_duration_ms'], slice_data['buckets'])
+    
+    bucket_labels = [f'le_{bound}' for bound in LATENCY_BUCKETS_MS] + [f'gt_{LATENCY_BUCKETS_MS[-1]}']
+    
+    result = {
+        'from': range_from.isoformat(),
+        'to': range_to.isoformat(),
+        'granularity': granularity
+    }
+    result.update(summarize(overall))
+    result['latency_histogram'] = dict(zip(bucket_labels, overall['buckets']))
+    result['by_endpoint'] = [
+        dict({'endpoint': endpoint}, **summarize(slice_data))
+        for endpoint, slice_data in sorted(by_endpoint.items())
+    ]
+    result['by_group_code'] = [
+        dict({'group_code': group_code or None}, **summarize(slice_data))
+        for group_code, slice_data in sorted(by_group_code.items())
+    ]
+    return result
 
 
-@app.route('/api/request-logs/<int:log_id>', methods=['GET'])
+def get_cached_stats(cache_key: str, range_from: Optional[datetime], range_to: Optional[datetime],
+                     length: timedelta) -> tuple:
+    '''Статистика из общего кэша узлов с коротким TTL. Возвращает (result, cache_hit)'''
+    try:
+        cached = shared_state.get(cache_key)
+        if cached is None:
+            # Под блокировкой: одновременные запросы одного окна на всех узлах ждут один расчёт, а не делают свои
+            with shared_state.lock(cache_key, STATS_CACHE_LOCK_WAIT_SECONDS) as acquired:
+                cached = shared_state.get(cache_key)
+                if cached is None:
+                    if not acquired:
+                        # Расчёт на другом узле не уложился в ожидание: считаем сами, чтобы не отвечать ошибкой
+                        logger.info(f"[STATS] Lock wait for {cache_key} timed out, computing without it")
+                    CACHE_REQUESTS.labels(cache='stats', result='miss').inc()
+                    result = query_stats(range_from, range_to, length)
+                    shared_state.set(cache_key, result, STATS_CACHE_TTL_SECONDS)
+                    return result, False
+    except SharedStateError as e:
+        logger.warning(f"[STATS] Shared cache unavailable: {str(e)}")
+        CACHE_REQUESTS.labels(cache='stats', result='miss').inc()
+        return query_stats(range_from, range_to, length), False
+    
+    CACHE_REQUESTS.labels(cache='stats', result='hit').inc()
+    return cached, True
+
+
+@app.route('/api/stats', methods=['GET'])
 @require_auth
-def get_request_log_detail(log_id):
-    '''Получить детальную информацию об одном запросе'''
+def get_stats():
+    '''
+    Статистика запросов из rollup-таблиц (без сканирования request_logs)
+    Параметры: window=5m|1h|24h|7d или from/to в ISO 8601
+    '''
     try:
         if not DATABASE_URL:
             return jsonify({'error': 'Database not configured'}), 500
         
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT id, created_at, method, url, path, source_ip, user_agent,
-                   request_headers, request_body,
-                   target_url, target_method, target_headers, target_body,
-                   response_status, response_headers, response_body,
-                   client_response_status, client_response_body,
-                   duration_ms, error_message, request_id
-            FROM request_logs WHERE id = %s
-        """, (log_id,))
-        
-        row = cur.fetchone()
-        
-        if not row:
-            cur.close()
-            conn.close()
-            return jsonify({'error': 'Log not found'}), 404
-        
-        log_detail = {
-            'id': row[0],
-            'created_at': row[1].isoformat() if row[1] else None,
-            'method': row[2],
-            'url': row[3],
-            'path': row[4],
-            'source_ip': row[5],
-            'user_agent': row[6],
-            'request_headers': json.loads(row[7]) if row[7] else None,
-            'request_body': json.loads(row[8]) if row[8] else None,
-            'target_url': row[9],
-            'target_method': row[10],
-            'target_headers': json.loads(row[11]) if row[11] else None,
-            'target_body': json.loads(row[12]) if row[12] else None,
-            'response_status': row[13],
-            'response_headers': json.loads(row[14]) if row[14] else None,
-            'response_body': json.loads(row[15]) if row[15] else None,
-            'client_response_status': row[16],
-            'client_response_body': json.loads(row[17]) if row[17] else None,
-            'duration_ms': row[18],
-            'error_message': row[19],
-            'request_id': row[20]
-        }
+        if request.args.get('from') or request.args.get('to'):
+            # Недостающая граница считается от текущего времени БД (см. query_stats)
+            try:
+                range_to = datetime.fromisoformat(request.args['to']) if request.args.get('to') else None
+                range_from = datetime.fromisoformat(request.args['from']) if request.args.get('from') else None
+            except ValueError:
+                return jsonify({'error': 'from/to must be ISO 8601 datetimes'}), 400
+            window = None
+            length = STATS_WINDOWS[STATS_DEFAULT_WINDOW]
+            cache_key = (f'stats:range:{range_from.isoformat() if range_from else ""}'
+                         f':{range_to.isoformat() if range_to else "now"}')
+        else:
+            window = request.args.get('window', STATS_DEFAULT_WINDOW)
+            if window not in STATS_WINDOWS:
+                return jsonify({'error': f'window must be one of: {", ".join(STATS_WINDOWS)}'}), 400
+            range_from = range_to = None
+            length = STATS_WINDOWS[window]
+            cache_key = f'stats:window:{window}'
         
-        cur.close()
-        conn.close()
+        result, cache_hit = get_cached_stats(cache_key, range_from, range_to, length)
         
-        response = jsonify(log_detail)
+        response = jsonify(dict(result, window=window, cached=cache_hit))
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.headers['Cache-Control'] = f'private, max-age={int(STATS_CACHE_TTL_SECONDS)}'
         return response, 200
-        
+    
     except Exception as e:
-        logger.error(f"Failed to fetch request log detail: {str(e)}")
+        logger.error(f"Failed to fetch stats: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/request-logs/<int:log_id>/replay', methods=['POST'])
-@require_auth
-def replay_request(log_id):
-    '''Повторить запрос из истории'''
+# Запросы, обрабатываемые воркером сейчас (занятые потоки gthread)
+active_requests = 0
+active_requests_lock = threading.Lock()
+
+
+@app.before_request
+def start_request_timer():
+    global active_requests
+    g.request_started = time.perf_counter()
+    g.request_deadline = time.monotonic() + request_deadline_budget()
+    with active_requests_lock:
+        active_requests += 1
+    g.request_active = True
+
+
+def release_active_request() -> None:
+    global active_requests
+    with active_requests_lock:
+        active_requests -= 1
+
+
+@app.after_request
+def hold_active_request_while_streaming(response):
+    '''Потоковый ответ (SSE, экспорт) занимает поток, пока тело не отдано: для readiness он ещё активен'''
+    if response.is_streamed and g.pop('request_active', False):
+        response.call_on_close(release_active_request)
+    return response
+
+
+@app.teardown_request
+def finish_active_request(exc):
+    if g.pop('request_active', False):
+        release_active_request()
+
+
+@app.before_request
+def enter_bulkhead():
+    '''Занимает место в bulkhead класса endpoint и клиента; при переполнении отвечает сразу, без очереди'''
+    if not BULKHEADS or request.method == 'OPTIONS':
+        return None
+    
+    endpoint_class = bulkhead_class_for(request.path, request.url_rule.rule if request.url_rule else None)
+    if endpoint_class is None:
+        return None
+    
+    bulkhead = BULKHEADS[endpoint_class]
+    if not bulkhead.try_acquire():
+        BULKHEAD_REJECTED.labels(endpoint_class=endpoint_class, reason='class').inc()
+        return bulkhead_rejection(endpoint_class, 503, 'Сервис перегружен, повторите запрос позже')
+    g.bulkhead = bulkhead
+    
+    if endpoint_class != 'admin' and BULKHEAD_CLIENT_LIMIT > 0:
+        client_key = request.args.get('AuthToken') or request.headers.get('X-Real-IP', request.remote_addr) or ''
+        if not acquire_client_slot(client_key):
+            BULKHEAD_REJECTED.labels(endpoint_class=endpoint_class, reason='client').inc()
+            return bulkhead_rejection(endpoint_class, 429, 'Слишком много одновременных запросов, повторите запрос позже')
+        g.bulkhead_client = client_key
+    return None
+
+
+def bulkhead_rejection(endpoint_class: str, status_code: int, message: str):
+    '''Отказ bulkhead: в формате Ferma для API кассы, {'error': ...} для админки'''
+    if endpoint_class == 'admin':
+        response = jsonify({'error': message})
+    else:
+        response = jsonify(create_ferma_response('Failed', error={'Code': status_code, 'Message': message}))
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Retry-After'] = '1'
+    return response, status_code
+
+
+def release_bulkhead_slots(client_key: Optional[str], bulkhead: Optional[Bulkhead]) -> None:
+    if client_key is not None:
+        release_client_slot(client_key)
+    if bulkhead is not None:
+        bulkhead.release()
+
+
+@app.after_request
+def hold_bulkhead_while_streaming(response):
+    '''Потоковый ответ (экспорт, страницы логов) занимает место, пока тело не отдано: teardown наступает раньше'''
+    if response.is_streamed and ('bulkhead' in g or 'bulkhead_client' in g):
+        slots = (g.pop('bulkhead_client', None), g.pop('bulkhead', None))
+        response.call_on_close(lambda: release_bulkhead_slots(*slots))
+    return response
+
+
+@app.teardown_request
+def leave_bulkhead(exc):
+    release_bulkhead_slots(g.pop('bulkhead_client', None), g.pop('bulkhead', None))
+
+
+@app.before_request
+def start_request_span():
+    '''Корневой span запроса; родитель берётся из входящего traceparent'''
+    tracer = get_tracer()
+    if tracer is None or request.path in OTEL_EXCLUDED_PATHS:
+        return
+    
+    # Геттер пропагатора чувствителен к регистру, а traceparent передаётся в нижнем
+    parent_context = otel_propagate.extract({key.lower(): value for key, value in request.headers.items()})
+    span = tracer.start_span(
+        f'{request.method} {request.url_rule.rule if request.url_rule else request.path}',
+        context=parent_context,
+        kind=SpanKind.SERVER,
+        attributes={
+            'http.method': request.method,
+            'http.target': request.path,
+            'gateway.request_id': request.headers.get('X-Request-ID', '')
+        }
+    )
+    g.request_span = span
+    g.request_span_token = otel_context.attach(otel_trace.set_span_in_context(span))
+
+
+@app.after_request
+def observe_request_metrics(response):
+    '''Метрики по каждому запросу: полное время обработки, ошибки в формате Ferma, Server-Timing'''
+    started = g.get('request_started')
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    
+    if started is not None:
+        REQUEST_DURATION.labels(
+            endpoint=endpoint,
+            method=request.method,
+            status_class=status_class_for(response.status_code)
+        ).observe(time.perf_counter() - started)
+    
+    if response.status_code >= 400 and response.is_json and not response.direct_passthrough:
+        body = response.get_json(silent=True)
+        if isinstance(body, dict) and body.get('Status') == 'Failed':
+            error = body.get('Error') if isinstance(body.get('Error'), dict) else {}
+            FERMA_ERRORS.labels(endpoint=endpoint, code=str(error.get('Code'))).inc()
+    
+    span = g.get('request_span')
+    if span is not None:
+        span.set_attribute('http.status_code', response.status_code)
+        if response.status_code >= 500:
+            span.set_status(Status(StatusCode.ERROR))
+    
+    if SERVER_TIMING_ENABLED and started is not None:
+        timings = current_phase_timings()
+        entries = [f'{phase};dur={timings[phase]:.1f}' for phase in REQUEST_PHASES if phase in timings]
+        entries.append(f'total;dur={(time.perf_counter() - started) * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+    
+    return response
+
+
+@app.teardown_request
+def end_request_span(exc):
+    span = g.pop('request_span', None)
+    if span is None:
+        return
+    
+    if exc is not None:
+        span.record_exception(exc)
+        span.set_status(Status(StatusCode.ERROR))
+    otel_context.detach(g.pop('request_span_token'))
+    span.end()
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    '''Метрики Prometheus (в multiprocess режиме собираются со всех gunicorn воркеров)'''
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    
+    return app.response_class(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+# ============================================
+# LIVENESS AND READINESS
+# ============================================
+_readiness_cache = {'expires_at': 0.0, 'report': None}
+_readiness_lock = threading.Lock()
+
+
+def check_database() -> Dict[str, Any]:
+    '''
+    Свободное соединение в пуле воркера и ответ БД на SELECT 1: новое соединение ограничено
+    DB_CONNECT_TIMEOUT_SECONDS, запрос - statement_timeout
+    '''
+    if not DATABASE_URL:
+        return {'ok': True, 'skipped': True}
+    
+    result = {'pool_in_use': db_connections_in_use, 'pool_max': DB_POOL_MAX_CONNECTIONS}
+    if db_connections_in_use >= DB_POOL_MAX_CONNECTIONS:
+        return {'ok': False, **result, 'error': 'Connection pool exhausted'}
+    
+    started = time.perf_counter()
     try:
-        if not DATABASE_URL:
-            return jsonify({'error': 'Database not configured'}), 500
-        
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT target_url, target_method, target_body
-            FROM request_logs WHERE id = %s
-        """, (log_id,))
-        
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
-        
-        if not row:
-            return jsonify({'error': 'Log not found'}), 404
-        
-        target_url, target_method, target_body = row
-        
-        if not target_url:
-            return jsonify({'error': 'No target URL in log'}), 400
-        
-        # Повторяем запрос
-        start_time = time.time()
-        headers = {'Content-Type': 'application/json'}
-        
-        try:
-            body = json.loads(target_body) if target_body else {}
-        except:
-            body = {}
-        
-        try:
-            if target_method == 'GET':
-                resp = requests.get(target_url, headers=headers, timeout=30)
-            else:
-                resp = requests.post(target_url, headers=headers, json=body, timeout=30)
-            
-            duration_ms = int((time.time() - start_time) * 1000)
-            
-            try:
-                response_body = resp.json()
-            except:
-                response_body = {'raw': resp.text}
-            
-            return jsonify({
-                'success': True,
-                'status': resp.status_code,
-                'body': response_body,
-                'duration_ms': duration_ms
-            }), 200
-            
-        except requests.RequestException as e:
-            duration_ms = int((time.time() - start_time) * 1000)
-            return jsonify({
-                'success': False,
-                'error': str(e),
-                'duration_ms': duration_ms
-            }), 502
-        
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SET LOCAL statement_timeout = %s', (HEALTH_DB_TIMEOUT_MS,))
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
     except Exception as e:
-        logger.error(f"Failed to replay request: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return {'ok': False, **result, 'error': str(e)[:200]}
+    return {'ok': True, **result, 'duration_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+
+def readiness_report() -> Dict[str, Any]:
+    '''
+    Проверки готовности воркера: БД, запись логов, занятость потоков. Circuit breaker'ы eKomKassa - только
+    для информации: при сбое eKomKassa узел должен отвечать быстрыми 503 и сохранёнными статусами, а не
+    выпадать из балансировки вместе со всеми остальными.
+    Одновременные пробы ждут одного вычисления (не дольше HEALTH_PROBE_WAIT_SECONDS), результат живёт
+    HEALTH_CACHE_SECONDS
+    '''
+    if not _readiness_lock.acquire(timeout=HEALTH_PROBE_WAIT_SECONDS):
+        return {
+            'status': 'not_ready',
+            'timestamp': datetime.now().isoformat(),
+            'pid': os.getpid(),
+            'checks': {'database': {'ok': False, 'error': 'Previous readiness check is still running'}}
+        }
+    try:
+        if _readiness_cache['report'] is not None and time.monotonic() < _readiness_cache['expires_at']:
+            return _readiness_cache['report']
+        
+        open_circuits = [operation for operation, breaker in CIRCUIT_BREAKERS.items() if breaker.state == 'open']
+        # Сама проба занимает один поток
+        busy_threads = active_requests - 1
+        checks = {
+            'database': check_database(),
+            'log_writes': {
+                'ok': log_write_health['consecutive_failures'] < HEALTH_LOG_WRITE_FAILURES,
+                **log_write_health
+            },
+            'workers': {
+                'ok': busy_threads < WORKER_THREADS - 1,
+                'busy_threads': busy_threads,
+                'threads': WORKER_THREADS
+            }
+        }
+        report = {
+            'status': 'ready' if all(check['ok'] for check in checks.values()) else 'not_ready',
+            'timestamp': datetime.now().isoformat(),
+            'pid': os.getpid(),
+            'checks': checks,
+            'upstream': {'open_circuits': open_circuits}
+        }
+        _readiness_cache.update(report=report, expires_at=time.monotonic() + HEALTH_CACHE_SECONDS)
+        return report
+    finally:
+        _readiness_lock.release()
+
+
+@app.route('/health/live', methods=['GET'])
+def health_live():
+    '''Liveness: процесс отвечает на запросы; от БД и eKomKassa не зависит (их сбой перезапуск не исправит)'''
+    return jsonify({'status': 'ok', 'timestamp': datetime.now().isoformat(), 'pid': os.getpid()}), 200
+
+
+@app.route('/health/ready', methods=['GET'])
+def health_ready():
+    '''Readiness: 503, пока воркер не может обслуживать запросы (балансировщик уводит с него трафик)'''
+    report = readiness_report()
+    if report['status'] == 'ready':
+        return jsonify(report), 200
+    response = jsonify(report)
+    response.headers['Retry-After'] = str(max(1, math.ceil(HEALTH_CACHE_SECONDS)))
+    return response, 503
 
 
 # Health check
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'ok', 'timestamp': datetime.now().isoformat()}), 200
+    '''Состояние шлюза; circuit breaker, bulkhead и проверки eKomKassa - состояние воркера, обработавшего запрос'''
+    ensure_upstream_prober()
+    circuits = {operation: breaker.snapshot() for operation, breaker in CIRCUIT_BREAKERS.items()}
+    bulkheads = {endpoint_class: bulkhead.snapshot() for endpoint_class, bulkhead in BULKHEADS.items()}
+    upstreams = {
+        name: [endpoint.snapshot() for endpoint in pool.endpoints] for name, pool in UPSTREAM_POOLS.items()
+    }
+    degraded = (
+        any(circuit['state'] != 'closed' for circuit in circuits.values())
+        or any(not any(endpoint['available'] for endpoint in endpoints) for endpoints in upstreams.values())
+    )
+    return jsonify({
+        'status': 'degraded' if degraded else 'ok',
+        'timestamp': datetime.now().isoformat(),
+        'circuits': circuits,
+        'bulkheads': bulkheads,
+        'upstreams': upstreams
+    }), 200
 
 
 # ============================================
 # REQUEST LOGS WEB VIEW
 # ============================================
-@app.route('/request-logs')
-def view_request_logs():
-    '''Display request logs in HTML table'''
-    try:
-        if not DATABASE_URL:
-            return "<h1>Database not configured</h1>", 500
-        
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT id, created_at, method, path, source_ip, 
-                   request_body, client_response_status, 
-                   client_response_body, duration_ms
-            FROM request_logs 
-            ORDER BY id DESC 
-            LIMIT 100
-        """)
-        
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        html = '''
+VIEW_PAGE_HEAD = '''
 <!DOCTYPE html>
 <html>
 <head>
+    <meta charset="utf-8">
     <title>Request Logs</title>
     <style>
         body { font-family: Arial, sans-serif; margin: 20px; background: #f5f5f5; }
         h1 { color: #333; }
+        form { margin-bottom: 15px; }
+        form input { margin-right: 10px; }
         table { width: 100%; border-collapse: collapse; background: white; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
         th { background: #4CAF50; color: white; padding: 12px; text-align: left; position: sticky; top: 0; }
         td { padding: 10px; border-bottom: 1px solid #ddd; }
         tr:hover { background: #f9f9f9; }
-        .json { font-family: monospace; font-size: 12px; max-width: 300px; overflow: auto; }
+        .json { font-family: monospace; font-size: 12px; max-width: 300px; overflow: auto; word-break: break-all; }
         .status-200 { color: green; font-weight: bold; }
         .status-500 { color: red; font-weight: bold; }
         .status-other { color: orange; font-weight: bold; }
+        .nav { margin: 15px 0; }
+        .nav a { margin-right: 15px; }
     </style>
 </head>
 <body>
-    <h1>📊 Request Logs (Last 100)</h1>
+    <h1>📊 Request Logs</h1>
+'''
+
+VIEW_TABLE_HEAD = '''
     <table>
         <tr>
             <th>ID</th>
@@ -1548,36 +5709,136 @@ def view_request_logs():
             <th>Duration (ms)</th>
         </tr>
 '''
-        
-        for row in rows:
-            id_, created_at, method, path, source_ip, req_body, status, resp_body, duration = row
-            
-            status_class = 'status-200' if status == 200 else ('status-500' if status >= 500 else 'status-other')
-            
-            html += f'''
+
+
+def sql_preview(column: str) -> str:
+    '''SQL выражение превью JSONB колонки: в воркер попадает не больше VIEW_PREVIEW_CHARS символов'''
+    return (f"CASE WHEN length({column}::text) > {VIEW_PREVIEW_CHARS} "
+            f"THEN left({column}::text, {VIEW_PREVIEW_CHARS}) || '…' ELSE {column}::text END")
+
+
+def view_row_html(row: tuple) -> str:
+    '''Строка таблицы /request-logs (все значения экранируются)'''
+    id_, created_at, method, path, source_ip, req_body, status, resp_body, duration = row
+    status_class = 'status-200' if status == 200 else ('status-500' if (status or 500) >= 500 else 'status-other')
+    
+    return f'''
         <tr>
-            <td>{id_}</td>
+            <td><a href="/api/request-logs/{id_}">{id_}</a></td>
             <td>{created_at}</td>
-            <td><strong>{method}</strong></td>
-            <td>{path}</td>
-            <td>{source_ip}</td>
-            <td class="json">{req_body or '-'}</td>
+            <td><strong>{html.escape(method or '')}</strong></td>
+            <td>{html.escape(path or '')}</td>
+            <td>{html.escape(source_ip or '')}</td>
+            <td class="json">{html.escape(req_body) if req_body else '-'}</td>
             <td class="{status_class}">{status}</td>
-            <td class="json">{resp_body or '-'}</td>
+            <td class="json">{html.escape(resp_body) if resp_body else '-'}</td>
             <td>{duration or '-'}</td>
         </tr>
 '''
-        
-        html += '''
+
+
+def iter_request_logs_view(query: str, params: list, page_size: int, filters: Dict[str, str]):
+    '''
+    Генератор HTML страницы: шапка уходит сразу, строки - батчами из server-side курсора
+    Запрос выбирает page_size + 1 строк: лишняя строка только показывает, что есть более старая страница
+    '''
+    yield VIEW_PAGE_HEAD
+    yield f'''
+    <form method="get" action="/request-logs">
+        Path: <input name="path" value="{html.escape(filters.get('path', ''))}">
+        Status: <input name="status" size="4" value="{html.escape(filters.get('status', ''))}">
+        GroupCode: <input name="group_code" size="8" value="{html.escape(filters.get('group_code', ''))}">
+        Rows: <input name="limit" size="4" value="{page_size}">
+        <button type="submit">Показать</button>
+    </form>
+    <div class="nav"><a href="/request-logs?{html.escape(urlencode(filters))}">Новые</a></div>
+'''
+    yield VIEW_TABLE_HEAD
+    
+    shown = 0
+    first_id = last_id = None
+    has_older = False
+    for rows in iter_cursor_batches(query, params, 50, 'request_logs_view'):
+        chunk = []
+        for row in rows:
+            if shown == page_size:
+                has_older = True
+                break
+            chunk.append(view_row_html(row))
+            first_id = row[0] if first_id is None else first_id
+            last_id = row[0]
+            shown += 1
+        yield ''.join(chunk)
+    
+    navigation = []
+    if first_id is not None:
+        navigation.append(f'<a href="/request-logs?{html.escape(urlencode(dict(filters, after_id=first_id)))}">← Новее</a>')
+    if has_older:
+        navigation.append(f'<a href="/request-logs?{html.escape(urlencode(dict(filters, before_id=last_id)))}">Старше →</a>')
+    
+    yield f'''
     </table>
+    <div class="nav">{''.join(navigation)}</div>
 </body>
 </html>
 '''
-        return html
+
+
+@app.route('/request-logs')
+def view_request_logs():
+    '''
+    HTML таблица request_logs с постраничной навигацией по id (keyset, без OFFSET)
+    Параметры: before_id / after_id, limit, path, status, group_code
+    '''
+    try:
+        if not DATABASE_URL:
+            return "<h1>Database not configured</h1>", 500
+        
+        page_size = min(int(request.args.get('limit', VIEW_PAGE_SIZE_DEFAULT)), VIEW_PAGE_SIZE_MAX)
+        filters = {
+            key: request.args[key] for key in ('path', 'status', 'group_code') if request.args.get(key)
+        }
+        if page_size != VIEW_PAGE_SIZE_DEFAULT:
+            filters['limit'] = str(page_size)
+        
+        conditions, params = request_log_filter_conditions(filters)
+        
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
+        
+        # Страница "новее": граница - строка, следующая за page_size строками после after_id
+        if after_id is not None and before_id is None:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    f"SELECT id FROM request_logs WHERE {' AND '.join(conditions + ['id > %s'])} "
+                    "ORDER BY id LIMIT 1 OFFSET %s",
+                    params + [after_id, page_size]
+                )
+                row = cur.fetchone()
+                cur.close()
+            before_id = row[0] if row else None
+        
+        if before_id is not None:
+            conditions.append("id < %s")
+            params.append(before_id)
+        
+        query = f"""
+            SELECT id, created_at, method, path, source_ip,
+                   {sql_preview('request_body')}, client_response_status,
+                   {sql_preview('client_response_body')}, duration_ms
+            FROM request_logs
+            {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+            ORDER BY id DESC
+            LIMIT %s
+        """
+        params.append(page_size + 1)
+        
+        return Response(iter_request_logs_view(query, params, page_size, filters), mimetype='text/html')
         
     except Exception as e:
         logger.error(f"Failed to load request logs: {str(e)}")
-        return f"<h1>Error loading logs</h1><p>{str(e)}</p>", 500
+        return f"<h1>Error loading logs</h1><p>{html.escape(str(e))}</p>", 500
 
 
 # ============================================
@@ -0,0 +1,25 @@
+# Конфигурация gunicorn для eKomKassa Gateway
+# Параметры запуска (bind, workers, timeout, логи) заданы в ekomkassa-gateway.service,
+# здесь - хуки жизненного цикла воркеров.
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+# Access log без строки запроса (%(U)s вместо %(r)s): в ней секреты - ?AuthToken=... у статусов
+# и ?key=... у результатов чеков от eKomKassa
+access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(m)s %(U)s %(H)s" %(s)s %(b)s "%(f)s" "%(a)s"'
+
+
+def on_starting(server):
+    '''Очистка метрик Prometheus от прошлого запуска (multiprocess режим)'''
+    metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    '''Метрики-gauge завершившегося воркера больше не учитываются'''
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,73 @@
+-- Агрегаты (rollup) для статистики: поминутные и почасовые срезы
+-- Обновляются инкрементально при записи каждого запроса в request_logs,
+-- поэтому статистика не требует сканирования всей истории логов.
+
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS group_code VARCHAR(50);
+
+CREATE INDEX IF NOT EXISTS idx_request_logs_group_code ON request_logs(group_code);
+
+CREATE TABLE IF NOT EXISTS request_metrics_minute (
+    bucket_start TIMESTAMP NOT NULL,
+
+    -- Измерения
+    endpoint TEXT NOT NULL,
+    group_code VARCHAR(50) NOT NULL DEFAULT '',
+    status_class VARCHAR(3) NOT NULL,  -- 2xx / 4xx / 5xx
+
+    -- Метрики
+    request_count INTEGER NOT NULL DEFAULT 0,
+    duration_sum_ms BIGINT NOT NULL DEFAULT 0,
+    duration_max_ms INTEGER NOT NULL DEFAULT 0,
+
+    -- Гистограмма задержек: корзины LATENCY_BUCKETS_MS из app.py + корзина "больше"
+    latency_buckets INTEGER[] NOT NULL,
+
+    PRIMARY KEY (bucket_start, endpoint, group_code, status_class)
+);
+
+CREATE TABLE IF NOT EXISTS request_metrics_hour (
+    bucket_start TIMESTAMP NOT NULL,
+
+    endpoint TEXT NOT NULL,
+    group_code VARCHAR(50) NOT NULL DEFAULT '',
+    status_class VARCHAR(3) NOT NULL,
+
+    request_count INTEGER NOT NULL DEFAULT 0,
+    duration_sum_ms BIGINT NOT NULL DEFAULT 0,
+    duration_max_ms INTEGER NOT NULL DEFAULT 0,
+
+    latency_buckets INTEGER[] NOT NULL,
+
+    PRIMARY KEY (bucket_start, endpoint, group_code, status_class)
+);
+
+-- Поминутные срезы нужны только для коротких окон, их можно периодически чистить:
+-- DELETE FROM request_metrics_minute WHERE bucket_start < NOW() - INTERVAL '2 days';
+
+-- Заполнение почасовых срезов по уже накопленной истории (однократно при миграции)
+INSERT INTO request_metrics_hour (
+    bucket_start, endpoint, group_code, status_class,
+    request_count, duration_sum_ms, duration_max_ms, latency_buckets
+)
+SELECT
+    date_trunc('hour', created_at),
+    path,
+    '',
+    COALESCE((client_response_status / 100)::TEXT || 'xx', '5xx'),
+    COUNT(*),
+    COALESCE(SUM(duration_ms), 0),
+    COALESCE(MAX(duration_ms), 0),
+    ARRAY[
+        COUNT(*) FILTER (WHERE COALESCE(duration_ms, 0) <= 50),
+        COUNT(*) FILTER (WHERE duration_ms > 50 AND duration_ms <= 100),
+        COUNT(*) FILTER (WHERE duration_ms > 100 AND duration_ms <= 250),
+        COUNT(*) FILTER (WHERE duration_ms > 250 AND duration_ms <= 500),
+        COUNT(*) FILTER (WHERE duration_ms > 500 AND duration_ms <= 1000),
+        COUNT(*) FILTER (WHERE duration_ms > 1000 AND duration_ms <= 2500),
+        COUNT(*) FILTER (WHERE duration_ms > 2500 AND duration_ms <= 5000),
+        COUNT(*) FILTER (WHERE duration_ms > 5000 AND duration_ms <= 10000),
+        COUNT(*) FILTER (WHERE duration_ms > 10000)
+    ]::INTEGER[]
+FROM request_logs
+GROUP BY 1, 2, 3, 4
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,20 @@
+-- Разбивка времени обработки запроса по фазам (мс)
+-- Позволяет понять, на что ушло время медленного запроса: разбор JSON, конвертация,
+-- соединение/ожидание ответа eKomKassa, сериализация ответа или запись логов.
+
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS phase_parse_ms REAL;
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS phase_convert_ms REAL;
+
+-- Установка соединения с eKomKassa (0 - переиспользовано keep-alive соединение)
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS phase_upstream_connect_ms REAL;
+
+-- От отправки запроса до получения заголовков ответа eKomKassa
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS phase_upstream_ttfb_ms REAL;
+
+-- Запрос к eKomKassa целиком, включая чтение тела ответа
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS phase_upstream_ms REAL;
+
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS phase_serialize_ms REAL;
+
+-- Запись логов, выполненная до вставки этой строки
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS phase_log_ms REAL;
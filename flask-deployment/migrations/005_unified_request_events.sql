@@ -0,0 +1,81 @@
+-- Единая запись о запросе: request_logs хранит и поля старой таблицы logs,
+-- а logs становится представлением над ней (раньше на один чек писалось 2 строки в logs + 1 в request_logs)
+
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS function_name VARCHAR(50);
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS log_level VARCHAR(20);
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS message TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_request_logs_function_created
+    ON request_logs(function_name, created_at DESC) WHERE function_name IS NOT NULL;
+
+-- Старые строки logs сохраняются в logs_legacy и остаются видны через представление
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = current_schema() AND tablename = 'logs') THEN
+        ALTER TABLE logs RENAME TO logs_legacy;
+
+        -- id в представлении должны быть уникальны: переносим logs_legacy на последовательность request_logs
+        PERFORM setval('request_logs_id_seq', GREATEST(
+            (SELECT COALESCE(MAX(id), 0) FROM request_logs),
+            (SELECT COALESCE(MAX(id), 0) FROM logs_legacy),
+            1
+        ));
+        UPDATE logs_legacy SET id = nextval('request_logs_id_seq');
+        ALTER TABLE logs_legacy ALTER COLUMN id SET DEFAULT nextval('request_logs_id_seq');
+        DROP SEQUENCE IF EXISTS logs_id_seq;
+    END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS logs_legacy (
+    id INTEGER PRIMARY KEY DEFAULT nextval('request_logs_id_seq'),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    function_name VARCHAR(50) NOT NULL,
+    log_level VARCHAR(20) NOT NULL,
+    message TEXT NOT NULL,
+    request_data JSONB,
+    response_data JSONB,
+    request_id VARCHAR(100),
+    duration_ms INTEGER,
+    status_code INTEGER
+);
+
+-- Представление в форме старой таблицы logs для /api/logs, backend/get-logs и backend/get-stats.
+-- Строки request_logs без function_name (proxy_and_log, записи до миграции) в logs не попадали и здесь не видны
+CREATE OR REPLACE VIEW logs AS
+SELECT
+    id, created_at, function_name, log_level, message,
+    request_data, response_data, request_id, duration_ms, status_code
+FROM logs_legacy
+UNION ALL
+SELECT
+    r.id,
+    r.created_at,
+    r.function_name,
+    COALESCE(r.log_level, 'INFO'),
+    COALESCE(r.message, ''),
+    r.request_body,
+    CASE WHEN r.client_response_body IS NOT NULL OR r.response_body IS NOT NULL
+         THEN jsonb_build_object('ferma_format', r.client_response_body, 'ekomkassa_raw', r.response_body)
+    END,
+    r.request_id,
+    r.duration_ms,
+    COALESCE(r.response_status, r.client_response_status)
+FROM request_logs r
+WHERE r.function_name IS NOT NULL;
+
+-- Запись в logs (старые версии приложения во время обновления) попадает в logs_legacy
+CREATE OR REPLACE FUNCTION logs_insert_legacy() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO logs_legacy (created_at, function_name, log_level, message,
+                             request_data, response_data, request_id, duration_ms, status_code)
+    VALUES (COALESCE(NEW.created_at, CURRENT_TIMESTAMP), NEW.function_name, NEW.log_level, NEW.message,
+            NEW.request_data, NEW.response_data, NEW.request_id, NEW.duration_ms, NEW.status_code)
+    RETURNING id INTO NEW.id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS logs_insert_legacy ON logs;
+CREATE TRIGGER logs_insert_legacy
+    INSTEAD OF INSERT ON logs
+    FOR EACH ROW EXECUTE FUNCTION logs_insert_legacy();
@@ -0,0 +1,6 @@
+-- Холодное хранение payload: после переноса в архив колонки тел обнуляются,
+-- archive_segment указывает на сегмент в ARCHIVE_DIR (<сегмент>.ndjson.zst + <сегмент>.idx.json)
+ALTER TABLE request_logs ADD COLUMN IF NOT EXISTS archive_segment VARCHAR(64);
+
+-- Кандидаты на архивацию: частичный индекс остаётся маленьким, так как содержит только свежие строки
+CREATE INDEX IF NOT EXISTS idx_request_logs_unarchived ON request_logs(id) WHERE archive_segment IS NULL;
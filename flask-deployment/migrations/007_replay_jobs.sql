@@ -0,0 +1,38 @@
+-- Пакетный повтор запросов из request_logs (/api/replay-jobs)
+CREATE TABLE IF NOT EXISTS replay_jobs (
+    id SERIAL PRIMARY KEY,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    -- Обновляется потоком задания с каждым батчем; давно не обновлялся - задание прервано перезапуском
+    heartbeat_at TIMESTAMP,
+
+    -- running / cancelling / cancelled / done / failed
+    status VARCHAR(20) NOT NULL,
+    filters JSONB,
+    options JSONB,
+
+    total INTEGER NOT NULL DEFAULT 0,
+    processed INTEGER NOT NULL DEFAULT 0,
+    succeeded INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    changed INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+
+CREATE TABLE IF NOT EXISTS replay_results (
+    job_id INTEGER NOT NULL REFERENCES replay_jobs(id) ON DELETE CASCADE,
+    log_id INTEGER NOT NULL,
+    replayed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+    original_status INTEGER,
+    status_code INTEGER,
+    response_body JSONB,
+    duration_ms INTEGER,
+    error TEXT,
+
+    -- Различия с исходным ответом eKomKassa: [{"path", "original", "replayed"}], NULL - совпадает
+    diff JSONB,
+
+    PRIMARY KEY (job_id, log_id)
+);
@@ -0,0 +1,34 @@
+-- Token bucket лимиты запросов к eKomKassa (общие для всех воркеров gunicorn).
+-- UNLOGGED: после сбоя Postgres таблица очищается, лимиты просто начинаются с полного bucket
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    -- login:<login>, token:<sha256 токена>, group:<group_code>
+    bucket_key VARCHAR(200) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL
+);
+
+-- Берёт токен из bucket: 0 - запрос разрешён, иначе через сколько секунд появится токен.
+-- Строка блокируется на время вызова, поэтому одновременные запросы разных воркеров не теряют списания
+CREATE OR REPLACE FUNCTION rate_limit_take(p_key VARCHAR, p_rate DOUBLE PRECISION, p_burst DOUBLE PRECISION)
+RETURNS DOUBLE PRECISION AS $$
+DECLARE
+    v_now TIMESTAMPTZ := clock_timestamp();
+    v_tokens DOUBLE PRECISION;
+BEGIN
+    INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, updated_at)
+    VALUES (p_key, p_burst, v_now)
+    ON CONFLICT (bucket_key) DO UPDATE
+        SET tokens = LEAST(p_burst, b.tokens + GREATEST(EXTRACT(EPOCH FROM v_now - b.updated_at), 0) * p_rate),
+            updated_at = v_now
+    RETURNING tokens INTO v_tokens;
+
+    IF v_tokens >= 1 THEN
+        UPDATE rate_limit_buckets SET tokens = v_tokens - 1 WHERE bucket_key = p_key;
+        RETURN 0;
+    END IF;
+    RETURN (1 - v_tokens) / p_rate;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Для очистки давно не использованных ключей
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated ON rate_limit_buckets(updated_at);
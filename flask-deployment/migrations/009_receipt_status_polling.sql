@@ -0,0 +1,35 @@
+-- Опрос статусов чеков на стороне шлюза и доставка их клиенту на CallbackUrl
+CREATE TABLE IF NOT EXISTS receipt_statuses (
+    uuid VARCHAR(64) PRIMARY KEY,
+    group_code VARCHAR(50) NOT NULL,
+    invoice_id VARCHAR(200),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+    -- wait / done / fail / expired (финальный статус не получен за STATUS_POLL_MAX_AGE_HOURS)
+    state VARCHAR(20) NOT NULL DEFAULT 'wait',
+    -- Токен клиента для запросов статуса в eKomKassa, удаляется после финального статуса
+    auth_token TEXT,
+    poll_attempts INTEGER NOT NULL DEFAULT 0,
+    next_poll_at TIMESTAMP,
+    last_polled_at TIMESTAMP,
+
+    -- Финальный статус в формате Ferma (ответ /api/kkt/cloud/status) и его HTTP статус.
+    -- JSON, а не JSONB: сохраняется порядок полей ответа
+    status_response JSON,
+    status_http INTEGER,
+
+    callback_url TEXT,
+    -- pending / delivered / failed
+    callback_state VARCHAR(20),
+    callback_attempts INTEGER NOT NULL DEFAULT 0,
+    next_callback_at TIMESTAMP,
+    callback_delivered_at TIMESTAMP,
+    callback_last_error TEXT
+);
+
+-- Выборка очередных строк опросчиком и доставкой (SELECT ... FOR UPDATE SKIP LOCKED)
+CREATE INDEX IF NOT EXISTS idx_receipt_statuses_next_poll
+    ON receipt_statuses(next_poll_at) WHERE state = 'wait';
+CREATE INDEX IF NOT EXISTS idx_receipt_statuses_next_callback
+    ON receipt_statuses(next_callback_at) WHERE callback_state = 'pending';
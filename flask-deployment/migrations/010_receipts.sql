@@ -0,0 +1,29 @@
+-- Реестр чеков: InvoiceId <-> uuid eKomKassa с состоянием и данными фискализации.
+-- Поиск чека по uuid или InvoiceId - обращение по индексу вместо поиска по JSONB в request_logs
+CREATE TABLE IF NOT EXISTS receipts (
+    id SERIAL PRIMARY KEY,
+    uuid VARCHAR(64) NOT NULL UNIQUE,
+    invoice_id VARCHAR(200),
+    group_code VARCHAR(50) NOT NULL,
+    -- sell / sell_refund / buy / ... / *_correction
+    operation VARCHAR(50) NOT NULL,
+    inn VARCHAR(20),
+    total NUMERIC(14, 2),
+    items_count INTEGER,
+
+    -- wait / done / fail
+    state VARCHAR(20) NOT NULL DEFAULT 'wait',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- Когда шлюз узнал финальный статус (запрос статуса, опрос или результат от eKomKassa)
+    finalized_at TIMESTAMP,
+
+    -- Из финального статуса: время чека на кассе, Device в формате Ferma, текст ошибки
+    receipt_datetime TIMESTAMP,
+    device JSONB,
+    error_message TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_receipts_invoice ON receipts(invoice_id, group_code);
+CREATE INDEX IF NOT EXISTS idx_receipts_created ON receipts(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_receipts_wait ON receipts(created_at) WHERE state = 'wait';
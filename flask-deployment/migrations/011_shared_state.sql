@@ -0,0 +1,11 @@
+-- Общее состояние узлов шлюза для SHARED_STATE_BACKEND=postgres: кэши с временем жизни
+-- (лимиты запросов - в rate_limit_buckets, миграция 008).
+-- UNLOGGED: после сбоя Postgres таблица очищается, кэши просто заполняются заново
+CREATE UNLOGGED TABLE IF NOT EXISTS shared_state (
+    -- stats:window:24h, stats:range:<from>:<to>
+    state_key VARCHAR(200) PRIMARY KEY,
+    value JSON NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_shared_state_expires ON shared_state(expires_at);
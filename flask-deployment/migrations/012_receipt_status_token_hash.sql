@@ -0,0 +1,3 @@
+-- Сохранённый финальный статус отдаётся только клиенту с тем же AuthToken, что создал чек
+-- (токен в receipt_statuses.auth_token удаляется после финального статуса, хэш остаётся)
+ALTER TABLE receipt_statuses ADD COLUMN IF NOT EXISTS auth_token_hash VARCHAR(64);
@@ -0,0 +1,2 @@
+-- Записи, тела которых обрезаны или замаскированы при логировании, не повторяются и считаются отдельно
+ALTER TABLE replay_jobs ADD COLUMN IF NOT EXISTS skipped INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,33 @@
+-- Списание из нескольких bucket'ов запроса (логин, токен, группа касс) по принципу "всё или ничего":
+-- если хоть один bucket пуст, остальные не теряют токен (иначе один токен, упёршийся в свой лимит,
+-- выбирал бы квоту всей группы касс на каждом повторе)
+CREATE OR REPLACE FUNCTION rate_limit_take_all(
+    p_keys VARCHAR[], p_rates DOUBLE PRECISION[], p_bursts DOUBLE PRECISION[]
+) RETURNS DOUBLE PRECISION AS $$
+DECLARE
+    v_now TIMESTAMPTZ := clock_timestamp();
+    v_wait DOUBLE PRECISION := 0;
+    v_tokens DOUBLE PRECISION;
+    i INTEGER;
+BEGIN
+    -- Пополнение и блокировка строк в порядке ключей: вызовы с пересекающимися ключами не взаимоблокируются
+    FOR i IN SELECT k.ord FROM unnest(p_keys) WITH ORDINALITY AS k(key, ord) ORDER BY k.key LOOP
+        INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, updated_at)
+        VALUES (p_keys[i], p_bursts[i], v_now)
+        ON CONFLICT (bucket_key) DO UPDATE
+            SET tokens = LEAST(p_bursts[i], b.tokens + GREATEST(EXTRACT(EPOCH FROM v_now - b.updated_at), 0) * p_rates[i]),
+                updated_at = v_now
+        RETURNING tokens INTO v_tokens;
+
+        IF v_tokens < 1 THEN
+            v_wait := GREATEST(v_wait, (1 - v_tokens) / p_rates[i]);
+        END IF;
+    END LOOP;
+
+    IF v_wait > 0 THEN
+        RETURN v_wait;
+    END IF;
+    UPDATE rate_limit_buckets SET tokens = tokens - 1 WHERE bucket_key = ANY(p_keys);
+    RETURN 0;
+END;
+$$ LANGUAGE plpgsql;